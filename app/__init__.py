@@ -1,8 +1,25 @@
 import os
+import copy
 from pathlib import Path
 import yaml
 
 from .ceph import ceph
+from .ceph import restore
+from .ceph import synthetic
+from .ceph import compact
+from .ceph import targets
+from .ceph import auto
+from . import scheduler
+from . import compression
+from . import checksum
+from . import throttle
+from . import adaptive
+from . import tracing
+from .storage import verify
+from .storage import backends
+from .storage import files
+from .monitoring import prometheus
+from .monitoring import pandorafms
 from util import color
 
 import logging
@@ -14,12 +31,16 @@ CONFIG_DIR = Path("etc")
 DEFAULT_CONFIG_FILE = CONFIG_DIR.joinpath("ceph_default.yaml")
 CONFIG_FILE = CONFIG_DIR.joinpath("ceph.yaml")
 
-AVAILABLES_BACKUP_TYPES = ["full", "diff"]
+AVAILABLES_BACKUP_TYPES = ["full", "diff", "auto"]
+AVAILABLES_EXPORT_MODES = ["librbd", "cli"]
+AVAILABLES_REFERENCE_MODES = ["rotate", "dummy"]
+AVAILABLES_MODES = ["backup", "restore", "synthetic", "compact", "verify"]
 
 default_config = {
     "app":{
         "verbose": False,
-        "log_file": "onbackup.log"
+        "log_file": "onbackup.log",
+        "mode": "backup"
     },
     "cluster": {
         "conf_file": "etc/ceph/ceph.conf",
@@ -30,10 +51,103 @@ default_config = {
         "type": "full",
         "pool": "",
         "directory": "",
-        "images": ["*"]
+        "images": ["*"],
+        "workers": 1,
+        "retries": 0,
+        "reference": "rotate",
+        "targets": [],
+        "auto": {
+            "restore_weight": 0.5,
+            "max_chain": 30
+        },
+        "export": {
+            "mode": "librbd",
+            "read_size": 8388608,
+            "sparse": True,
+            "checkpoint_interval": 1073741824,
+            "queue_depth": 4,
+            "pipeline": True,
+            "pipeline_buffer": 33554432,
+            "preallocate": False,
+            "cache": "keep",
+            "sync_interval": 0
+        },
+        "compression": {
+            "codec": "none",
+            "level": 3,
+            "threads": 2,
+            "frame_size": 4194304
+        },
+        "dedup": {
+            "enabled": False,
+            "directory": "",
+            "chunk_size": 262144
+        },
+        "checksum": {
+            "algorithm": "blake2b",
+            "block_size": 4194304
+        },
+        "throttle": {
+            "bytes_per_second": 0,
+            "ops_per_second": 0,
+            "image_bytes_per_second": 0,
+            "image_ops_per_second": 0,
+            "schedule": []
+        },
+        "adaptive": {
+            "enabled": False,
+            "interval": 10,
+            "target_latency": 50,
+            "max_pool_ops": 0,
+            "min_workers": 1,
+            "max_reads": 0,
+            "decrease_factor": 0.5
+        },
+        "offsite": {
+            "backend": "none",
+            "directory": "",
+            "endpoint": "",
+            "region": "",
+            "bucket": "",
+            "prefix": "",
+            "access_key": "",
+            "secret_key": "",
+            "part_size": 67108864,
+            "concurrency": 4
+        }
+    },
+    "restore": {
+        "at": "",
+        "target_dir": "",
+        "target_pool": "",
+        "workers": 1,
+        "threads": 2,
+        "queue_size": 8
+    },
+    "verify": {
+        "workers": 1,
+        "threads": 0
+    },
+    "monitoring": {
+        "prometheus": {
+            "textfile": "",
+            "listen": ""
+        },
+        "trace": {
+            "directory": ""
+        }
     }
 }
 
+def merge_config(config, defaults):
+    """ Fills the keys missing in config with the default values """
+    for key, value in defaults.items():
+        if key not in config:
+            config[key] = value
+        elif isinstance(value, dict) and isinstance(config[key], dict):
+            merge_config(config[key], value)
+    return config
+
 def load_config():
     # If config file does not exists create with the default config
     # and return the default configuration and
@@ -49,7 +163,7 @@ def load_config():
     logger.info("Loading ceph config...")
     with open(CONFIG_FILE, 'r') as ymlfile:
         config = yaml.load(ymlfile)
-    return config
+    return merge_config(config, copy.deepcopy(default_config))
 
 def check_config(config):   
     logger.info("Checking the app config...")
@@ -57,31 +171,152 @@ def check_config(config):
     if not app_config["verbose"]:
         # logger.warning("Logging level not set")
         app_config["verbose"] = False
-
-    # Checks if the cluster config exists
-    logger.info("Checking the cluster config...")    
-    cluster_config = config["cluster"]
-    if not Path(cluster_config["conf_file"]).exists():
-        logger.critical(f"Ceph config file \"{cluster_config['conf_file']}\" does not exist")
-        raise
-    if not Path(cluster_config["user_keyring"]).exists():
-        logger.critical(f"User keyring file \"{cluster_config['user_keyring']}\" does not exist")
+    if app_config["mode"] not in AVAILABLES_MODES:
+        logger.critical(f"Mode \"{app_config['mode']}\" not allowed, please use {AVAILABLES_MODES}")
         raise
 
+    # Checks if the cluster config exists, only needed when the program
+    # connects to the cluster
+    backup_config = config["backup"]
+    with_targets = app_config["mode"] == "backup" and bool(backup_config["targets"])
+    if needs_cluster(config) and not with_targets:
+        check_cluster_config(config["cluster"])
+
     # Checks if there are blank values into the config
     logger.info("Checking the ceph config...")
-    backup_config = config["backup"]
-    if not backup_config["pool"].strip():
+    if not backup_config["pool"].strip() and not with_targets:
         logger.critical("Backup pool not set")
         raise
     if not backup_config["directory"].strip():
         logger.critical("Backup directory not set")
         raise
+    if not Path(backup_config["directory"]).exists():
+        logger.critical(f"Backup directory \"{backup_config['directory']}\" does not exist")
+        raise
+
+    if app_config["mode"] in ("backup", "synthetic", "compact"):
+        # The synthetic full backups and the merged diffs are stored like
+        # the exports
+        check_backup_config(backup_config)
+    if with_targets:
+        check_targets_config(config)
+    elif app_config["mode"] == "restore":
+        check_restore_config(config["restore"])
+    if app_config["mode"] == "backup":
+        check_monitoring_config(config["monitoring"])
+
+def check_monitoring_config(monitoring_config):
+    logger.info("Checking the monitoring config...")
+    try:
+        prometheus.check_config(monitoring_config["prometheus"])
+    except ValueError as e:
+        logger.critical(str(e))
+        raise
+    trace_dir = monitoring_config["trace"]["directory"]
+    if trace_dir and not Path(trace_dir).is_dir():
+        logger.critical(f"Trace directory \"{trace_dir}\" does not exist")
+        raise
+
+def needs_cluster(config):
+    """ Whether the selected mode has to connect to the cluster """
+    mode = config["app"]["mode"]
+    return mode == "backup" or (mode == "restore" and bool(config["restore"]["target_pool"]))
+
+def check_cluster_config(cluster_config):
+    logger.info("Checking the cluster config...")    
+    if not Path(cluster_config["conf_file"]).exists():
+        logger.critical(f"Ceph config file \"{cluster_config['conf_file']}\" does not exist")
+        raise
+    if not Path(cluster_config["user_keyring"]).exists():
+        logger.critical(f"User keyring file \"{cluster_config['user_keyring']}\" does not exist")
+        raise
+
+def check_backup_config(backup_config):
+    logger.info("Checking the backup config...")
     if backup_config["type"] not in AVAILABLES_BACKUP_TYPES:
         logger.critical(f"Backup type \"{backup_config['type']}\" not allowed, please use {AVAILABLES_BACKUP_TYPES}")
         raise    
-    if not Path(backup_config["directory"]).exists():
-        logger.critical(f"Backup directory \"{backup_config['directory']}\" does not exist")
+    if int(backup_config["workers"]) < 1:
+        logger.critical("Backup workers must be at least 1")
+        raise
+    if int(backup_config["retries"]) < 0:
+        logger.critical("Backup retries cannot be negative")
+        raise
+    if backup_config["reference"] not in AVAILABLES_REFERENCE_MODES:
+        logger.critical(f"Reference mode \"{backup_config['reference']}\" not allowed, please use {AVAILABLES_REFERENCE_MODES}")
+        raise
+    if backup_config["export"]["mode"] not in AVAILABLES_EXPORT_MODES:
+        logger.critical(f"Export mode \"{backup_config['export']['mode']}\" not allowed, please use {AVAILABLES_EXPORT_MODES}")
+        raise
+    if int(backup_config["export"]["read_size"]) < 4096:
+        logger.critical("Export read size must be at least 4096 bytes")
+        raise
+    if int(backup_config["export"]["checkpoint_interval"]) < int(backup_config["export"]["read_size"]):
+        logger.critical("Export checkpoint interval must be at least the read size")
+        raise
+    if int(backup_config["export"]["queue_depth"]) < 1:
+        logger.critical("Export queue depth must be at least 1")
+        raise
+    if int(backup_config["export"]["pipeline_buffer"]) < 1048576:
+        logger.critical("Export pipeline buffer must be at least 1048576 bytes")
+        raise
+    try:
+        files.check_cache(backup_config["export"]["cache"])
+    except ValueError as e:
+        logger.critical(str(e))
+        raise
+    if int(backup_config["export"]["sync_interval"]) < 0:
+        logger.critical("Export sync interval cannot be negative")
+        raise
+    try:
+        compression.check_codec(backup_config["compression"]["codec"])
+    except ValueError as e:
+        logger.critical(str(e))
+        raise
+    if int(backup_config["compression"]["threads"]) < 1:
+        logger.critical("Compression threads must be at least 1")
+        raise
+    if int(backup_config["dedup"]["chunk_size"]) < 4096:
+        logger.critical("Deduplication chunk size must be at least 4096 bytes")
+        raise
+    try:
+        checksum.check_algorithm(backup_config["checksum"]["algorithm"])
+    except ValueError as e:
+        logger.critical(str(e))
+        raise
+    if int(backup_config["checksum"]["block_size"]) < 4096:
+        logger.critical("Checksum block size must be at least 4096 bytes")
+        raise
+    try:
+        throttle.check_config(backup_config["throttle"])
+        adaptive.check_config(backup_config["adaptive"])
+        auto.check_config(backup_config["auto"])
+        backends.check_config(backup_config["offsite"])
+    except ValueError as e:
+        logger.critical(str(e))
+        raise
+
+def check_targets_config(config):
+    logger.info("Checking the backup targets...")
+    resolved = targets.resolve_targets(config["cluster"], config["backup"])
+    try:
+        targets.check_targets(resolved)
+    except ValueError as e:
+        logger.critical(str(e))
+        raise
+    for target in resolved:
+        check_cluster_config(target["cluster"])
+
+def check_restore_config(restore_config):
+    logger.info("Checking the restore config...")
+    if not restore_config["target_dir"] and not restore_config["target_pool"]:
+        logger.critical("Restore target not set, please set a target directory or a target pool")
+        raise
+    if restore_config["target_dir"] and not Path(restore_config["target_dir"]).exists():
+        logger.critical(f"Restore directory \"{restore_config['target_dir']}\" does not exist")
+        raise
+    if int(restore_config["workers"]) < 1:
+        logger.critical("Restore workers must be at least 1")
         raise
 
 def setup_app(app_config):
@@ -110,11 +345,11 @@ def setup_app(app_config):
     f_handler.setFormatter(f_format)
     logger.addHandler(f_handler)
 
-    # File log for pandora monitoring. Different because it will be erased
-    # all the time
+    # Event log for pandora monitoring, a JSON line per backup event. The
+    # plugin reads it incrementally, so it is appended to
     pandora_handler = logging.FileHandler(
-        "app/monitoring/pandorafms/pandora_data.log", "w")
+        "app/monitoring/pandorafms/pandora_data.log", "a")
     pandora_handler.setLevel(logging.INFO)
-    pandora_format = logging.Formatter('%(asctime)s - %(message)s')
-    pandora_handler.setFormatter(pandora_format)
+    pandora_handler.addFilter(pandorafms.EventFilter())
+    pandora_handler.setFormatter(pandorafms.EventFormatter())
     logger.addHandler(pandora_handler)
@@ -0,0 +1,266 @@
+"""
+Adaptive concurrency of the exports
+
+While a backup runs, a controller samples every `interval` seconds the pool
+and cluster statistics together with the latency and throughput of the reads
+of the exports, and adjusts the number of images exported at the same time
+and of reads in flight, AIMD-style:
+
+    - the reads are slower than `target_latency` or the pool serves more than
+      `max_pool_ops` operations per second (all its clients): both limits are
+      multiplied by `decrease_factor`
+    - otherwise, when the exports had to wait for a slot: the exports grow by
+      one and the reads by the queue depth of an export, unless the last
+      increase did not raise the throughput
+
+The limits start at `min_workers` exports, each with its queue depth of reads,
+and never exceed the configured workers.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+import threading
+
+# Minimum throughput gain that justifies the last increase
+THROUGHPUT_GAIN = 1.05
+
+
+def check_config(config: dict):
+    """
+    Checks the adaptive section of the backup config
+
+    Raises
+    ------
+    ValueError
+        when a parameter is out of range
+    """
+
+    if float(config["interval"]) <= 0:
+        raise ValueError("Adaptive interval must be positive")
+    if float(config["target_latency"]) <= 0:
+        raise ValueError("Adaptive target latency must be positive")
+    if float(config["max_pool_ops"]) < 0:
+        raise ValueError("Adaptive max pool ops cannot be negative")
+    if int(config["min_workers"]) < 1:
+        raise ValueError("Adaptive min workers must be at least 1")
+    if int(config["max_reads"]) < 0:
+        raise ValueError("Adaptive max reads cannot be negative")
+    if not 0 < float(config["decrease_factor"]) < 1:
+        raise ValueError("Adaptive decrease factor must be between 0 and 1")
+
+
+class AdaptiveLimit():
+    """
+    Semaphore whose number of slots can change while it is in use
+
+    When the limit is lowered the slots in use are not taken back, the next
+    acquire waits until enough of them are released.
+    """
+
+    def __init__(self, limit: int, minimum: int = 1, maximum: int = None):
+        self._cond = threading.Condition()
+        self._minimum = max(1, int(minimum))
+        self._maximum = int(maximum) if maximum else None
+        self.limit = self._clamp(limit)
+        self.in_use = 0
+        self._waiting = 0
+        self._contended = False
+
+    def acquire(self):
+        with self._cond:
+            if self.in_use >= self.limit:
+                self._contended = True
+                self._waiting += 1
+                while self.in_use >= self.limit:
+                    self._cond.wait()
+                self._waiting -= 1
+            self.in_use += 1
+
+    def release(self):
+        with self._cond:
+            self.in_use -= 1
+            self._cond.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def set_limit(self, limit: int) -> bool:
+        """ Changes the number of slots. Returns whether it changed """
+        with self._cond:
+            limit = self._clamp(limit)
+            if limit == self.limit:
+                return False
+            self.limit = limit
+            self._cond.notify_all()
+            return True
+
+    def contended(self) -> bool:
+        """ Whether an acquire had to wait since the last call """
+        with self._cond:
+            contended = self._contended or self._waiting > 0
+            self._contended = False
+            return contended
+
+    def _clamp(self, limit: int) -> int:
+        limit = max(self._minimum, int(limit))
+        if self._maximum is not None:
+            limit = min(self._maximum, limit)
+        return limit
+
+
+class ConcurrencyController():
+    """
+    AIMD controller of the concurrent exports and reads
+    """
+
+    def __init__(self, config: dict, max_workers: int, sample_pool=None, sample_cluster=None,
+                 queue_depth: int = 1):
+        """
+        Parameters
+        ----------
+        config : dict
+            adaptive section of the backup config
+        max_workers : int
+            maximum number of images exported at the same time
+        sample_pool : callable
+            returns the statistics of the pool (ioctx.get_stats)
+        sample_cluster : callable
+            returns the statistics of the cluster (get_cluster_stats)
+        queue_depth : int
+            reads in flight of every export
+        """
+
+        check_config(config)
+        self._interval = float(config["interval"])
+        self._target_latency = float(config["target_latency"])
+        self._max_pool_ops = float(config["max_pool_ops"])
+        self._decrease_factor = float(config["decrease_factor"])
+        min_workers = min(int(config["min_workers"]), int(max_workers))
+        self._queue_depth = max(1, int(queue_depth))
+        max_reads = int(config["max_reads"]) or int(max_workers) * self._queue_depth
+        self.exports = AdaptiveLimit(min_workers, min_workers, max_workers)
+        self.reads = AdaptiveLimit(min(min_workers * self._queue_depth, max_reads), 1, max_reads)
+
+        self._sample_pool = sample_pool
+        self._sample_cluster = sample_cluster
+        self._lock = threading.Lock()
+        self._reads = 0
+        self._read_time = 0.0
+        self._read_bytes = 0
+        self._sampled_at = time.monotonic()
+        self._pool_ops = None
+        self._last_increase = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record_read(self, length: int, seconds: float):
+        """ Accounts a read of the exports """
+        with self._lock:
+            self._reads += 1
+            self._read_time += seconds
+            self._read_bytes += length
+
+    def start(self):
+        self._stop.clear()
+        self._sampled_at = time.monotonic()
+        self._pool_ops = self._read_pool_ops()
+        self._thread = threading.Thread(target=self._run, name="adaptive", daemon=True)
+        self._thread.start()
+        logger.info(f"Adaptive concurrency started with {self.exports.limit} exports and "
+                    f"{self.reads.limit} reads in flight")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def step(self) -> dict:
+        """
+        Samples the statistics of the last interval and adjusts the limits
+
+        Returns
+        -------
+        dict
+            the sample: latency (ms), throughput (bytes/s), pool_ops (ops/s),
+            cluster_used (ratio) and the action taken
+        """
+
+        now = time.monotonic()
+        elapsed = max(now - self._sampled_at, 1e-6)
+        self._sampled_at = now
+        with self._lock:
+            reads, read_time, read_bytes = self._reads, self._read_time, self._read_bytes
+            self._reads, self._read_time, self._read_bytes = 0, 0.0, 0
+
+        sample = {
+            "latency": read_time / reads * 1000 if reads else None,
+            "throughput": read_bytes / elapsed,
+            "pool_ops": None,
+            "cluster_used": None
+        }
+        pool_ops = self._read_pool_ops()
+        if pool_ops is not None and self._pool_ops is not None:
+            sample["pool_ops"] = max(0, pool_ops - self._pool_ops) / elapsed
+        self._pool_ops = pool_ops
+        if self._sample_cluster is not None:
+            cluster = self._sample_cluster()
+            if cluster.get("kb"):
+                sample["cluster_used"] = cluster["kb_used"] / cluster["kb"]
+
+        congested = (sample["latency"] is not None and sample["latency"] > self._target_latency) or \
+            (self._max_pool_ops and sample["pool_ops"] is not None and sample["pool_ops"] > self._max_pool_ops)
+        contended = self.exports.contended() | self.reads.contended()
+        if congested:
+            changed = self.exports.set_limit(int(self.exports.limit * self._decrease_factor))
+            changed |= self.reads.set_limit(int(self.reads.limit * self._decrease_factor))
+            sample["action"] = "decrease" if changed else "hold"
+            self._last_increase = None
+        elif not contended:
+            sample["action"] = "hold"
+        elif self._last_increase is not None and sample["throughput"] < self._last_increase * THROUGHPUT_GAIN:
+            # More concurrency did not read faster, wait for the next interval
+            sample["action"] = "hold"
+            self._last_increase = None
+        else:
+            changed = self.exports.set_limit(self.exports.limit + 1)
+            changed |= self.reads.set_limit(self.reads.limit + self._queue_depth)
+            sample["action"] = "increase" if changed else "hold"
+            self._last_increase = sample["throughput"] if changed else None
+
+        logger.debug(f"Adaptive sample: {sample}")
+        if sample["action"] != "hold":
+            logger.info(f"Adaptive concurrency {sample['action']}d to {self.exports.limit} exports and "
+                        f"{self.reads.limit} reads in flight (latency {self._format(sample['latency'], 'ms')}, "
+                        f"pool {self._format(sample['pool_ops'], 'ops/s')})")
+        return sample
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.step()
+            except Exception as e:
+                logger.warning(f"Could not sample the cluster statistics: {e!r}")
+
+    def _read_pool_ops(self):
+        if self._sample_pool is None:
+            return None
+        stats = self._sample_pool()
+        return stats.get("num_rd", 0) + stats.get("num_wr", 0)
+
+    @staticmethod
+    def _format(value, unit: str) -> str:
+        return f"{value:.1f} {unit}" if value is not None else "unknown"
@@ -0,0 +1,134 @@
+"""
+Choice between a full and a diff backup of every image
+
+The `auto` backup type exports a diff or a full image depending on what the
+image went through since its last backup. The changes are measured with
+diff_iterate against the reference snapshot of the image and weighed, with
+the chain of backups recorded in the catalog, against what each choice
+costs:
+
+    full    reads the allocated bytes of the image (those of its last full
+            backup), and a restore only replays them
+    diff    reads the changed bytes, but a restore replays the last full
+            backup, every diff that follows it and the new diff
+
+Both costs add the bytes read now and `restore_weight` times the bytes a
+restore would replay, and the cheaper one is chosen:
+
+    backup:
+      auto:
+        restore_weight: 0.5     # 0 only minimises the bytes read
+        max_chain: 30           # diffs after a full before a full is forced (0 unlimited)
+
+With the default weight a full backup is taken when the changes reach two
+thirds of the last full backup, or the diffs of the chain add up to twice
+its size.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from ..storage.catalog import FULL, DIFF
+
+DEFAULT_RESTORE_WEIGHT = 0.5
+DEFAULT_MAX_CHAIN = 30
+
+
+def check_config(auto_config: dict):
+    """
+    Checks the auto section of the backup config
+
+    Raises
+    ------
+    ValueError
+        when a value is out of range
+    """
+
+    if float(auto_config.get("restore_weight", DEFAULT_RESTORE_WEIGHT)) < 0:
+        raise ValueError("Auto restore weight cannot be negative")
+    if int(auto_config.get("max_chain", DEFAULT_MAX_CHAIN)) < 0:
+        raise ValueError("Auto max chain cannot be negative")
+
+
+class Decision():
+    """
+    Backup type chosen for an image, with the figures it was based on
+    """
+
+    def __init__(self, backup_type: str, reason: str, changed_bytes: int = 0, base_bytes: int = 0,
+                 chain_bytes: int = 0, chain_length: int = 0):
+        self.backup_type = backup_type
+        self.reason = reason
+        self.changed_bytes = changed_bytes
+        self.base_bytes = base_bytes
+        self.chain_bytes = chain_bytes
+        self.chain_length = chain_length
+
+    def __str__(self):
+        return (f"{self.backup_type} ({self.reason}): {self.changed_bytes} bytes changed, "
+                f"last full {self.base_bytes} bytes, {self.chain_length} diffs of {self.chain_bytes} bytes")
+
+
+class AutoPolicy():
+    """
+    Chooses the backup type of an image from its changes and its chain
+    """
+
+    def __init__(self, auto_config: dict = None):
+        """
+        Parameters
+        ----------
+        auto_config : dict
+            auto section of the backup config
+        """
+
+        auto_config = auto_config or {}
+        self.restore_weight = float(auto_config.get("restore_weight", DEFAULT_RESTORE_WEIGHT))
+        self.max_chain = int(auto_config.get("max_chain", DEFAULT_MAX_CHAIN))
+
+    def choose(self, changed_bytes: int, chain: list, image_size: int = 0) -> Decision:
+        """
+        Parameters
+        ----------
+        changed_bytes : int
+            bytes changed since the reference snapshot
+        chain : list
+            backups of the catalog needed to restore the image now, the
+            last full backup followed by its diffs
+        image_size : int
+            size of the image, taken as the size of the backups imported
+            without their sizes
+
+        Returns
+        -------
+        Decision
+        """
+
+        if not chain:
+            return Decision(FULL, "no full backup")
+        base, diffs = chain[0], chain[1:]
+        base_bytes = self._backup_bytes(base, image_size)
+        chain_bytes = sum(self._backup_bytes(diff, image_size) for diff in diffs)
+        figures = dict(changed_bytes=changed_bytes, base_bytes=base_bytes, chain_bytes=chain_bytes,
+                       chain_length=len(diffs))
+
+        if self.max_chain and len(diffs) >= self.max_chain:
+            return Decision(FULL, f"chain of {len(diffs)} diffs", **figures)
+        weight = self.restore_weight
+        full_cost = (1 + weight) * base_bytes
+        diff_cost = changed_bytes + weight * (base_bytes + chain_bytes + changed_bytes)
+        if full_cost <= diff_cost:
+            return Decision(FULL, "cheaper than a diff", **figures)
+        return Decision(DIFF, "cheaper than a full", **figures)
+
+    @staticmethod
+    def _backup_bytes(backup: dict, default: int) -> int:
+        """
+        Bytes of image data of a backup, the ones read to export and to
+        restore it. The cli exports only record the bytes of their file
+        """
+        if backup["allocated_bytes"]:
+            return backup["allocated_bytes"]
+        if backup["bytes_written"] is not None:
+            return backup["bytes_written"]
+        return default
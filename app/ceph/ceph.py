@@ -6,9 +6,28 @@ import rbd
 
 
 from util.color import Color
-
+from ..scheduler import Scheduler
+from .export import Exporter, ExportStats, DEFAULT_READ_SIZE, DEFAULT_CHECKPOINT_INTERVAL, DEFAULT_QUEUE_DEPTH
+from .checkpoint import ExportCheckpoint, remove_stray_partials, SNAPSHOT_NAME_PATTERN
+from .session import ImageSessions
+from .restore import restore_images
+from .auto import AutoPolicy
+from ..storage.catalog import Catalog, FULL, DIFF
+from ..storage.chunkstore import ChunkStore, DEFAULT_CHUNK_SIZE
+from ..storage.sinks import open_sink
+from ..storage.files import commit_file, PARTIAL_SUFFIX
+from ..checksum import read_checksum
+from ..throttle import Throttle
+from ..adaptive import ConcurrencyController
+from ..monitoring.pandorafms import backup_event
+from .. import tracing
+from ..pipeline import Pipeline, DEFAULT_QUEUE_BYTES
+
+import os
 import time
+import fnmatch
 import datetime
+import tempfile
 import subprocess
 from pathlib import Path
 
@@ -19,29 +38,97 @@ class Ceph():
     """
 
     def __init__(self, conf_file: str, user_keyring: str, client: str, pool: str, 
-                images: list, backup_dir: str):        
+                images: list, backup_dir: str, workers: int = 1, retries: int = 0,
+                export_config: dict = None, compression_config: dict = None,
+                dedup_config: dict = None, checksum_config: dict = None,
+                throttle_config: dict = None, adaptive_config: dict = None,
+                reference_mode: str = "rotate", handler=None, catalog: Catalog = None,
+                chunk_store: ChunkStore = None, throttle: Throttle = None,
+                controller: ConcurrencyController = None, name: str = None,
+                offsite=None, auto_config: dict = None):        
+        """
+        The connection, catalog, chunk store, throttle and adaptive controller
+        can be shared with the targets of other pools of the same run. When
+        they are not given, they are created from the parameters. `offsite`
+        is the backend (see storage.backends) where the exported files are
+        copied while they are written, None without offsite copies
+        """
 
         # Cluster parameters
         self.user_keyring = user_keyring
-        self._handler = rados.Rados(
-            conffile=conf_file, conf=dict(keyring=user_keyring), name=f"client.{client}")
-
-        logger.debug("librados version: {}".format(str(self._handler.version())))
-
-        # Connect to the cluster
-        try:
-            self.connect()
-        except:
-            logger.critical(f"Cannot connect to the cluster")
-            raise
+        # A connection created here is shut down with the pool connection
+        self._owns_handler = handler is None
+        if handler is None:
+            handler = Ceph.open_handler(conf_file, user_keyring, client)
+        self._handler = handler
 
         # Backup parameters
         self._pool = pool
         self._client = client
         self._images = images
+        self._name = name
         self._backup_dir = Path(backup_dir)
         self._diffs_dir_name = "diffs"
         self._dummy_snap_name = "dummy"                    
+        # "rotate" keeps the snapshot of every diff run as the reference of
+        # the next one, "dummy" recreates the dummy snapshot after every run
+        self._reference_mode = reference_mode
+        self._workers = workers
+        self._retries = retries
+
+        # Export engine parameters
+        export_config = export_config or {}
+        self._export_mode = export_config.get("mode", "librbd")
+        self._read_size = int(export_config.get("read_size", DEFAULT_READ_SIZE))
+        self._sparse = bool(export_config.get("sparse", True))
+        self._checkpoint_interval = int(export_config.get("checkpoint_interval", DEFAULT_CHECKPOINT_INTERVAL))
+        self._queue_depth = int(export_config.get("queue_depth", DEFAULT_QUEUE_DEPTH))
+        # The exported stream is transformed and written by threads of their
+        # own, with `pipeline_buffer` bytes queued before every one
+        self._pipeline = bool(export_config.get("pipeline", True))
+        self._pipeline_buffer = int(export_config.get("pipeline_buffer", DEFAULT_QUEUE_BYTES))
+        # Preallocation, page cache and sync batching of the exported files
+        self._file_config = {
+            "preallocate": bool(export_config.get("preallocate", False)),
+            "cache": export_config.get("cache", "keep"),
+            "sync_interval": int(export_config.get("sync_interval", 0))
+        }
+
+        # Compression parameters
+        compression_config = compression_config or {}
+        self._compression_config = compression_config
+        self._compression_codec = compression_config.get("codec", "none")
+        self._compression_level = int(compression_config.get("level", 3))
+
+        # Deduplication parameters. The chunks are compressed one by one
+        # when the compression is also enabled
+        dedup_config = dedup_config or {}
+        self._chunk_store = chunk_store
+        self._owns_chunk_store = chunk_store is None
+        self._chunk_size = int(dedup_config.get("chunk_size", DEFAULT_CHUNK_SIZE))
+        if chunk_store is None and dedup_config.get("enabled", False):
+            chunk_store_dir = dedup_config.get("directory") or self._backup_dir.joinpath(".chunks")
+            self._chunk_store = ChunkStore(chunk_store_dir, self._compression_codec, self._compression_level)
+
+        # Checksums of the stored files, computed while they are written
+        self._checksum_config = checksum_config or {}
+
+        # Choice of the backup type of every image in the auto backups
+        self._auto_policy = AutoPolicy(auto_config)
+
+        # Copies of the exported files streamed to another storage
+        self._offsite = offsite
+        if offsite is not None and self._chunk_store is not None:
+            logger.warning("The deduplicated backups are not copied to the offsite backend")
+
+        # Limits of the reads sent to the cluster
+        self._throttle = throttle
+        if throttle is None:
+            self._throttle = Throttle(throttle_config)
+        if self._throttle.enabled:
+            logger.info(f"Reads limited to {self._throttle}")
+            if self._export_mode == "cli":
+                logger.warning("The cli exports are not throttled, use the librbd export mode")
 
         logger.info(f"Attempting to connect to pool {self._pool} ...")
         
@@ -54,12 +141,29 @@ class Ceph():
         logger.info("Connected")
 
         self._rbd = rbd.RBD()
+        self._catalog = catalog
+        self._owns_catalog = catalog is None
+        if catalog is None:
+            self._catalog = Catalog(self._backup_dir)
+        # Adaptive number of concurrent exports and reads, driven by the
+        # statistics of the cluster while the backup runs
+        self._controller = controller
+        if controller is None and adaptive_config and adaptive_config.get("enabled", False):
+            self._controller = ConcurrencyController(
+                adaptive_config, self._workers, self._ioctx.get_stats, self._handler.get_cluster_stats,
+                queue_depth=self._queue_depth)
+            if self._export_mode == "cli":
+                logger.warning("The reads of the cli exports are not limited, only the concurrent exports")
+        self._exporter = Exporter(self._ioctx, self._read_size, self._sparse,
+                                  checkpoint_interval=self._checkpoint_interval,
+                                  throttle=self._throttle, concurrency=self._controller,
+                                  pool_name=self._name or self._pool, queue_depth=self._queue_depth)
 
         # support wildcard for images
         pool_images = self._get_images()
-        if len(self._images) == 1 and self._images[0] == '*':
+        if any(Ceph._is_glob(image) for image in self._images):
             logger.info("Loading all images...")
-            self._images = self._get_images()
+            self._images = Ceph._select_images(self._images, pool_images)
         
         images_out_of_pool = list(set(self._images) - set(pool_images))        
         # Check if the images that you want to do a backup of are in the pool
@@ -67,19 +171,30 @@ class Ceph():
             logger.critical(f"Images \"{images_out_of_pool}\" does not exist in the pool")
             raise
 
+        # Every image is opened once and its metadata cached for the run
+        self._sessions = ImageSessions(self._ioctx)
+        self._sessions.prefetch(self._images)
+
 #######################################
 # Ceph basic interaction
 #######################################
-    def connect(self):
-        """ Connect to the ceph cluster """
+    @staticmethod
+    def open_handler(conf_file: str, user_keyring: str, client: str):
+        """ Connect to the ceph cluster, returns the connection """
+        handler = rados.Rados(
+            conffile=conf_file, conf=dict(keyring=user_keyring), name=f"client.{client}")
+        logger.debug("librados version: {}".format(str(handler.version())))
         logger.info("Will attempt to connect to: {}".format(
-            str(self._handler.conf_get("mon initial members"))))
+            str(handler.conf_get("mon initial members"))))
         try:
-            self._handler.connect()
+            handler.connect()
             logger.info("Connected. cluster ID [{}]".format(
-                self._handler.get_fsid().decode("utf-8")))
-        except Exception as e:
+                handler.get_fsid().decode("utf-8")))
+        except:
+            logger.critical(f"Cannot connect to the cluster")
+            handler.shutdown()
             raise
+        return handler
 
     def print_stats(self):
         print("\nCluster Statistics")
@@ -103,55 +218,314 @@ class Ceph():
 # Rbd interaction
 #######################################
 
-    def full_backup(self):
+    def full_backup(self) -> list:
         """
+        Performs a full backup of every image
 
+        Each image is an independent job of the scheduler, so a failing image
+        does not abort the backup of the rest.
+
+        Returns
+        -------
+        list
+            list of JobResult, one per image
         """
 
-        current_timestamp = Ceph._get_current_timestamp()
-        for image in self._images:            
-            try:
-                logger.info(f"BACKUP - START - FULL - {image}")
-                # Check wheter image directory exists, if not, create it
-                self._check_image_dir(image)
-
-                # Export the image                
-                self._export_image(image, current_timestamp, self._get_image_backup_dir(image))
-                logger.info(f"BACKUP - END - FULL - {image}")
-            except:
-                logger.error(f"Failed to do the full backup!")
-                raise
-    
-    def full_diff_backup(self):
+        scheduler = self._new_scheduler()
+        self.submit_backup_jobs(scheduler, "full", Ceph._get_current_timestamp())
+        return self._run_scheduler(scheduler)
+
+    def full_diff_backup(self) -> list:
         """
-        TODO: Cuando el snapshot dummy no esta creado, exportar la imagen completa
-        para tener una base con la que recuperar
+        Performs a differential backup of every image
+
+        Each image is an independent job of the scheduler, so a failing image
+        does not abort the backup of the rest.
+
+        Returns
+        -------
+        list
+            list of JobResult, one per image
         """
 
-        current_timestamp = Ceph._get_current_timestamp()
-        for image in self._images:                    
-            try:
-                logger.info(f"BACKUP - START - DIFF - {image}")
-                # Check wheter image differentials directory exists, if not, create it
-                self._check_image_diff_dir(image)
-                image_has_dummy = self._check_dummy_snap(image)
-                # Creates a dummy snapshot if is not exists
-                if not image_has_dummy:
-                    logger.info("Image has no previous state! The full image it will be also exported")
-                    logger.info("Exporting the full image (base image to restore)...")
-                    
-                    self._export_image(image, current_timestamp, self._get_image_backup_dir(image))            
-                    logger.info("Creating the first reference snapshot...")
-                    self._create_dummy_snapshot(image)            
-
-                # Export the differential image
-                self._export_diff_image(image, current_timestamp, self._dummy_snap_name, self._get_image_diff_backup_dir(image))                                                
-                logger.info(f"BACKUP - END - DIFF - {image}")                
-                # Update the dummy snapshot
+        scheduler = self._new_scheduler()
+        self.submit_backup_jobs(scheduler, "diff", Ceph._get_current_timestamp())
+        return self._run_scheduler(scheduler)
+
+    def submit_backup_jobs(self, scheduler: Scheduler, backup_type: str, current_timestamp: str):
+        """
+        Queues the backup of every image in a scheduler, that can be shared
+        with the targets of other pools
+
+        Parameters
+        ----------
+        scheduler : Scheduler
+            scheduler of the run
+        backup_type : str
+            "full", "diff" or "auto"
+        current_timestamp : str
+            timestamp of the backup run
+        """
+
+        func = {"full": self._full_backup_image, "diff": self._full_diff_backup_image,
+                "auto": self._auto_backup_image}[backup_type]
+        for image in self._images:
+            job_name = f"{self._name}/{image}" if self._name else image
+            scheduler.submit(job_name, func, image, current_timestamp)
+
+    def _event(self, name: str, backup_type: str, image: str) -> dict:
+        """ Event of the pandora log, the image is named like its job """
+        return backup_event(name, backup_type, f"{self._name}/{image}" if self._name else image)
+
+    def _new_scheduler(self) -> Scheduler:
+        """ Scheduler of the backup jobs, limited by the adaptive controller when enabled """
+        limit = self._controller.exports if self._controller is not None else None
+        return Scheduler(self._workers, self._retries, limit=limit)
+
+    def _run_scheduler(self, scheduler: Scheduler) -> list:
+        if self._controller is None:
+            return scheduler.run()
+        with self._controller:
+            return scheduler.run()
+
+    def _full_backup_image(self, image: str, current_timestamp: str):
+        """
+        Performs the full backup of a single image
+
+        Parameters
+        ----------
+        image : str
+            name of the image
+        current_timestamp : str
+            timestamp of the backup run
+        """
+
+        try:
+            logger.info(f"BACKUP - START - FULL - {image}", extra=self._event("start", "full", image))
+            # Check wheter image directory exists, if not, create it
+            self._check_image_dir(image)
+            with tracing.span("metadata", image=image):
+                self._collect_garbage(image)
+
+            # Export the image                
+            stats = self._export_image(image, current_timestamp, self._get_image_backup_dir(image))
+            stats.snapshots = len(self._get_image_snapshots(image))
+            logger.info(f"BACKUP - END - FULL - {image}", extra=self._event("end", "full", image))
+            return stats
+        except:
+            logger.error(f"Failed to do the full backup of {image}!", extra=self._event("fail", "full", image))
+            raise
+
+    def _full_diff_backup_image(self, image: str, current_timestamp: str):
+        """
+        Performs the differential backup of a single image
+
+        The diff is exported from the reference snapshot of the image. When
+        the image has no reference yet, the full image is exported first as
+        the base to restore the diffs onto.
+
+        Parameters
+        ----------
+        image : str
+            name of the image
+        current_timestamp : str
+            timestamp of the backup run
+        """
+
+        try:
+            logger.info(f"BACKUP - START - DIFF - {image}", extra=self._event("start", "diff", image))
+            # Check wheter image differentials directory exists, if not, create it
+            self._check_image_diff_dir(image)
+            with tracing.span("metadata", image=image):
+                snapshots = self._collect_garbage(image)
+            stats = self._diff_backup_image(image, current_timestamp, snapshots)
+            stats.snapshots = len(self._get_image_snapshots(image))
+            logger.info(f"BACKUP - END - DIFF - {image}", extra=self._event("end", "diff", image))
+            return stats
+        except:
+            logger.error(f"Failed to do the full diff backup of {image}!", extra=self._event("fail", "diff", image))
+            raise
+
+    def _auto_backup_image(self, image: str, current_timestamp: str):
+        """
+        Performs the full or the differential backup of a single image,
+        whichever the auto policy finds cheaper from the bytes changed since
+        the reference snapshot and the chain of backups of the image
+
+        Parameters
+        ----------
+        image : str
+            name of the image
+        current_timestamp : str
+            timestamp of the backup run
+        """
+
+        try:
+            logger.info(f"BACKUP - START - AUTO - {image}", extra=self._event("start", "auto", image))
+            self._check_image_diff_dir(image)
+            with tracing.span("metadata", image=image):
+                snapshots = self._collect_garbage(image)
+            if self._reference_mode == "rotate":
+                reference = self._get_reference_snapshot(image, snapshots)
+            else:
+                reference = self._dummy_snap_name if self._check_dummy_snap(image, snapshots) else None
+
+            # Without reference the diff backup exports the base, and only
+            # the base in rotate mode
+            backup_type = FULL if reference is None and self._reference_mode == "rotate" else DIFF
+            if reference is not None:
+                phase_started = time.monotonic()
+                with tracing.span("change_rate", image=image, snapshot=reference) as span:
+                    session = self._sessions.get(image)
+                    changed_bytes = session.changed_bytes(reference)
+                    decision = self._auto_policy.choose(
+                        changed_bytes, self._catalog.get_chain(self._pool, image), session.size)
+                    span.set(changed_bytes=changed_bytes, decision=decision.backup_type)
+                logger.info(f"Backup of {image}: {decision}")
+                backup_type = decision.backup_type
+                change_rate_time = time.monotonic() - phase_started
+
+            if backup_type == FULL and reference is not None:
+                stats = self._rebase_image(image, current_timestamp, reference)
+            else:
+                stats = self._diff_backup_image(image, current_timestamp, snapshots)
+            if reference is not None:
+                stats.add_phase("change_rate", change_rate_time)
+            stats.backup_type = backup_type
+            stats.snapshots = len(self._get_image_snapshots(image))
+            logger.info(f"BACKUP - END - AUTO - {image}", extra=self._event("end", backup_type, image))
+            return stats
+        except:
+            logger.error(f"Failed to do the auto backup of {image}!", extra=self._event("fail", "auto", image))
+            raise
+
+    def _diff_backup_image(self, image: str, current_timestamp: str, snapshots: set):
+        """
+        Exports the differential of a single image from its reference
+        snapshot, or the full image when it has none, and moves the reference
+
+        Parameters
+        ----------
+        image : str
+            name of the image
+        current_timestamp : str
+            timestamp of the backup run
+        snapshots : set
+            names of the snapshots of the image
+        """
+
+        if self._reference_mode == "rotate":
+            return self._rotate_diff_backup_image(image, current_timestamp, snapshots)
+
+        image_has_dummy = self._check_dummy_snap(image, snapshots)
+        # Creates a dummy snapshot if is not exists
+        if not image_has_dummy:
+            logger.info("Image has no previous state! The full image it will be also exported")
+            logger.info("Exporting the full image (base image to restore)...")
+            
+            self._export_image(image, current_timestamp, self._get_image_backup_dir(image))            
+            logger.info("Creating the first reference snapshot...")
+            self._create_dummy_snapshot(image)            
+
+        # Export the differential image
+        stats = self._export_diff_image(image, current_timestamp, self._dummy_snap_name, self._get_image_diff_backup_dir(image))                                                
+        # Update the dummy snapshot
+        phase_started = time.monotonic()
+        with tracing.span("reference_update", image=image):
+            self._update_dummy_snapshot(image)
+        stats.add_phase("reference", time.monotonic() - phase_started)
+        return stats
+
+    def _rebase_image(self, image: str, current_timestamp: str, reference: str):
+        """
+        Exports the full image as the new base of its diffs, and moves the
+        reference snapshot to it
+
+        Parameters
+        ----------
+        image : str
+            name of the image
+        current_timestamp : str
+            timestamp of the backup run
+        reference : str
+            current reference snapshot of the image
+        """
+
+        rotate = self._reference_mode == "rotate"
+        stats = self._export_image(image, current_timestamp, self._get_image_backup_dir(image),
+                                   keep_snapshot=rotate)
+        phase_started = time.monotonic()
+        with tracing.span("reference_update", image=image, snapshot=reference):
+            if rotate:
+                # The new snapshot is already recorded as the reference
+                self._remove_reference(image, reference, stats)
+            else:
                 self._update_dummy_snapshot(image)
-            except:
-                logger.error(f"Failed to do the full diff backup!")
-                raise
+        stats.add_phase("reference", time.monotonic() - phase_started)
+        return stats
+
+    def _rotate_diff_backup_image(self, image: str, current_timestamp: str, snapshots: set):
+        """
+        Performs the differential backup of a single image, rotating the
+        reference snapshot
+
+        The snapshot of the export is kept as the reference of the next run
+        and only the previous reference is removed, so every write lands in
+        one of the diffs. The full image is exported, and its snapshot kept,
+        when there is no reference yet.
+
+        Parameters
+        ----------
+        image : str
+            name of the image
+        current_timestamp : str
+            timestamp of the backup run
+        snapshots : set
+            names of the snapshots of the image
+        """
+
+        reference = self._get_reference_snapshot(image, snapshots)
+        if reference is None:
+            logger.info("Image has no reference snapshot! The full image it will be exported (base image to restore)")
+            return self._export_image(image, current_timestamp, self._get_image_backup_dir(image),
+                                      keep_snapshot=True)
+
+        stats = self._export_diff_image(image, current_timestamp, reference,
+                                        self._get_image_diff_backup_dir(image), keep_snapshot=True)
+        # The new snapshot is already recorded as the reference
+        phase_started = time.monotonic()
+        with tracing.span("reference_update", image=image, snapshot=reference):
+            self._remove_reference(image, reference, stats)
+        stats.add_phase("reference", time.monotonic() - phase_started)
+        return stats
+
+    def restore(self, pool: str, images: list, at: str = None, workers: int = 1,
+                threads: int = 2, queue_size: int = 8) -> list:
+        """
+        Restores images of the backup directory as rbd images of this pool
+
+        Parameters
+        ----------
+        pool : str
+            pool of the backed up images
+        images : list
+            names of the images ('*' for every image of the pool in the catalog)
+        at : str
+            point in time (backup timestamp). None restores the latest backup
+        workers : int
+            number of images restored at the same time
+
+        Returns
+        -------
+        list
+            list of JobResult, one per image
+        """
+
+        chunk_store_dir = self._chunk_store.root if self._chunk_store is not None else \
+            self._backup_dir.joinpath(".chunks")
+        return restore_images(self._backup_dir, pool, images, at, ioctx=self._ioctx,
+                              chunk_store_dir=chunk_store_dir, workers=workers,
+                              threads=threads, queue_size=queue_size)
 
     def print_overview(self):
         """
@@ -200,7 +574,7 @@ class Ceph():
         pool_dir = self._get_pool_dir()
         if not pool_dir.exists():
             logger.info(f"Pool [{pool_dir}] directory does not exist. It will be created")
-            pool_dir.mkdir()
+            pool_dir.mkdir(exist_ok=True)
 
     def _check_image_dir(self, image_name: str):
         """
@@ -219,7 +593,7 @@ class Ceph():
         image_dir = self._get_image_backup_dir(image_name)
         if not image_dir.exists():
             logger.info(f"Image [{image_dir}] directory does not exist. It will be created")
-            image_dir.mkdir()
+            image_dir.mkdir(exist_ok=True)
     
     def _check_image_diff_dir(self, image_name: str):
         """
@@ -238,7 +612,7 @@ class Ceph():
         diff_dir = self._get_image_diff_backup_dir(image_name)
         if not diff_dir.exists():
             logger.info(f"Diff [{diff_dir}] directory does not exist. It will be created")
-            diff_dir.mkdir()
+            diff_dir.mkdir(exist_ok=True)
     
     def _get_pool_dir(self):
         return self._backup_dir.joinpath(self._pool)
@@ -253,7 +627,8 @@ class Ceph():
 # Images management
 #######################################
 
-    def _export_image(self, image_name: str, target_name: str, export_dir: str):
+    def _export_image(self, image_name: str, target_name: str, export_dir: str,
+                      keep_snapshot: bool = False):
         """
         Export a image
 
@@ -271,22 +646,48 @@ class Ceph():
             name of the exported snapshot. The final name it will be <image_name>_<target_name>.img
         export_dir : str
             directory where the image will be exported
+        keep_snapshot : bool
+            keep the snapshot as the reference of the next diff instead of
+            removing it
         """
 
-        try:
-            # Create the snapshot
+        # Resume an interrupted export against its snapshot or create the snapshot
+        phase_started = time.monotonic()
+        checkpoint = self._find_checkpoint(image_name, FULL, export_dir)
+        if checkpoint is not None:
+            target_name = checkpoint["snapshot"]
+            logger.info(f"Resuming the export of {image_name}@{target_name} at offset {checkpoint['offset']}")
+        else:
             self._create_snapshot(image_name, target_name)
-        
+        snapshot_time = time.monotonic() - phase_started
+        try:
             # Export the snapshot
-            self._export_snapshot(image_name, target_name, export_dir)
-
-            # Remove it after exporting
-            self._delete_snapshot(image_name, target_name)
+            started_at = time.time()
+            with tracing.span("export", image=image_name, snapshot=target_name, type=FULL) as span:
+                stats = self._export_snapshot(image_name, target_name, export_dir, checkpoint)
+                span.set(bytes_read=stats.bytes_read, bytes_written=stats.bytes_written)
+            stats.started_at, stats.elapsed = started_at, time.time() - started_at
+            stats.add_phase("snapshot", snapshot_time)
+            stats.add_phase("export", stats.elapsed)
+            phase_started = time.monotonic()
+            with tracing.span("register", image=image_name):
+                self._register_backup(image_name, FULL, target_name, stats, reference=keep_snapshot)
+            stats.add_phase("register", time.monotonic() - phase_started)
         except:
             logger.info(f"Failed to export image {image_name}")
+            self._keep_or_discard_snapshot(image_name, target_name,
+                                           self._get_export_path(image_name, target_name, export_dir))
             raise
 
-    def _export_diff_image(self, image_name: str, target_name: str, from_snapshot_name: str, export_dir: str):
+        # Remove it after exporting
+        phase_started = time.monotonic()
+        if not keep_snapshot:
+            self._delete_snapshot(image_name, target_name)
+        stats.add_phase("cleanup", time.monotonic() - phase_started)
+        return stats
+
+    def _export_diff_image(self, image_name: str, target_name: str, from_snapshot_name: str, export_dir: str,
+                           keep_snapshot: bool = False):
         """
         Export a differential image
 
@@ -307,21 +708,47 @@ class Ceph():
             name of the snapshot from which the diferences are calculated
         export_dir : str
             directory where the snapshot image will be exported
+        keep_snapshot : bool
+            keep the snapshot as the reference of the next diff instead of
+            removing it
         """
 
-        try:
-            # Create the snapshot
+        # Resume an interrupted export against its snapshot or create the snapshot
+        phase_started = time.monotonic()
+        checkpoint = self._find_checkpoint(image_name, DIFF, export_dir, from_snapshot_name)
+        if checkpoint is not None:
+            target_name = checkpoint["snapshot"]
+            logger.info(f"Resuming the diff export of {image_name}@{target_name} at offset {checkpoint['offset']}")
+        else:
             self._create_snapshot(image_name, target_name)
-
+        snapshot_time = time.monotonic() - phase_started
+        try:
             # Exports the snapshot but with differences from the dummy snap
-            self._export_diff_snapshot(image_name, target_name, from_snapshot_name, export_dir)
-
-            # Remove it after exporting
-            self._delete_snapshot(image_name, target_name)
+            started_at = time.time()
+            with tracing.span("export", image=image_name, snapshot=target_name, type=DIFF) as span:
+                stats = self._export_diff_snapshot(image_name, target_name, from_snapshot_name, export_dir, checkpoint)
+                span.set(bytes_read=stats.bytes_read, bytes_written=stats.bytes_written)
+            stats.started_at, stats.elapsed = started_at, time.time() - started_at
+            stats.add_phase("snapshot", snapshot_time)
+            stats.add_phase("export", stats.elapsed)
+            phase_started = time.monotonic()
+            with tracing.span("register", image=image_name):
+                self._register_backup(image_name, DIFF, target_name, stats, from_snapshot_name,
+                                      reference=keep_snapshot)
+            stats.add_phase("register", time.monotonic() - phase_started)
         except:
             logger.info(f"Failed to export diff image {image_name}")
+            self._keep_or_discard_snapshot(image_name, target_name,
+                                           self._get_export_path(image_name, target_name, export_dir, diff=True))
             raise
 
+        # Remove it after exporting
+        phase_started = time.monotonic()
+        if not keep_snapshot:
+            self._delete_snapshot(image_name, target_name)
+        stats.add_phase("cleanup", time.monotonic() - phase_started)
+        return stats
+
 #######################################
 # Snapshots management
 #######################################
@@ -333,10 +760,11 @@ class Ceph():
         full_snapshot_name = self._get_full_snapshot_name(image_name, snapshot_name)
         logger.info(f"Attempting to create snapshot {full_snapshot_name}")
         try:
-            image = rbd.Image(self._ioctx, image_name)
-            image.create_snap(snapshot_name)
+            with tracing.span("snapshot_create", image=image_name, snapshot=snapshot_name):
+                self._sessions.get(image_name).create_snap(snapshot_name)
+            self._catalog.add_snapshot(self._pool, image_name, snapshot_name)
             logger.info(f"Snapshot {full_snapshot_name} successfully created")
-        except (ImageExists) as e:
+        except (rbd.ImageExists) as e:
             logger.critical(f"Failed to create snapshot {full_snapshot_name}")
             raise e
 
@@ -348,22 +776,111 @@ class Ceph():
         full_snapshot_name = self._get_full_snapshot_name(image_name, snapshot_name)
         logger.info(f"Attempting to delete snapshot {full_snapshot_name}")
         try:
-            image = rbd.Image(self._ioctx, image_name)
-            image.remove_snap(snapshot_name)
+            with tracing.span("snapshot_delete", image=image_name, snapshot=snapshot_name):
+                self._sessions.get(image_name).remove_snap(snapshot_name)
+            self._catalog.remove_snapshot(self._pool, image_name, snapshot_name)
             logger.info(f"Snapshot {full_snapshot_name} successfully deleted")
-        except (ImageNotFound, ImageBusy, IOError) as e:
+        except (rbd.ImageNotFound, rbd.ImageBusy, IOError) as e:
             logger.critical(f"Failed to delete snapshot {full_snapshot_name}")
             raise e
 
+    def _discard_snapshot(self, image_name: str, snapshot_name: str):
+        """
+        Deletes a snapshot left behind by a failed export, so the export can
+        be retried. Errors are only logged.
+        """
+
+        try:
+            self._delete_snapshot(image_name, snapshot_name)
+        except Exception:
+            logger.warning(f"Could not discard snapshot {self._get_full_snapshot_name(image_name, snapshot_name)}")
+
+    def _remove_reference(self, image_name: str, snapshot_name: str, stats: ExportStats):
+        """
+        Deletes the previous reference snapshot of an image once the new one
+        is recorded. The backup is complete, so a failure does not fail it:
+        the error is added to its stats, and the snapshot stays recorded in
+        the catalog to be collected by the next run
+        """
+
+        try:
+            self._delete_snapshot(image_name, snapshot_name)
+        except Exception as e:
+            full_snapshot_name = self._get_full_snapshot_name(image_name, snapshot_name)
+            logger.error(f"Could not remove the previous reference snapshot {full_snapshot_name}: {e!r}")
+            stats.errors.append(f"reference snapshot {full_snapshot_name} not removed")
+
+    def _keep_or_discard_snapshot(self, image_name: str, snapshot_name: str, export_path: str):
+        """
+        Keeps the snapshot of a failed export when it saved a checkpoint, so
+        the next run resumes it, and discards it otherwise
+        """
+
+        if ExportCheckpoint(export_path).exists():
+            logger.warning(f"Snapshot {self._get_full_snapshot_name(image_name, snapshot_name)} kept, "
+                           "the export will be resumed from its last checkpoint")
+        else:
+            self._discard_snapshot(image_name, snapshot_name)
+
 #######################################
 # Snapshots export management
 #######################################
 
-    def _export_snapshot(self, image_name: str, snapshot_name: str, export_dir: str):
+    def _export_snapshot(self, image_name: str, snapshot_name: str, export_dir: str,
+                         checkpoint: dict = None):
         """
         Export a snapshot
 
-        Export a snapshot to a backup directory defined when the object was created
+        Export a snapshot to a backup directory defined when the object was created.
+        Depending on the export mode, the snapshot is read in-process through
+        librbd ("librbd") or exported by the rbd command ("cli")
+        
+        Parameters
+        ----------
+        image_name : str
+            name of the image
+        snapshot_name : str
+            name of the snapshot that will be exported
+        export_dir : str
+            directory where the snapshot will be exported
+        checkpoint : dict
+            checkpoint of an interrupted export of the snapshot to resume
+        """
+
+        if self._export_mode == "cli":
+            return self._export_snapshot_cli(image_name, snapshot_name, export_dir)
+
+        full_snapshot_name = self._get_full_snapshot_name(image_name, snapshot_name)
+        logger.info(f"Attempting to export the snapshot {full_snapshot_name}")
+
+        export_checkpoint = ExportCheckpoint(self._get_export_path(image_name, snapshot_name, export_dir))
+        pipeline = self._new_pipeline()
+        sink = self._open_sink(str(export_checkpoint.export_path), checkpoint["sink"] if checkpoint else None,
+                               pipeline, self._sessions.get(image_name).size)
+        try:
+            stats = self._exporter.export(
+                image_name, snapshot_name, sink, *self._resume_point(checkpoint),
+                self._checkpoint_writer(export_checkpoint, sink, image_name, FULL, snapshot_name))
+            # Without checkpoint an interrupted close leaves a stray partial file
+            export_checkpoint.remove(partials=False)
+            with tracing.span("close", image=image_name, path=sink.path):
+                sink.close()
+            stats.bytes_written = sink.bytes_written
+            stats.path = sink.path
+            self._record_pipeline(pipeline, stats, full_snapshot_name)
+        except Exception as e:
+            if export_checkpoint.exists():
+                sink.suspend()
+            else:
+                sink.abort()
+            logger.critical(f"Failed to export snapshot {full_snapshot_name}: {e!r}")
+            raise
+        logger.info(f"Snapshot {full_snapshot_name} exported: {stats}")
+        return stats
+
+    def _export_snapshot_cli(self, image_name: str, snapshot_name: str, export_dir: str):
+        """
+        Export a snapshot using the rbd command
 
         The method will perform the following method:
             rbd export --pool pool --image image_name --snap snap_name --path path
@@ -381,11 +898,12 @@ class Ceph():
         full_snapshot_name = self._get_full_snapshot_name(image_name, snapshot_name)
         logger.info(f"Attempting to export the snapshot {full_snapshot_name}")
 
+        path = f"{export_dir}/{image_name}_{snapshot_name}.img"
         args = {
             "pool": f"{self._pool}",
             "image": f"{image_name}",
             "snap": f"{snapshot_name}",
-            "path": f"{export_dir}/{image_name}_{snapshot_name}.img"
+            "path": "-" if self._stream_output() else f"{path}{PARTIAL_SUFFIX}"
         }
 
         # Generate a list with all the command parameters
@@ -393,20 +911,71 @@ class Ceph():
         for key, value in args.items():
             command.append(f"--{key}")
             command.append(f"{value}")
-        
-        # Execute that command
-        logger.info(f"Executing command: {' '.join(command)}")
-        p = subprocess.run(command,  capture_output=True)
-        if p.returncode != 0:
-            logger.critical(f"Failed to export snapshot {full_snapshot_name}: {p.stderr}")
-            raise Exception
 
-    def _export_diff_snapshot(self, image_name: str, snapshot_name: str, from_snapshot_name:str, export_dir):
+        # The output has to pass through the sink stages
+        if self._stream_output():
+            return self._stream_export_command(command, path, full_snapshot_name,
+                                               self._sessions.get(image_name).size)
+        return self._run_export_command(command, path, full_snapshot_name)
+
+    def _export_diff_snapshot(self, image_name: str, snapshot_name: str, from_snapshot_name:str, export_dir,
+                              checkpoint: dict = None):
         """
         Export a differential snapshot
 
         Export a differential snapshot of a imaged related to another snapshot and
-        store it into the backup directory        
+        store it into the backup directory. Depending on the export mode, the
+        snapshot is read in-process through librbd ("librbd") or exported by
+        the rbd command ("cli")
+        
+        Parameters
+        ----------
+        image_name: str
+            name of the image
+        snapshot_name: str
+            name of the snapshot that will be exported
+        from_snapshot_name: str
+            name of the snapshot from which differences are calculated
+        export_dir : str
+            directory where the differential snapshot will be exported
+        """        
+
+        if self._export_mode == "cli":
+            return self._export_diff_snapshot_cli(image_name, snapshot_name, from_snapshot_name, export_dir)
+
+        full_snapshot_name = self._get_full_snapshot_name(image_name, snapshot_name)
+        full_from_snapshot_name = self._get_full_snapshot_name(image_name, from_snapshot_name)
+        logger.info(f"Attempting to export a diff of {full_snapshot_name} from {full_from_snapshot_name}")
+
+        export_checkpoint = ExportCheckpoint(self._get_export_path(image_name, snapshot_name, export_dir, diff=True))
+        pipeline = self._new_pipeline()
+        sink = self._open_sink(str(export_checkpoint.export_path), checkpoint["sink"] if checkpoint else None,
+                               pipeline)
+        try:
+            stats = self._exporter.export_diff(
+                image_name, snapshot_name, from_snapshot_name, sink, *self._resume_point(checkpoint),
+                self._checkpoint_writer(export_checkpoint, sink, image_name, DIFF, snapshot_name,
+                                        from_snapshot_name))
+            # Without checkpoint an interrupted close leaves a stray partial file
+            export_checkpoint.remove(partials=False)
+            with tracing.span("close", image=image_name, path=sink.path):
+                sink.close()
+            stats.bytes_written = sink.bytes_written
+            stats.path = sink.path
+            self._record_pipeline(pipeline, stats, full_snapshot_name)
+        except Exception as e:
+            if export_checkpoint.exists():
+                sink.suspend()
+            else:
+                sink.abort()
+            logger.critical(f"Failed to export snapshot {full_snapshot_name}: {e!r}")
+            raise
+        logger.info(f"Snapshot {full_snapshot_name} exported: {stats}")
+        return stats
+
+    def _export_diff_snapshot_cli(self, image_name: str, snapshot_name: str, from_snapshot_name:str, export_dir):
+        """
+        Export a differential snapshot using the rbd command
 
         The method will perform the following method:
             rbd export-diff --pool backup-one --image image_name --from-snap from_snapshot_name --snap snapshot_name
@@ -428,12 +997,13 @@ class Ceph():
         full_from_snapshot_name = self._get_full_snapshot_name(image_name, from_snapshot_name)
         logger.info(f"Attempting to export a diff of {full_snapshot_name} from {full_from_snapshot_name}")
 
+        path = f"{export_dir}/diff_{image_name}_{snapshot_name}.img"
         args = {
             "pool": f"{self._pool}",
             "image": f"{image_name}",
             "from-snap": f"{from_snapshot_name}",            
             "snap": f"{snapshot_name}",            
-            "path": f"{export_dir}/diff_{image_name}_{snapshot_name}.img"
+            "path": "-" if self._stream_output() else f"{path}{PARTIAL_SUFFIX}"
         }
         
         # Generate a list with all the command parameters
@@ -441,13 +1011,329 @@ class Ceph():
         for key, value in args.items():
             command.append(f"--{key}")
             command.append(f"{value}")
-        
-        # Execute that command
+
+        # The output has to pass through the sink stages
+        if self._stream_output():
+            return self._stream_export_command(command, path, full_snapshot_name)
+        return self._run_export_command(command, path, full_snapshot_name)
+
+    def _run_export_command(self, command: list, path: str, full_snapshot_name: str) -> ExportStats:
+        """
+        Executes a rbd export command that writes into <path>.part, then
+        syncs the file and renames it to <path>
+
+        Parameters
+        ----------
+        command : list
+            rbd command
+        path : str
+            path of the exported file
+        full_snapshot_name : str
+            name of the exported snapshot, used in the log
+
+        Returns
+        -------
+        ExportStats
+            counters of the export
+        """
+
+        partial_path = f"{path}{PARTIAL_SUFFIX}"
         logger.info(f"Executing command: {' '.join(command)}")
         p = subprocess.run(command,  capture_output=True)
         if p.returncode != 0:
             logger.critical(f"Failed to export snapshot {full_snapshot_name}: {p.stderr}")
+            try:
+                os.unlink(partial_path)
+            except FileNotFoundError:
+                pass
             raise Exception
+        with tracing.span("close", snapshot=full_snapshot_name, path=path):
+            commit_file(partial_path, path)
+
+        stats = ExportStats()
+        stats.path = path
+        stats.bytes_written = os.path.getsize(path)
+        return stats
+
+    def _stream_export_command(self, command: list, path: str, full_snapshot_name: str,
+                               size: int = None) -> ExportStats:
+        """
+        Executes a rbd export command that writes to stdout and passes its
+        output through the sink stages
+
+        Parameters
+        ----------
+        command : list
+            rbd command, with "-" as path
+        path : str
+            path of the exported file (without the compression suffix)
+        full_snapshot_name : str
+            name of the exported snapshot, used in the log
+        size : int
+            size of the image of a full export, to preallocate the file
+
+        Returns
+        -------
+        ExportStats
+            counters of the export
+        """
+
+        command.append("--no-progress")
+        logger.info(f"Executing command: {' '.join(command)}")
+        stats = ExportStats()
+        pipeline = self._new_pipeline()
+        sink = self._open_sink(path, pipeline=pipeline, size=size)
+        # The errors go to a file, a full stderr pipe would block the command
+        # while its output is streamed
+        stderr = tempfile.TemporaryFile()
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            data = p.stdout.read(self._read_size)
+            while data:
+                sink.write(data)
+                stats.bytes_read += len(data)
+                data = p.stdout.read(self._read_size)
+            p.wait()
+            if p.returncode != 0:
+                stderr.seek(0)
+                raise Exception(stderr.read())
+            with tracing.span("close", snapshot=full_snapshot_name, path=sink.path):
+                sink.close()
+        except Exception as e:
+            p.kill()
+            p.wait()
+            sink.abort()
+            logger.critical(f"Failed to export snapshot {full_snapshot_name}: {e!r}")
+            raise
+        finally:
+            p.stdout.close()
+            stderr.close()
+        stats.logical_bytes = stats.bytes_read
+        stats.bytes_written = sink.bytes_written
+        stats.path = sink.path
+        self._record_pipeline(pipeline, stats, full_snapshot_name)
+        logger.info(f"Snapshot {full_snapshot_name} exported: {stats}")
+        return stats
+
+    def _register_backup(self, image_name: str, backup_type: str, target_name: str,
+                         stats: ExportStats, from_snapshot_name: str = None, reference: bool = False):
+        """
+        Records a completed export in the catalog
+
+        Parameters
+        ----------
+        image_name : str
+            name of the image
+        backup_type : str
+            "full" or "diff"
+        target_name : str
+            name of the exported snapshot
+        stats : ExportStats
+            counters of the export
+        from_snapshot_name : str
+            name of the reference snapshot of a diff
+        reference : bool
+            record the exported snapshot as the reference of the next diff
+        """
+
+        parent_id = None
+        if backup_type == DIFF:
+            base = self._catalog.get_latest_full(self._pool, image_name)
+            parent_id = base["id"] if base else None
+        self._catalog.add_backup(
+            self._pool, image_name, backup_type, target_name, stats.path,
+            parent_id=parent_id, snapshot=target_name, from_snapshot=from_snapshot_name,
+            logical_bytes=stats.logical_bytes, allocated_bytes=stats.allocated_bytes,
+            bytes_written=stats.bytes_written, started_at=stats.started_at,
+            duration=stats.elapsed, checksum=read_checksum(stats.path), reference=reference)
+
+    def _stream_output(self) -> bool:
+        """
+        Whether the exports have to pass through a compression, deduplication,
+        checksum or offsite copy stage, or be written by a tuned file writer
+        """
+        return (self._compression_codec != "none" or self._chunk_store is not None or
+                self._checksum_config.get("algorithm", "none") != "none" or self._offsite is not None or
+                self._file_config["preallocate"] or self._file_config["cache"] != "keep" or
+                self._file_config["sync_interval"] > 0)
+
+    def _open_sink(self, path: str, resume: dict = None, pipeline: Pipeline = None, size: int = None):
+        """
+        Opens the sink where an export is written, adding the compression,
+        deduplication and checksum stages when they are enabled
+
+        Parameters
+        ----------
+        path : str
+            path of the exported file. The codec suffix is appended when the
+            file is compressed and the manifest suffix when it is deduplicated
+        resume : dict
+            sink state saved in the checkpoint of an interrupted export
+        pipeline : Pipeline
+            pipeline of the export, None to write in the export thread
+        size : int
+            size of the image of a full export, to preallocate the file
+        """
+
+        return open_sink(path, self._compression_config, self._chunk_store, self._chunk_size,
+                         self._checksum_config, resume,
+                         self._open_offsite_writer if self._offsite is not None else None,
+                         pipeline, self._pipeline_buffer, self._file_config, size)
+
+    def _new_pipeline(self) -> Pipeline:
+        """ Pipeline of an export, None when the exports are not pipelined """
+        return Pipeline() if self._pipeline else None
+
+    def _record_pipeline(self, pipeline: Pipeline, stats: ExportStats, full_snapshot_name: str):
+        """ Adds the counters of the stages of a completed export to its stats """
+        if pipeline is None:
+            return
+        pipeline.stop()
+        stats.stages = pipeline.as_dict()
+        logger.info(f"Pipeline of {full_snapshot_name}: {pipeline}")
+
+    def _open_offsite_writer(self, path: str):
+        """ Opens the offsite copy of a file, stored under its path in the backup directory """
+        return self._offsite.open_writer(Path(path).relative_to(self._backup_dir).as_posix())
+
+#######################################
+# Export checkpoints management
+#######################################
+
+    def _get_export_path(self, image_name: str, snapshot_name: str, export_dir: str,
+                         diff: bool = False) -> str:
+        """ Path of an exported file, without the compression or manifest suffix """
+        prefix = "diff_" if diff else ""
+        return f"{export_dir}/{prefix}{image_name}_{snapshot_name}.img"
+
+    def _find_checkpoint(self, image_name: str, backup_type: str, export_dir: str,
+                         from_snapshot_name: str = None) -> dict:
+        """
+        Returns the newest checkpoint of an interrupted export of an image
+        that can be resumed, None when there is none
+        """
+
+        if self._export_mode != "librbd":
+            return None
+        prefix = f"diff_{image_name}_" if backup_type == DIFF else f"{image_name}_"
+        for checkpoint in ExportCheckpoint.find(export_dir, prefix):
+            data = checkpoint.load()
+            if data["image"] == image_name and data["type"] == backup_type and \
+                    data["from_snapshot"] == from_snapshot_name:
+                return data
+        return None
+
+    @staticmethod
+    def _resume_point(checkpoint: dict) -> tuple:
+        """ Returns the (offset, stats) where an export is resumed """
+        if checkpoint is None:
+            return None, None
+        stats = ExportStats()
+        for counter, value in checkpoint["stats"].items():
+            setattr(stats, counter, value)
+        return checkpoint["offset"], stats
+
+    def _checkpoint_writer(self, export_checkpoint: ExportCheckpoint, sink, image_name: str,
+                           backup_type: str, snapshot_name: str, from_snapshot_name: str = None):
+        """ Returns the callback that saves the checkpoints of an export """
+
+        def save(offset: int, stats: ExportStats):
+            with tracing.span("fsync", image=image_name, offset=offset, bytes_written=sink.bytes_written):
+                state = sink.checkpoint()
+            export_checkpoint.save({
+                "image": image_name,
+                "type": backup_type,
+                "snapshot": snapshot_name,
+                "from_snapshot": from_snapshot_name,
+                "offset": offset,
+                "stats": {"allocated_bytes": stats.allocated_bytes, "bytes_read": stats.bytes_read},
+                "sink": state
+            })
+            logger.info(f"Checkpoint of {self._get_full_snapshot_name(image_name, snapshot_name)} "
+                        f"saved at offset {offset}")
+        return save
+
+    def _collect_garbage(self, image_name: str) -> set:
+        """
+        Removes the checkpoints that can no longer be resumed (their snapshot
+        was deleted), the partial files without a checkpoint and the export
+        snapshots left behind by interrupted runs. The reference snapshot of
+        the next diff is kept, and so are the snapshots not created by the
+        backups of this directory, which may belong to another config
+
+        Parameters
+        ----------
+        image_name : str
+            name of the image
+
+        Returns
+        -------
+        set
+            names of the remaining snapshots of the image
+        """
+
+        snapshots = {snap["name"] for snap in self._get_image_snapshots(image_name)}
+        referenced = set()
+        reference = self._catalog.get_reference(self._pool, image_name)
+        if reference is not None:
+            if self._reference_mode == "rotate":
+                referenced.add(reference)
+            else:
+                # Left by a previous run in rotate mode, no longer needed
+                self._catalog.remove_reference(self._pool, image_name)
+        for export_dir, prefix in ((self._get_image_backup_dir(image_name), f"{image_name}_"),
+                                   (self._get_image_diff_backup_dir(image_name), f"diff_{image_name}_")):
+            kept = []
+            for checkpoint in ExportCheckpoint.find(export_dir, prefix):
+                data = checkpoint.load()
+                if self._export_mode == "librbd" and data["snapshot"] in snapshots and \
+                        (data["from_snapshot"] is None or data["from_snapshot"] in snapshots):
+                    kept.append(checkpoint)
+                    referenced.add(data["snapshot"])
+                else:
+                    logger.info(f"Removing the orphaned checkpoint {checkpoint.path}")
+                    checkpoint.remove()
+            remove_stray_partials(export_dir, prefix, kept)
+
+        created = self._catalog.list_snapshots(self._pool, image_name)
+        for snapshot_name in sorted(snapshots - referenced):
+            if not SNAPSHOT_NAME_PATTERN.match(snapshot_name):
+                continue
+            full_snapshot_name = self._get_full_snapshot_name(image_name, snapshot_name)
+            if snapshot_name not in created:
+                logger.warning(f"Snapshot {full_snapshot_name} was not created by the backups of "
+                               f"{self._backup_dir}, it is kept")
+                continue
+            logger.warning(f"Removing the orphaned snapshot {full_snapshot_name}")
+            self._discard_snapshot(image_name, snapshot_name)
+            snapshots.discard(snapshot_name)
+        return snapshots
+
+    def _get_reference_snapshot(self, image_name: str, snapshots: set) -> str:
+        """
+        Returns the snapshot the next diff of an image is taken from, None
+        when there is none and the full image has to be exported
+
+        The reference is recorded in the catalog. An image backed up in dummy
+        mode continues from its dummy snapshot, which is removed after the
+        first diff in rotate mode
+
+        Parameters
+        ----------
+        image_name : str
+            name of the image
+        snapshots : set
+            names of the snapshots of the image
+        """
+
+        reference = self._catalog.get_reference(self._pool, image_name)
+        if reference is None:
+            return self._dummy_snap_name if self._dummy_snap_name in snapshots else None
+        if reference not in snapshots:
+            logger.warning(f"The reference snapshot {self._get_full_snapshot_name(image_name, reference)} "
+                           "no longer exists")
+            return None
+        return reference
 
     def get_pool_stats(self):
         """
@@ -479,8 +1365,7 @@ class Ceph():
 
         """
 
-        image = rbd.Image(self._ioctx, image_name)
-        return image.list_snaps()
+        return self._sessions.get(image_name).snapshots
 
 #######################################
 # Dummy snapshot management
@@ -535,7 +1420,7 @@ class Ceph():
         except:
             raise
     
-    def _check_dummy_snap(self, image_name: str) -> bool:
+    def _check_dummy_snap(self, image_name: str, snapshots: set = None) -> bool:
         """
         Checks whether the image has a dummy snapshot or not
 
@@ -545,6 +1430,8 @@ class Ceph():
         ----------
         image_name : str
             name of the image to check
+        snapshots : set
+            names of the snapshots of the image, when they are already known
 
         Returns
         -------
@@ -554,10 +1441,10 @@ class Ceph():
 
         """
 
-        snap_list = self._get_image_snapshots(image_name)
-        snap_names = [snap["name"] for snap in snap_list]
+        if snapshots is None:
+            snapshots = {snap["name"] for snap in self._get_image_snapshots(image_name)}
 
-        if self._dummy_snap_name in snap_names:
+        if self._dummy_snap_name in snapshots:
             return True
         return False            
 
@@ -567,7 +1454,50 @@ class Ceph():
         """
 
         logger.info("\nClosing the connection.")
+        self._sessions.close()
+        if self._chunk_store is not None and self._owns_chunk_store:
+            self._chunk_store.close()
+        if self._owns_catalog:
+            self._catalog.close()
         self._ioctx.close()
+        if self._owns_handler:
+            self._handler.shutdown()
+
+    @property
+    def name(self) -> str:
+        """ Name of the target, the pool by default """
+        return self._name or self._pool
+
+    @property
+    def images(self) -> list:
+        return list(self._images)
+
+    @property
+    def handler(self):
+        """ Connection to the cluster """
+        return self._handler
+
+    def pool_stats(self) -> dict:
+        return self._ioctx.get_stats()
+
+    @staticmethod
+    def _is_glob(pattern: str) -> bool:
+        return any(char in pattern for char in "*?[")
+
+    @staticmethod
+    def _select_images(patterns: list, pool_images: list) -> list:
+        """
+        Returns the images selected by a list of names and globs, in the
+        order of the pool. The plain names are kept even when they are not
+        in the pool, so they are reported as missing
+        """
+
+        selected = [image for image in pool_images
+                    if any(fnmatch.fnmatchcase(image, pattern) for pattern in patterns)]
+        for pattern in patterns:
+            if not Ceph._is_glob(pattern) and pattern not in selected:
+                selected.append(pattern)
+        return selected
 
     @staticmethod
     def _get_current_timestamp() -> str:
@@ -0,0 +1,102 @@
+"""
+Checkpoints of the exports in progress
+
+While an image is exported, a checkpoint is saved periodically next to the
+partial file with the snapshot being read and the offset of the image up to
+which the file is complete:
+
+    <export path>.checkpoint    {"image": ..., "type": "full" | "diff",
+                                 "snapshot": ..., "from_snapshot": ...,
+                                 "offset": ..., "stats": {...},
+                                 "sink": {...}}
+
+When an export fails its snapshot is kept, so the next run resumes the
+export from the offset of the checkpoint against the same snapshot.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import re
+import json
+from pathlib import Path
+
+from ..storage.files import PARTIAL_SUFFIX
+
+CHECKPOINT_SUFFIX = ".checkpoint"
+
+# Snapshots created by the exports are named after the backup timestamp
+SNAPSHOT_NAME_PATTERN = re.compile(r"^\d{8}-\d+$")
+
+
+class ExportCheckpoint():
+    """
+    Checkpoint file of an export
+    """
+
+    def __init__(self, export_path: str):
+        """
+        Parameters
+        ----------
+        export_path : str
+            path of the exported file, without the suffix of the compressed
+            files or chunk manifests
+        """
+
+        self.export_path = Path(export_path)
+        self.path = Path(f"{export_path}{CHECKPOINT_SUFFIX}")
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def load(self) -> dict:
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self, data: dict):
+        """ Replaces the checkpoint atomically """
+        partial = Path(f"{self.path}{PARTIAL_SUFFIX}")
+        with open(partial, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, self.path)
+
+    def remove(self, partials: bool = True):
+        """ Removes the checkpoint and, unless `partials` is False, the partial files of the export """
+        if partials:
+            for path in self.export_path.parent.glob(f"{self.export_path.name}*{PARTIAL_SUFFIX}"):
+                path.unlink()
+        if self.path.exists():
+            self.path.unlink()
+
+    @staticmethod
+    def find(export_dir: str, prefix: str) -> list:
+        """
+        Returns the checkpoints of a directory whose exported file name
+        starts with `prefix`, the newest first
+        """
+
+        export_dir = Path(export_dir)
+        if not export_dir.is_dir():
+            return []
+        paths = sorted(export_dir.glob(f"{prefix}*{CHECKPOINT_SUFFIX}"), reverse=True)
+        return [ExportCheckpoint(str(path)[:-len(CHECKPOINT_SUFFIX)]) for path in paths]
+
+
+def remove_stray_partials(export_dir: str, prefix: str, keep: list = ()):
+    """
+    Removes the partial files of a directory left by exports that never
+    saved a checkpoint, except the ones of the `keep` checkpoints
+    """
+
+    export_dir = Path(export_dir)
+    if not export_dir.is_dir():
+        return
+    kept = [checkpoint.export_path.name for checkpoint in keep]
+    for path in export_dir.glob(f"{prefix}*{PARTIAL_SUFFIX}"):
+        if path.name.endswith(f"{CHECKPOINT_SUFFIX}{PARTIAL_SUFFIX}") or \
+                not any(path.name.startswith(name) for name in kept):
+            logger.info(f"Removing the partial file {path}")
+            path.unlink()
@@ -0,0 +1,375 @@
+"""
+Compaction of diff chains
+
+Consecutive `rbd export-diff` files of an image are merged into a single
+equivalent diff. Only the extents of the diffs are kept in memory: every
+write is recorded as the location of its data in the diff it comes from, in
+an interval map where the later extents supersede the earlier ones. The data
+is then copied from the source files into the merged diff, which replaces the
+range of diffs in the catalog.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import time
+import bisect
+from pathlib import Path
+
+from . import rbd_diff
+from .export import ExportStats, DEFAULT_READ_SIZE
+from ..scheduler import Scheduler
+from ..storage.catalog import Catalog, DIFF
+from ..storage.chunkstore import ChunkStore, DEFAULT_CHUNK_SIZE
+from ..storage.readers import open_backup, IteratorStream
+from ..storage.sinks import open_sink
+from ..checksum import read_checksum, sidecar_path
+from ..storage.files import sync_directory
+
+COMPACT_DIR_NAME = ".compact"
+
+
+def compact_images(backup_dir: str, pool: str, images: list, at: str = None,
+                   compression_config: dict = None, dedup_config: dict = None,
+                   checksum_config: dict = None, workers: int = 1, threads: int = 2) -> list:
+    """
+    Compacts the diff chains of several images at the same time
+
+    Parameters
+    ----------
+    backup_dir : str
+        root of the backup directory
+    pool : str
+        pool of the backed up images
+    images : list
+        names of the images ('*' for every image of the pool in the catalog)
+    at : str
+        point in time (backup timestamp). The diffs of the chain that
+        rebuilds the images at that time are compacted, the latest chain
+        when it is None
+    compression_config : dict
+        compression section of the backup config, used for the new files
+    dedup_config : dict
+        dedup section of the backup config
+    checksum_config : dict
+        checksum section of the backup config
+    workers : int
+        number of images compacted at the same time
+
+    Returns
+    -------
+    list
+        list of JobResult, one per image
+    """
+
+    compression_config = compression_config or {}
+    dedup_config = dedup_config or {}
+    chunk_store_dir = Path(dedup_config.get("directory") or Path(backup_dir).joinpath(".chunks"))
+
+    catalog = Catalog(backup_dir)
+    chunk_store = None
+    if dedup_config.get("enabled", False) or chunk_store_dir.exists():
+        chunk_store = ChunkStore(chunk_store_dir, compression_config.get("codec", "none"),
+                                 int(compression_config.get("level", 3)))
+    try:
+        compactor = Compactor(
+            catalog, chunk_store, compression_config,
+            dedup_config.get("enabled", False),
+            int(dedup_config.get("chunk_size", DEFAULT_CHUNK_SIZE)), checksum_config, threads)
+        return compactor.compact_images(pool, images, at, workers)
+    finally:
+        if chunk_store is not None:
+            chunk_store.close()
+        catalog.close()
+
+
+class ExtentMap():
+    """
+    Non overlapping extents of an image, sorted by offset
+
+    Every extent is (start, end, source, position): the data of a write
+    comes from the diff number `source` at `position` of its stream, and a
+    zeroed extent has None as source. Adding an extent trims or removes the
+    extents it overlaps, so the memory used depends on the number of extents
+    and not on the size of the data.
+    """
+
+    def __init__(self):
+        self._starts = []
+        self._extents = []
+
+    def __len__(self):
+        return len(self._extents)
+
+    def __iter__(self):
+        return iter(self._extents)
+
+    def add(self, start: int, length: int, source: int = None, position: int = 0):
+        """ Records an extent that supersedes whatever was stored in its range """
+        if length <= 0:
+            return
+        end = start + length
+        first = bisect.bisect_right(self._starts, start) - 1
+        if first < 0 or self._extents[first][1] <= start:
+            first += 1
+        last = bisect.bisect_left(self._starts, end)
+
+        pieces = []
+        if first < last:
+            old_start, old_end, old_source, old_position = self._extents[first]
+            if old_start < start:
+                pieces.append((old_start, start, old_source, old_position))
+        pieces.append((start, end, source, position))
+        if first < last:
+            old_start, old_end, old_source, old_position = self._extents[last - 1]
+            if old_end > end:
+                if old_source is not None:
+                    old_position += end - old_start
+                pieces.append((end, old_end, old_source, old_position))
+
+        self._extents[first:last] = pieces
+        self._starts[first:last] = [piece[0] for piece in pieces]
+
+    def truncate(self, size: int):
+        """ Drops the extents beyond the end of a shrunk image """
+        index = bisect.bisect_left(self._starts, size)
+        del self._extents[index:]
+        del self._starts[index:]
+        if self._extents and self._extents[-1][1] > size:
+            start, end, source, position = self._extents[-1]
+            self._extents[-1] = (start, size, source, position)
+
+
+class Compactor():
+    """
+    Merges the diffs of a chain into a single diff
+    """
+
+    def __init__(self, catalog, chunk_store=None, compression_config: dict = None,
+                 dedup: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 checksum_config: dict = None, threads: int = 2,
+                 read_size: int = DEFAULT_READ_SIZE):
+        """
+        Parameters
+        ----------
+        catalog : Catalog
+            catalog of the backup directory
+        chunk_store : ChunkStore
+            chunk store, needed to read and write deduplicated backups
+        compression_config : dict
+            compression section of the backup config, used for the new files
+        dedup : bool
+            store the new files in the chunk store
+        chunk_size : int
+            average size in bytes of the chunks
+        checksum_config : dict
+            checksum section of the backup config
+        threads : int
+            number of frames of a compressed file decompressed at the same time
+        read_size : int
+            maximum number of bytes copied at once from a source diff
+        """
+
+        self._catalog = catalog
+        self._chunk_store = chunk_store
+        self._compression_config = compression_config or {}
+        self._dedup = dedup
+        self._chunk_size = chunk_size
+        self._checksum_config = checksum_config or {}
+        self._threads = threads
+        self._read_size = read_size
+
+    def compact_images(self, pool: str, images: list, at: str = None, workers: int = 1) -> list:
+        """
+        Compacts the diff chains of several images at the same time
+
+        Returns
+        -------
+        list
+            list of JobResult, one per image
+        """
+
+        if len(images) == 1 and images[0] == '*':
+            images = [image for image_pool, image in self._catalog.list_images() if image_pool == pool]
+
+        scheduler = Scheduler(workers)
+        for image in images:
+            scheduler.submit(image, self.compact, pool, image, at)
+        return scheduler.run()
+
+    def compact(self, pool: str, image: str, at: str = None) -> ExportStats:
+        """
+        Merges the diffs of the chain of an image into a single diff
+
+        Parameters
+        ----------
+        pool : str
+            pool of the backed up image
+        image : str
+            name of the backed up image
+        at : str
+            point in time (backup timestamp) of the chain. None compacts
+            the latest chain
+
+        Returns
+        -------
+        ExportStats
+            counters of the merged diff, None when there was nothing to merge
+        """
+
+        chain = self._catalog.get_chain(pool, image, at)
+        if not chain:
+            raise LookupError(f"There is no backup of {pool}/{image} at {at or 'any time'}")
+        diffs = chain[1:]
+        if len(diffs) < 2:
+            logger.info(f"COMPACT - {pool}/{image} - there are less than two diffs to merge")
+            return None
+
+        logger.info(f"COMPACT - START - {pool}/{image} - {len(diffs)} diffs from "
+                    f"{diffs[0]['timestamp']} to {diffs[-1]['timestamp']}")
+        stats = ExportStats()
+        stats.started_at = time.time()
+        start = time.monotonic()
+
+        last_path = self._catalog.absolute_path(diffs[-1])
+        diffs_dir = last_path.parent
+        work_dir = diffs_dir.joinpath(COMPACT_DIR_NAME)
+        work_dir.mkdir(exist_ok=True)
+        name = f"diff_{image}_{diffs[-1]['timestamp']}.img"
+
+        readers = [open_backup(self._catalog.absolute_path(diff), self._chunk_store, self._threads)
+                   for diff in diffs]
+        try:
+            extents, header = self._merge_extents(readers)
+            sink = open_sink(str(work_dir.joinpath(name)), self._compression_config,
+                             self._chunk_store if self._dedup else None, self._chunk_size,
+                             self._checksum_config)
+            try:
+                self._write_diff(sink, readers, extents, header, stats)
+                sink.close()
+            except:
+                sink.abort()
+                raise
+            stats.bytes_written = sink.bytes_written
+        finally:
+            for reader in readers:
+                reader.close()
+
+        # The merged diff takes the place of the last one before the catalog
+        # is updated: if the process stops in between, applying the old diffs
+        # before the merged one still gives the same image. The old sidecar
+        # is removed first, so the file is never paired with the sidecar of
+        # the other one, only left without checksum
+        path = diffs_dir.joinpath(Path(sink.path).name)
+        if sidecar_path(path).exists():
+            sidecar_path(path).unlink()
+            sync_directory(str(diffs_dir))
+        os.replace(sink.path, path)
+        if sidecar_path(sink.path).exists():
+            os.replace(sidecar_path(sink.path), sidecar_path(path))
+        sync_directory(str(diffs_dir))
+        stats.path = str(path)
+        stats.elapsed = time.monotonic() - start
+        self._catalog.add_backup(
+            pool, image, DIFF, diffs[-1]["timestamp"], path, parent_id=chain[0]["id"],
+            snapshot=diffs[-1]["snapshot"], from_snapshot=diffs[0]["from_snapshot"],
+            logical_bytes=stats.logical_bytes, allocated_bytes=stats.allocated_bytes,
+            bytes_written=stats.bytes_written, started_at=stats.started_at,
+            duration=stats.elapsed, checksum=read_checksum(path), replaces=[diff["id"] for diff in diffs])
+
+        for diff in diffs:
+            old_path = self._catalog.absolute_path(diff)
+            if old_path == path:
+                continue
+            for old_file in (old_path, sidecar_path(old_path)):
+                if old_file.exists():
+                    old_file.unlink()
+        try:
+            work_dir.rmdir()
+        except OSError:
+            # Another image is being compacted
+            pass
+
+        logger.info(f"COMPACT - END - {pool}/{image} - {stats}")
+        return stats
+
+    @staticmethod
+    def _merge_extents(readers: list) -> tuple:
+        """
+        Parses the diffs in order
+
+        Returns
+        -------
+        tuple
+            (ExtentMap, dict with the from snapshot, to snapshot and size of
+            the merged diff)
+        """
+
+        extents = ExtentMap()
+        header = {"from_snap": None, "to_snap": None, "size": None}
+        for source, reader in enumerate(readers):
+            for record in rbd_diff.read_extents(IteratorStream(reader.iter_chunks())):
+                tag = record[0]
+                if tag == rbd_diff.WRITE:
+                    extents.add(record[1], record[2], source, record[3])
+                elif tag == rbd_diff.ZERO:
+                    extents.add(record[1], record[2])
+                elif tag == rbd_diff.SIZE:
+                    size = record[1]
+                    if header["size"] is not None and size < header["size"]:
+                        # The data beyond the new end is lost even if the
+                        # image grows again later
+                        extents.truncate(size)
+                        extents.add(size, header["size"] - size)
+                    header["size"] = size
+                elif tag == rbd_diff.FROM_SNAP and source == 0:
+                    header["from_snap"] = record[1]
+                elif tag == rbd_diff.TO_SNAP:
+                    header["to_snap"] = record[1]
+        if header["size"] is not None:
+            extents.truncate(header["size"])
+        return extents, header
+
+    def _write_diff(self, sink, readers: list, extents: ExtentMap, header: dict, stats: ExportStats):
+        sink.write(rbd_diff.BANNER)
+        if header["from_snap"] is not None:
+            sink.write(rbd_diff.encode_from_snap(header["from_snap"]))
+        if header["to_snap"] is not None:
+            sink.write(rbd_diff.encode_to_snap(header["to_snap"]))
+        if header["size"] is not None:
+            sink.write(rbd_diff.encode_size(header["size"]))
+            stats.logical_bytes = header["size"]
+
+        for start, end, source, position in self._coalesce(extents):
+            length = end - start
+            if source is None:
+                sink.write(rbd_diff.encode_zero(start, length))
+                continue
+            sink.write(rbd_diff.encode_write(start, length))
+            stats.allocated_bytes += length
+            reader = readers[source]
+            while length > 0:
+                data = reader.read_at(position, min(length, self._read_size))
+                if not data:
+                    raise ValueError(f"Truncated rbd diff {reader.path}")
+                sink.write(data)
+                stats.bytes_read += len(data)
+                position += len(data)
+                length -= len(data)
+        sink.write(rbd_diff.END)
+
+    @staticmethod
+    def _coalesce(extents: ExtentMap):
+        """ Joins the contiguous extents read from the same place """
+        current = None
+        for extent in extents:
+            if current is not None and current[1] == extent[0] and current[2] == extent[2] and \
+                    (extent[2] is None or current[3] + current[1] - current[0] == extent[3]):
+                current = (current[0], extent[1], current[2], current[3])
+                continue
+            if current is not None:
+                yield current
+            current = extent
+        if current is not None:
+            yield current
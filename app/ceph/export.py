@@ -0,0 +1,463 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import rbd
+import os
+import time
+import threading
+from collections import deque
+from contextlib import closing
+
+from . import rbd_diff
+
+DEFAULT_READ_SIZE = 8 * 1024 * 1024
+DEFAULT_SPARSE_SIZE = 64 * 1024
+DEFAULT_CHECKPOINT_INTERVAL = 1024 * 1024 * 1024
+DEFAULT_QUEUE_DEPTH = 4
+
+
+class ExportStats():
+    """
+    Counters of a single export
+    """
+
+    def __init__(self):
+        self.logical_bytes = 0
+        self.allocated_bytes = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.path = None
+        self.started_at = None
+        self.elapsed = 0.0
+        self.throttled = 0.0
+        # Seconds spent in every phase of the backup of the image
+        self.phases = {}
+        self.snapshots = None
+        # Type chosen for the image by an auto backup
+        self.backup_type = None
+        # Counters of every stage of the export pipeline, by name
+        self.stages = {}
+        # Errors that did not fail the backup, such as a reference snapshot
+        # that could not be removed
+        self.errors = []
+
+    def add_phase(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def __str__(self):
+        text = (f"{self.allocated_bytes} of {self.logical_bytes} bytes allocated, "
+                f"{self.bytes_written} bytes written")
+        if self.throttled:
+            text += f", {self.throttled:.1f} s throttled"
+        if self.errors:
+            text += f", {len(self.errors)} errors: {'; '.join(self.errors)}"
+        return text
+
+
+class Exporter():
+    """
+    In-process export engine
+
+    Reads the snapshots through librbd using the already opened ioctx,
+    instead of spawning a `rbd` process (with its own cluster connection)
+    per image. The output is byte-compatible with `rbd export` (raw image)
+    and `rbd export-diff` (v1 format).
+
+    The extents are read in ranges aligned to the objects of the image, with
+    up to `queue_depth` aio reads in flight, so the OSDs of several objects
+    serve the same image at the same time. The ranges are written in order as
+    they complete.
+    """
+
+    def __init__(self, ioctx, read_size: int = DEFAULT_READ_SIZE, sparse: bool = True,
+                 sparse_size: int = DEFAULT_SPARSE_SIZE,
+                 checkpoint_interval: int = DEFAULT_CHECKPOINT_INTERVAL, throttle=None,
+                 concurrency=None, pool_name: str = None, queue_depth: int = DEFAULT_QUEUE_DEPTH):
+        """
+        Parameters
+        ----------
+        ioctx : rados.Ioctx
+            opened ioctx of the pool
+        read_size : int
+            size in bytes of every read request sent to the cluster
+        sparse : bool
+            only read the allocated extents of the image and leave holes
+            for the unallocated and zero-filled blocks of a full export
+        sparse_size : int
+            size in bytes of the blocks checked for zeros
+        checkpoint_interval : int
+            bytes read between two checkpoints of an export (0 disables them)
+        throttle : Throttle
+            limits of the reads, None for unlimited
+        concurrency : ConcurrencyController
+            adaptive controller of the reads in flight, None to read without
+            limit
+        pool_name : str
+            name that tells apart the images of this pool in a throttle
+            shared with other pools
+        queue_depth : int
+            reads of an image in flight at the same time (1 reads
+            synchronously, one range after the other)
+        """
+
+        self._ioctx = ioctx
+        self._read_size = int(read_size)
+        self._zero_block = bytes(self._read_size)
+        self._sparse = sparse
+        self._sparse_size = min(int(sparse_size), self._read_size)
+        self._zero_sparse_block = bytes(self._sparse_size)
+        self._checkpoint_interval = int(checkpoint_interval)
+        self._throttle = throttle if throttle is not None and throttle.enabled else None
+        self._concurrency = concurrency
+        self._throttle_prefix = f"{pool_name}/" if pool_name else ""
+        self._queue_depth = max(1, int(queue_depth))
+
+    def export(self, image_name: str, snapshot_name: str, sink, resume_offset: int = None,
+               stats: ExportStats = None, on_checkpoint=None) -> ExportStats:
+        """
+        Export a snapshot as a raw image (`rbd export` format)
+
+        In sparse mode only the allocated extents (enumerated with
+        diff_iterate from the beginning of the image) are read, and both the
+        unallocated extents and the zero-filled blocks are left as holes.
+
+        Parameters
+        ----------
+        image_name : str
+            name of the image
+        snapshot_name : str
+            name of the snapshot that will be exported
+        sink : FileSink
+            destination of the exported stream
+        resume_offset : int
+            offset of the image where an interrupted export is resumed. The
+            sink already contains the stream up to it
+        stats : ExportStats
+            counters of the interrupted export
+        on_checkpoint : callable
+            called as on_checkpoint(offset, stats) every checkpoint interval,
+            when the stream is complete up to that offset of the image
+
+        Returns
+        -------
+        ExportStats
+            counters of the export
+        """
+
+        stats = stats or ExportStats()
+        checkpoint = _Checkpointer(on_checkpoint, self._checkpoint_interval, stats)
+        image = rbd.Image(self._ioctx, image_name, snapshot=snapshot_name, read_only=True)
+        try:
+            size = image.size()
+            stats.logical_bytes = size
+            extents = self._allocated_extents(image, size) if self._sparse else [(0, size)]
+
+            position = resume_offset or 0
+            ranges = self._split_ranges(image, (extent + (True,) for extent in _clip_extents(extents, position)))
+            with closing(self._read_ranges(image, image_name, ranges, stats)) as reads:
+                for offset, length, data in reads:
+                    if offset > position:
+                        sink.skip(offset - position)
+                    stats.allocated_bytes += length
+                    stats.bytes_read += length
+                    if self._sparse:
+                        self._write_sparse(data, sink)
+                    else:
+                        sink.write(data)
+                    position = offset + length
+                    checkpoint.step(position, length)
+            if position < size:
+                sink.skip(size - position)
+            stats.bytes_written = sink.bytes_written
+            return stats
+        finally:
+            image.close()
+
+    def export_diff(self, image_name: str, snapshot_name: str, from_snapshot_name: str, sink,
+                    resume_offset: int = None, stats: ExportStats = None,
+                    on_checkpoint=None) -> ExportStats:
+        """
+        Export the differences between two snapshots (`rbd export-diff` v1 format)
+
+        Parameters
+        ----------
+        image_name : str
+            name of the image
+        snapshot_name : str
+            name of the snapshot that will be exported
+        from_snapshot_name : str
+            name of the snapshot from which differences are calculated. None
+            exports every allocated extent of the image
+        sink : FileSink
+            destination of the exported stream
+        resume_offset : int
+            offset of the image where an interrupted export is resumed. The
+            sink already contains the records of the extents before it
+        stats : ExportStats
+            counters of the interrupted export
+        on_checkpoint : callable
+            called as on_checkpoint(offset, stats) every checkpoint interval,
+            when the records of the extents before that offset are written
+
+        Returns
+        -------
+        ExportStats
+            counters of the export
+        """
+
+        stats = stats or ExportStats()
+        checkpoint = _Checkpointer(on_checkpoint, self._checkpoint_interval, stats)
+        image = rbd.Image(self._ioctx, image_name, snapshot=snapshot_name, read_only=True)
+        try:
+            size = image.size()
+            stats.logical_bytes = size
+            extents = []
+            image.diff_iterate(0, size, from_snapshot_name,
+                               lambda offset, length, exists: extents.append((offset, length, exists)))
+
+            if resume_offset is None:
+                sink.write(rbd_diff.BANNER)
+                if from_snapshot_name:
+                    sink.write(rbd_diff.encode_from_snap(from_snapshot_name))
+                sink.write(rbd_diff.encode_to_snap(snapshot_name))
+                sink.write(rbd_diff.encode_size(size))
+
+            ranges = self._split_ranges(image, _clip_extents(extents, resume_offset or 0))
+            with closing(self._read_ranges(image, image_name, ranges, stats)) as reads:
+                for offset, length, data in reads:
+                    if data is None:
+                        sink.write(rbd_diff.encode_zero(offset, length))
+                        continue
+                    stats.allocated_bytes += length
+                    stats.bytes_read += length
+                    if self._is_zero(data):
+                        sink.write(rbd_diff.encode_zero(offset, length))
+                    else:
+                        sink.write(rbd_diff.encode_write(offset, length))
+                        sink.write(data)
+                    checkpoint.step(offset + length, length)
+            sink.write(rbd_diff.END)
+            stats.bytes_written = sink.bytes_written
+            return stats
+        finally:
+            image.close()
+
+    def _split_ranges(self, image, extents):
+        """
+        Yields the extents (offset, length, read) split in ranges of up to
+        read_size bytes. A read_size smaller than the objects of the image
+        splits every object from its start, so the ranges never cross an
+        object boundary, the last one of an object being shorter when
+        read_size does not divide the object size. A larger read_size is
+        rounded down to whole objects and the ranges are cut at its
+        multiples. The extents that are not read are yielded whole
+        """
+
+        object_size = image.stat()["obj_size"]
+        step = self._read_size if self._read_size <= object_size else \
+            self._read_size // object_size * object_size
+        for offset, length, read in extents:
+            end = offset + length
+            if not read:
+                yield offset, length, False
+                continue
+            while offset < end:
+                if step < object_size:
+                    object_start = offset - offset % object_size
+                    range_end = min(object_start + object_size,
+                                    offset - (offset - object_start) % step + step)
+                else:
+                    range_end = (offset // step + 1) * step
+                range_end = min(end, range_end)
+                yield offset, range_end - offset, True
+                offset = range_end
+
+    def _read_ranges(self, image, image_name: str, ranges, stats: ExportStats):
+        """
+        Reads the ranges (offset, length, read) of an image keeping up to
+        queue_depth reads in flight, and yields them in order as
+        (offset, length, data). The ranges not read are yielded with None
+        data
+        """
+
+        if self._queue_depth == 1:
+            for offset, length, read in ranges:
+                yield offset, length, self._read(image, image_name, offset, length, stats) if read else None
+            return
+
+        pending = deque()
+        try:
+            for offset, length, read in ranges:
+                if not read:
+                    pending.append(_AioRead(offset, length, None, completed=True))
+                    continue
+                while len(pending) >= self._queue_depth:
+                    yield pending.popleft().result()
+                pending.append(self._aio_read(image, image_name, offset, length, stats))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # The buffers of the reads still in flight belong to librbd until they complete
+            for request in pending:
+                request.wait()
+
+    def _aio_read(self, image, image_name: str, offset: int, length: int, stats: ExportStats):
+        """ Starts a read of the image within the throttle and concurrency limits """
+        if self._throttle is not None:
+            stats.throttled += self._throttle.acquire(f"{self._throttle_prefix}{image_name}", length)
+        if self._concurrency is not None:
+            self._concurrency.reads.acquire()
+        request = _AioRead(offset, length, self._concurrency)
+        try:
+            image.aio_read(offset, length, request.complete)
+        except:
+            request.fail(None)
+            raise
+        return request
+
+    def _read(self, image, image_name: str, offset: int, length: int, stats: ExportStats) -> bytes:
+        """ Reads from the image within the throttle and concurrency limits """
+        if self._throttle is not None:
+            stats.throttled += self._throttle.acquire(f"{self._throttle_prefix}{image_name}", length)
+        if self._concurrency is None:
+            return image.read(offset, length)
+        with self._concurrency.reads:
+            start = time.monotonic()
+            data = image.read(offset, length)
+            self._concurrency.record_read(length, time.monotonic() - start)
+        return data
+
+    @staticmethod
+    def _allocated_extents(image, size: int) -> list:
+        """
+        Returns the allocated extents of an image as a sorted list of
+        (offset, length), merging the contiguous ones
+        """
+
+        extents = []
+
+        def add_extent(offset, length, exists):
+            if not exists:
+                return
+            if extents and extents[-1][0] + extents[-1][1] == offset:
+                extents[-1] = (extents[-1][0], extents[-1][1] + length)
+            else:
+                extents.append((offset, length))
+
+        image.diff_iterate(0, size, None, add_extent)
+        return extents
+
+    def _write_sparse(self, data: bytes, sink):
+        """
+        Writes the data blocks to the sink leaving holes for the zero-filled
+        blocks. Contiguous data blocks are written at once
+        """
+
+        view = memoryview(data)
+        length = len(data)
+        data_start = None
+        position = 0
+        while position < length:
+            block_length = min(self._sparse_size, length - position)
+            if block_length == self._sparse_size:
+                is_zero = data.startswith(self._zero_sparse_block, position)
+            else:
+                is_zero = data.startswith(bytes(block_length), position)
+
+            if is_zero:
+                if data_start is not None:
+                    sink.write(view[data_start:position])
+                    data_start = None
+                sink.skip(block_length)
+            elif data_start is None:
+                data_start = position
+            position += block_length
+        if data_start is not None:
+            sink.write(view[data_start:])
+
+    def _is_zero(self, data: bytes) -> bool:
+        if len(data) == self._read_size:
+            return data == self._zero_block
+        return data == bytes(len(data))
+
+
+def _clip_extents(extents: list, start: int):
+    """ Yields the extents (offset, length, ...) or the part of them after `start` """
+    for extent in extents:
+        offset, length = extent[0], extent[1]
+        if offset + length <= start:
+            continue
+        if offset < start:
+            extent = (start, offset + length - start) + tuple(extent[2:])
+        yield extent
+
+
+class _AioRead():
+    """
+    Read of an image in flight
+    """
+
+    def __init__(self, offset: int, length: int, concurrency, completed: bool = False):
+        self.offset = offset
+        self.length = length
+        self._concurrency = concurrency
+        self._started_at = time.monotonic()
+        self._done = threading.Event()
+        self._data = None
+        self._error = None
+        if completed:
+            self._done.set()
+
+    def complete(self, completion, data: bytes):
+        """ Callback of librbd, called from its own thread """
+        ret = completion.get_return_value()
+        if ret < 0:
+            self.fail(OSError(-ret, f"Read of {self.length} bytes at offset {self.offset} failed: "
+                                    f"{os.strerror(-ret)}"))
+            return
+        if len(data) != self.length:
+            self.fail(OSError(f"Short read of {len(data)} of {self.length} bytes at offset {self.offset}"))
+            return
+        self._data = data
+        if self._concurrency is not None:
+            self._concurrency.record_read(self.length, time.monotonic() - self._started_at)
+        self._finish()
+
+    def fail(self, error: Exception):
+        self._error = error
+        self._finish()
+
+    def wait(self):
+        self._done.wait()
+
+    def result(self) -> tuple:
+        """ Waits for the read and returns (offset, length, data) """
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self.offset, self.length, self._data
+
+    def _finish(self):
+        if self._concurrency is not None:
+            self._concurrency.reads.release()
+        self._done.set()
+
+
+class _Checkpointer():
+    """
+    Calls the checkpoint callback of an export every `interval` bytes read
+    """
+
+    def __init__(self, callback, interval: int, stats: ExportStats):
+        self._callback = callback if interval > 0 else None
+        self._interval = interval
+        self._stats = stats
+        self._pending = 0
+
+    def step(self, offset: int, length: int):
+        if self._callback is None:
+            return
+        self._pending += length
+        if self._pending >= self._interval:
+            self._callback(offset, self._stats)
+            self._pending = 0
@@ -0,0 +1,164 @@
+"""
+Encoding and parsing of the `rbd export-diff` v1 file format
+
+A v1 diff is a banner followed by a sequence of tagged records:
+
+    "rbd diff v1\n"
+    'f' le32 len, name          from snapshot (optional)
+    't' le32 len, name          to snapshot
+    's' le64 size               image size
+    'w' le64 offset, le64 len   data, followed by len bytes
+    'z' le64 offset, le64 len   zeroed extent
+    'e'                         end of the diff
+"""
+
+import struct
+
+BANNER = b"rbd diff v1\n"
+
+FROM_SNAP = b"f"
+TO_SNAP = b"t"
+SIZE = b"s"
+WRITE = b"w"
+ZERO = b"z"
+END = b"e"
+
+
+def encode_from_snap(snapshot_name: str) -> bytes:
+    name = snapshot_name.encode("utf-8")
+    return FROM_SNAP + struct.pack("<I", len(name)) + name
+
+
+def encode_to_snap(snapshot_name: str) -> bytes:
+    name = snapshot_name.encode("utf-8")
+    return TO_SNAP + struct.pack("<I", len(name)) + name
+
+
+def encode_size(size: int) -> bytes:
+    return SIZE + struct.pack("<Q", size)
+
+
+def encode_write(offset: int, length: int) -> bytes:
+    """ Header of a data record. It must be followed by `length` bytes """
+    return WRITE + struct.pack("<QQ", offset, length)
+
+
+def encode_zero(offset: int, length: int) -> bytes:
+    return ZERO + struct.pack("<QQ", offset, length)
+
+
+def read_records(stream, max_data_size: int = 8 * 1024 * 1024):
+    """
+    Parses a v1 diff
+
+    Parameters
+    ----------
+    stream : file-like
+        object with a read(n) method positioned at the beginning of the diff
+    max_data_size : int
+        data records bigger than this are yielded in several pieces
+
+    Yields
+    ------
+    tuple
+        (FROM_SNAP, name), (TO_SNAP, name), (SIZE, size),
+        (WRITE, offset, data), (ZERO, offset, length) and (END,)
+
+    Raises
+    ------
+    ValueError
+        when the stream is not a valid v1 diff
+    """
+
+    if _read_exactly(stream, len(BANNER)) != BANNER:
+        raise ValueError("Not a rbd diff v1 stream")
+
+    while True:
+        tag = _read_exactly(stream, 1)
+        if tag in (FROM_SNAP, TO_SNAP):
+            length = struct.unpack("<I", _read_exactly(stream, 4))[0]
+            yield tag, _read_exactly(stream, length).decode("utf-8")
+        elif tag == SIZE:
+            yield tag, struct.unpack("<Q", _read_exactly(stream, 8))[0]
+        elif tag == WRITE:
+            offset, length = struct.unpack("<QQ", _read_exactly(stream, 16))
+            while length > 0:
+                n = min(length, max_data_size)
+                yield tag, offset, _read_exactly(stream, n)
+                offset += n
+                length -= n
+        elif tag == ZERO:
+            offset, length = struct.unpack("<QQ", _read_exactly(stream, 16))
+            yield tag, offset, length
+        elif tag == END:
+            yield (tag,)
+            return
+        else:
+            raise ValueError(f"Unknown rbd diff record {tag!r}")
+
+
+def read_extents(stream, skip_size: int = 8 * 1024 * 1024):
+    """
+    Parses a v1 diff without keeping the data of the write records
+
+    Parameters
+    ----------
+    stream : file-like
+        object with a read(n) method positioned at the beginning of the diff
+    skip_size : int
+        maximum number of data bytes read at once while skipping a record
+
+    Yields
+    ------
+    tuple
+        the same records as read_records, except the writes, that are
+        yielded as (WRITE, offset, length, position) where position is the
+        offset of their data in the stream
+
+    Raises
+    ------
+    ValueError
+        when the stream is not a valid v1 diff
+    """
+
+    if _read_exactly(stream, len(BANNER)) != BANNER:
+        raise ValueError("Not a rbd diff v1 stream")
+    position = len(BANNER)
+
+    while True:
+        tag = _read_exactly(stream, 1)
+        position += 1
+        if tag in (FROM_SNAP, TO_SNAP):
+            length = struct.unpack("<I", _read_exactly(stream, 4))[0]
+            yield tag, _read_exactly(stream, length).decode("utf-8")
+            position += 4 + length
+        elif tag == SIZE:
+            yield tag, struct.unpack("<Q", _read_exactly(stream, 8))[0]
+            position += 8
+        elif tag == WRITE:
+            offset, length = struct.unpack("<QQ", _read_exactly(stream, 16))
+            position += 16
+            yield tag, offset, length, position
+            remaining = length
+            while remaining > 0:
+                remaining -= len(_read_exactly(stream, min(remaining, skip_size)))
+            position += length
+        elif tag == ZERO:
+            offset, length = struct.unpack("<QQ", _read_exactly(stream, 16))
+            yield tag, offset, length
+            position += 16
+        elif tag == END:
+            yield (tag,)
+            return
+        else:
+            raise ValueError(f"Unknown rbd diff record {tag!r}")
+
+
+def _read_exactly(stream, length: int) -> bytes:
+    data = stream.read(length)
+    while len(data) < length:
+        more = stream.read(length - len(data))
+        if not more:
+            raise ValueError("Truncated rbd diff stream")
+        data += more
+    return data
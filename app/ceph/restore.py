@@ -0,0 +1,456 @@
+"""
+Restore of an image from its base export and its chain of diffs
+
+The chain is resolved through the catalog. A reader thread parses the next
+files of the chain while the current one is being applied, passing the
+operations through a bounded queue, and several images can be restored at
+the same time.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import rbd
+
+import os
+import time
+import queue
+import datetime
+import threading
+from pathlib import Path
+
+from . import rbd_diff
+from .checkpoint import SNAPSHOT_NAME_PATTERN
+from ..scheduler import Scheduler
+from ..storage.catalog import Catalog, DIFF
+from ..storage.chunkstore import ChunkStore
+from ..storage.readers import open_backup, iter_data, IteratorStream
+from ..storage.files import commit_file, PARTIAL_SUFFIX
+
+DEFAULT_QUEUE_SIZE = 8
+ZERO_WRITE_SIZE = 4 * 1024 * 1024
+
+# Operations passed from the reader to the writer
+OP_SIZE = "size"
+OP_WRITE = "write"
+OP_ZERO = "zero"
+
+
+def parse_point_in_time(value: str) -> str:
+    """
+    Converts a point in time to the format of the backup timestamps
+
+    Parameters
+    ----------
+    value : str
+        a backup timestamp (YYYYMMDD-<unix time>), a unix time, a date
+        (YYYYMMDD or YYYY-MM-DD, the end of that day) or a date and time
+        (YYYY-MM-DD HH:MM[:SS])
+
+    Returns
+    -------
+    str
+        timestamp comparable with the backup timestamps
+    """
+
+    value = value.strip()
+    if "-" in value and value.split("-")[0].isdigit() and len(value.split("-")[0]) == 8:
+        return value
+    if value.isdigit() and len(value) != 8:
+        t = int(value)
+    else:
+        for fmt, end_of_day in (("%Y%m%d", True), ("%Y-%m-%d", True),
+                                ("%Y-%m-%d %H:%M", False), ("%Y-%m-%d %H:%M:%S", False)):
+            try:
+                d = datetime.datetime.strptime(value, fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError(f"Wrong point in time \"{value}\"")
+        if end_of_day:
+            d = d.replace(hour=23, minute=59, second=59)
+        t = int(d.timestamp())
+    d = datetime.datetime.fromtimestamp(t).strftime("%Y%m%d")
+    return f"{d}-{t}"
+
+
+def restore_images(backup_dir: str, pool: str, images: list, at: str = None,
+                   target_dir: str = None, ioctx=None, chunk_store_dir: str = None,
+                   workers: int = 1, threads: int = 2,
+                   queue_size: int = DEFAULT_QUEUE_SIZE) -> list:
+    """
+    Restores several images of a backup directory at the same time
+
+    Parameters
+    ----------
+    backup_dir : str
+        root of the backup directory
+    pool : str
+        pool of the backed up images
+    images : list
+        names of the images ('*' for every image of the pool in the catalog)
+    at : str
+        point in time (backup timestamp). None restores the latest backup
+    target_dir : str
+        directory where the images are restored as <image>.img. When it is
+        None they are restored as rbd images in the pool of the ioctx
+    ioctx : rados.Ioctx
+        ioctx of the pool where the images are restored
+    chunk_store_dir : str
+        directory of the chunk store of the deduplicated backups
+    workers : int
+        number of images restored at the same time
+
+    Returns
+    -------
+    list
+        list of JobResult, one per image
+    """
+
+    catalog = Catalog(backup_dir)
+    chunk_store = None
+    if chunk_store_dir and Path(chunk_store_dir).exists():
+        chunk_store = ChunkStore(chunk_store_dir)
+    try:
+        restorer = Restorer(catalog, chunk_store, ioctx, threads, queue_size)
+        return restorer.restore_images(pool, images, at, target_dir, workers)
+    finally:
+        if chunk_store is not None:
+            chunk_store.close()
+        catalog.close()
+
+
+def check_chain(chain: list):
+    """
+    Checks that every diff of a chain starts at the latest at the snapshot
+    of the backup before it. A diff holds every block changed since its
+    snapshot, so it can be applied over a later state, but a diff from a
+    later snapshot would miss the changes in between. The backups imported
+    without their snapshots and the diffs of the dummy snapshot, recreated
+    after every run, are not checked
+
+    Raises
+    ------
+    ValueError
+        when there is a gap between a diff and the backup before it
+    """
+
+    for previous, backup in zip(chain, chain[1:]):
+        if backup["type"] != DIFF:
+            continue
+        from_time = _snapshot_time(backup["from_snapshot"])
+        previous_time = _snapshot_time(previous["snapshot"])
+        if from_time is None or previous_time is None:
+            continue
+        if from_time > previous_time:
+            raise ValueError(f"The diff {backup['path']} starts at the snapshot {backup['from_snapshot']}, "
+                             f"after the snapshot {previous['snapshot']} of {previous['path']}")
+
+
+def _snapshot_time(snapshot: str) -> int:
+    """ Unix time of a snapshot named after a backup timestamp, None otherwise """
+    if snapshot is None or not SNAPSHOT_NAME_PATTERN.match(snapshot):
+        return None
+    return int(snapshot.split("-")[1])
+
+
+class RestoreStats():
+    """
+    Counters of a single restore
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.size = 0
+        self.bytes_written = 0
+        self.elapsed = 0.0
+
+    def __str__(self):
+        return f"{self.files} files applied, {self.bytes_written} bytes written in {self.elapsed:.1f} s"
+
+
+class FileTarget():
+    """
+    Restores an image into a local raw file
+
+    The image is written into <path>.part and renamed to <path> once it is
+    complete, so a failed restore never leaves a file that looks like an
+    image. A partial file left by an interrupted restore is overwritten.
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self.partial_path = f"{self.path}{PARTIAL_SUFFIX}"
+        if Path(self.path).exists():
+            raise FileExistsError(f"Restore target {self.path} already exists")
+        self._file = open(self.partial_path, "wb")
+        self._zero_block = bytes(ZERO_WRITE_SIZE)
+
+    def resize(self, size: int):
+        self._file.truncate(size)
+
+    def write(self, offset: int, data):
+        os.pwrite(self._file.fileno(), data, offset)
+
+    def zero(self, offset: int, length: int):
+        while length > 0:
+            n = min(length, ZERO_WRITE_SIZE)
+            os.pwrite(self._file.fileno(), memoryview(self._zero_block)[:n], offset)
+            offset += n
+            length -= n
+
+    def commit(self):
+        """ Completes the restored file """
+        self._file.close()
+        commit_file(self.partial_path, self.path)
+
+    def abort(self):
+        """ Removes the incomplete file """
+        self._file.close()
+        try:
+            os.unlink(self.partial_path)
+        except FileNotFoundError:
+            pass
+
+
+class ImageTarget():
+    """
+    Restores an image into a new rbd image
+    """
+
+    def __init__(self, ioctx, image_name: str):
+        self.path = image_name
+        self._ioctx = ioctx
+        self._image_name = image_name
+        self._image = None
+        self._created = False
+        self._zero_block = bytes(ZERO_WRITE_SIZE)
+
+    def resize(self, size: int):
+        if self._image is None:
+            # Fails with ImageExists, an existing image is never overwritten
+            rbd.RBD().create(self._ioctx, self._image_name, size, old_format=False)
+            self._created = True
+            self._image = rbd.Image(self._ioctx, self._image_name)
+        elif self._image.size() != size:
+            self._image.resize(size)
+
+    def write(self, offset: int, data):
+        self._image.write(bytes(data), offset)
+
+    def zero(self, offset: int, length: int):
+        # A discard may skip the partial objects and leave their data, the
+        # zeros are written instead
+        if hasattr(self._image, "write_zeroes"):
+            self._image.write_zeroes(offset, length)
+            return
+        while length > 0:
+            n = min(length, ZERO_WRITE_SIZE)
+            self._image.write(self._zero_block[:n], offset)
+            offset += n
+            length -= n
+
+    def commit(self):
+        """ Completes the restored image """
+        if self._image is not None:
+            self._image.flush()
+            self._image.close()
+
+    def abort(self):
+        """ Removes the incomplete image, when the restore created it """
+        if self._image is not None:
+            self._image.close()
+        if self._created:
+            try:
+                rbd.RBD().remove(self._ioctx, self._image_name)
+            except Exception as e:
+                logger.error(f"Could not remove the incomplete image {self._image_name}: {e!r}")
+
+
+class Restorer():
+    """
+    Rebuilds images at a point in time from the backups of the catalog
+    """
+
+    def __init__(self, catalog, chunk_store=None, ioctx=None, threads: int = 2,
+                 queue_size: int = DEFAULT_QUEUE_SIZE):
+        """
+        Parameters
+        ----------
+        catalog : Catalog
+            catalog of the backup directory
+        chunk_store : ChunkStore
+            chunk store, needed for the deduplicated backups
+        ioctx : rados.Ioctx
+            ioctx of the pool where the images are restored. Only needed to
+            restore into rbd images
+        threads : int
+            number of frames of a compressed file decompressed at the same time
+        queue_size : int
+            maximum number of read operations waiting to be applied
+        """
+
+        self._catalog = catalog
+        self._chunk_store = chunk_store
+        self._ioctx = ioctx
+        self._threads = threads
+        self._queue_size = queue_size
+
+    def restore_images(self, pool: str, images: list, at: str = None, target_dir: str = None,
+                       workers: int = 1) -> list:
+        """
+        Restores several images at the same time
+
+        Parameters
+        ----------
+        pool : str
+            pool of the backed up images
+        images : list
+            names of the images ('*' for every image of the pool in the catalog)
+        at : str
+            point in time (backup timestamp). None restores the latest backup
+        target_dir : str
+            directory where the images are restored as <image>.img. When it is
+            None they are restored as rbd images in the pool of the ioctx
+        workers : int
+            number of images restored at the same time
+
+        Returns
+        -------
+        list
+            list of JobResult, one per image
+        """
+
+        if len(images) == 1 and images[0] == '*':
+            images = [image for image_pool, image in self._catalog.list_images() if image_pool == pool]
+
+        scheduler = Scheduler(workers)
+        for image in images:
+            if target_dir is not None:
+                target = Path(target_dir).joinpath(f"{image}.img")
+            else:
+                target = None
+            scheduler.submit(image, self.restore, pool, image, at, target)
+        return scheduler.run()
+
+    def restore(self, pool: str, image: str, at: str = None, target_path: str = None,
+                target_image: str = None) -> RestoreStats:
+        """
+        Restores an image at a point in time
+
+        Parameters
+        ----------
+        pool : str
+            pool of the backed up image
+        image : str
+            name of the backed up image
+        at : str
+            point in time (backup timestamp). None restores the latest backup
+        target_path : str
+            local file where the image is restored
+        target_image : str
+            rbd image where the image is restored (the backed up image name
+            by default). Only used when target_path is None
+
+        Returns
+        -------
+        RestoreStats
+            counters of the restore
+        """
+
+        chain = self._catalog.get_chain(pool, image, at)
+        if not chain:
+            raise LookupError(f"There is no backup of {pool}/{image} at {at or 'any time'}")
+        check_chain(chain)
+
+        if target_path is not None:
+            target = FileTarget(target_path)
+        elif self._ioctx is not None:
+            target = ImageTarget(self._ioctx, target_image or image)
+        else:
+            raise ValueError("A target file or a cluster connection is needed to restore")
+
+        logger.info(f"RESTORE - START - {pool}/{image} - {len(chain) - 1} diffs over "
+                    f"{chain[0]['timestamp']} into {target.path}")
+        stats = RestoreStats()
+        start = time.monotonic()
+        operations = queue.Queue(maxsize=self._queue_size)
+        reader = threading.Thread(target=self._read_chain, args=(chain, operations),
+                                  name=f"restore-{image}", daemon=True)
+        reader.start()
+        try:
+            self._apply(operations, target, stats)
+        except:
+            logger.error(f"Failed to restore {pool}/{image}")
+            self._stop_reader(reader, operations)
+            target.abort()
+            raise
+        self._stop_reader(reader, operations)
+        target.commit()
+
+        stats.files = len(chain)
+        stats.elapsed = time.monotonic() - start
+        logger.info(f"RESTORE - END - {pool}/{image} - {stats}")
+        return stats
+
+    @staticmethod
+    def _stop_reader(reader: threading.Thread, operations: queue.Queue):
+        """ Unblocks the reader if the writer failed """
+        while reader.is_alive():
+            try:
+                operations.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def _apply(self, operations: queue.Queue, target, stats: RestoreStats):
+        while True:
+            operation = operations.get()
+            if operation is None:
+                return
+            if isinstance(operation, Exception):
+                raise operation
+            kind = operation[0]
+            if kind == OP_WRITE:
+                target.write(operation[1], operation[2])
+                stats.bytes_written += len(operation[2])
+            elif kind == OP_ZERO:
+                target.zero(operation[1], operation[2])
+            elif kind == OP_SIZE:
+                target.resize(operation[1])
+                stats.size = operation[1]
+
+    def _read_chain(self, chain: list, operations: queue.Queue):
+        """
+        Reads the files of a chain in order and puts the operations to apply
+        in the queue. Ends with None, or with the exception that stopped it
+        """
+
+        try:
+            for backup in chain:
+                path = self._catalog.absolute_path(backup)
+                logger.info(f"Reading {path}")
+                reader = open_backup(path, self._chunk_store, self._threads)
+                try:
+                    if backup["type"] == DIFF:
+                        self._read_diff(reader, operations)
+                    else:
+                        operations.put((OP_SIZE, reader.size))
+                        for offset, data in iter_data(reader):
+                            operations.put((OP_WRITE, offset, data))
+                finally:
+                    reader.close()
+            operations.put(None)
+        except Exception as e:
+            operations.put(e)
+
+    @staticmethod
+    def _read_diff(reader, operations: queue.Queue):
+        for record in rbd_diff.read_records(IteratorStream(reader.iter_chunks())):
+            tag = record[0]
+            if tag == rbd_diff.WRITE:
+                operations.put((OP_WRITE, record[1], record[2]))
+            elif tag == rbd_diff.ZERO:
+                operations.put((OP_ZERO, record[1], record[2]))
+            elif tag == rbd_diff.SIZE:
+                operations.put((OP_SIZE, record[1]))
@@ -0,0 +1,161 @@
+"""
+Image sessions of a backup run
+
+Every selected image is opened once at startup and its metadata (size,
+features, snapshots, parent and flags) is fetched by a pool of threads, so
+the round-trips to the cluster of hundreds of images overlap instead of
+adding up. The images stay open for the rest of the run and the metadata is
+served from the cache. The snapshots are listed again, when needed, after a
+snapshot is created or removed through the session.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import rbd
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_PREFETCH_THREADS = 16
+
+
+class ImageSession():
+    """
+    Opened image with its cached metadata
+    """
+
+    def __init__(self, ioctx, image_name: str):
+        """
+        Parameters
+        ----------
+        ioctx : rados.Ioctx
+            opened ioctx of the pool
+        image_name : str
+            name of the image
+        """
+
+        self.name = image_name
+        self._lock = threading.RLock()
+        self._image = rbd.Image(ioctx, image_name)
+        self._snapshots = None
+        self.size = None
+        self.features = None
+        self.flags = None
+        self.parent = None
+
+    def prefetch(self):
+        """ Fetches the metadata of the image """
+        with self._lock:
+            self.size = self._image.size()
+            self.features = self._image.features()
+            self.flags = self._image.flags()
+            try:
+                self.parent = self._image.parent_info()
+            except rbd.ImageNotFound:
+                self.parent = None
+            self._list_snapshots()
+
+    @property
+    def snapshots(self) -> list:
+        """ Snapshots of the image, as returned by list_snaps """
+        with self._lock:
+            if self._snapshots is None:
+                self._list_snapshots()
+            return list(self._snapshots)
+
+    def snapshot_names(self) -> set:
+        return {snap["name"] for snap in self.snapshots}
+
+    def create_snap(self, snapshot_name: str):
+        with self._lock:
+            self._snapshots = None
+            self._image.create_snap(snapshot_name)
+
+    def remove_snap(self, snapshot_name: str):
+        with self._lock:
+            self._snapshots = None
+            self._image.remove_snap(snapshot_name)
+
+    def changed_bytes(self, from_snapshot: str) -> int:
+        """ Bytes of the extents of the image written since a snapshot """
+        changed = 0
+
+        def add_extent(offset, length, exists):
+            nonlocal changed
+            if exists:
+                changed += length
+
+        with self._lock:
+            self._image.diff_iterate(0, self._image.size(), from_snapshot, add_extent)
+        return changed
+
+    def invalidate(self):
+        """ Drops the cached snapshots, after they were changed outside the session """
+        with self._lock:
+            self._snapshots = None
+
+    def close(self):
+        with self._lock:
+            self._image.close()
+
+    def _list_snapshots(self):
+        self._snapshots = list(self._image.list_snaps())
+
+
+class ImageSessions():
+    """
+    Sessions of the images of a run, opened and prefetched concurrently
+    """
+
+    def __init__(self, ioctx, threads: int = DEFAULT_PREFETCH_THREADS):
+        self._ioctx = ioctx
+        self._threads = max(1, int(threads))
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def prefetch(self, image_names: list):
+        """ Opens the images and fetches their metadata, several at the same time """
+        image_names = [name for name in image_names if name not in self._sessions]
+        if not image_names:
+            return
+        logger.info(f"Prefetching the metadata of {len(image_names)} images...")
+        with ThreadPoolExecutor(max_workers=min(self._threads, len(image_names)),
+                                thread_name_prefix="prefetch") as executor:
+            sessions = list(executor.map(self._try_open, image_names))
+        with self._lock:
+            for session in sessions:
+                if session is not None:
+                    self._sessions[session.name] = session
+
+    def get(self, image_name: str) -> ImageSession:
+        """ Returns the session of an image, opening it when it was not prefetched """
+        with self._lock:
+            session = self._sessions.get(image_name)
+            if session is None:
+                session = self._open(image_name)
+                self._sessions[image_name] = session
+            return session
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+    def _open(self, image_name: str) -> ImageSession:
+        session = ImageSession(self._ioctx, image_name)
+        try:
+            session.prefetch()
+        except:
+            session.close()
+            raise
+        return session
+
+    def _try_open(self, image_name: str) -> ImageSession:
+        # The job of the image fails later, when it opens the image again
+        try:
+            return self._open(image_name)
+        except Exception as e:
+            logger.warning(f"Could not prefetch the metadata of {image_name}: {e!r}")
+            return None
@@ -0,0 +1,245 @@
+"""
+Offline generation of synthetic full backups
+
+A synthetic full is the base export of an image at the point in time of its
+latest diff, built only from the files of the backup directory: the base and
+its diffs are applied into a temporary raw file, which is then stored with
+the configured compression or deduplication and recorded in the catalog as a
+new base. The following diffs are applied over it, so the restore chains stay
+short without reading the images from the cluster again.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+from pathlib import Path
+
+from .export import ExportStats
+from .restore import Restorer, DEFAULT_QUEUE_SIZE
+from ..scheduler import Scheduler
+from ..storage.catalog import Catalog, FULL
+from ..storage.chunkstore import ChunkStore, DEFAULT_CHUNK_SIZE
+from ..storage.readers import RawReader
+from ..storage.sinks import open_sink
+from ..storage.files import commit_file, PARTIAL_SUFFIX
+from ..checksum import read_checksum, hash_file, write_sidecar, sidecar_path, DEFAULT_BLOCK_SIZE
+
+
+def synthesize_images(backup_dir: str, pool: str, images: list, at: str = None,
+                      compression_config: dict = None, dedup_config: dict = None,
+                      checksum_config: dict = None, workers: int = 1, threads: int = 2,
+                      queue_size: int = DEFAULT_QUEUE_SIZE) -> list:
+    """
+    Generates the synthetic full backups of several images at the same time
+
+    Parameters
+    ----------
+    backup_dir : str
+        root of the backup directory
+    pool : str
+        pool of the backed up images
+    images : list
+        names of the images ('*' for every image of the pool in the catalog)
+    at : str
+        point in time (backup timestamp). None uses the latest diff
+    compression_config : dict
+        compression section of the backup config, used for the new files
+    dedup_config : dict
+        dedup section of the backup config
+    checksum_config : dict
+        checksum section of the backup config
+    workers : int
+        number of images processed at the same time
+
+    Returns
+    -------
+    list
+        list of JobResult, one per image
+    """
+
+    compression_config = compression_config or {}
+    dedup_config = dedup_config or {}
+    chunk_store_dir = Path(dedup_config.get("directory") or Path(backup_dir).joinpath(".chunks"))
+
+    catalog = Catalog(backup_dir)
+    chunk_store = None
+    if dedup_config.get("enabled", False) or chunk_store_dir.exists():
+        chunk_store = ChunkStore(chunk_store_dir, compression_config.get("codec", "none"),
+                                 int(compression_config.get("level", 3)))
+    try:
+        synthesizer = Synthesizer(
+            catalog, chunk_store, compression_config,
+            dedup_config.get("enabled", False),
+            int(dedup_config.get("chunk_size", DEFAULT_CHUNK_SIZE)), checksum_config, threads, queue_size)
+        return synthesizer.synthesize_images(pool, images, at, workers)
+    finally:
+        if chunk_store is not None:
+            chunk_store.close()
+        catalog.close()
+
+
+class Synthesizer():
+    """
+    Builds new base backups from a base and its chain of diffs
+    """
+
+    def __init__(self, catalog, chunk_store=None, compression_config: dict = None,
+                 dedup: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 checksum_config: dict = None,
+                 threads: int = 2, queue_size: int = DEFAULT_QUEUE_SIZE):
+        """
+        Parameters
+        ----------
+        catalog : Catalog
+            catalog of the backup directory
+        chunk_store : ChunkStore
+            chunk store, needed to read and write deduplicated backups
+        compression_config : dict
+            compression section of the backup config, used for the new files
+        dedup : bool
+            store the new files in the chunk store
+        chunk_size : int
+            average size in bytes of the chunks
+        checksum_config : dict
+            checksum section of the backup config
+        threads : int
+            number of frames of a compressed file decompressed at the same time
+        queue_size : int
+            maximum number of read operations waiting to be applied
+        """
+
+        self._catalog = catalog
+        self._chunk_store = chunk_store
+        self._compression_config = compression_config or {}
+        self._dedup = dedup
+        self._chunk_size = chunk_size
+        self._checksum_config = checksum_config or {}
+        self._restorer = Restorer(catalog, chunk_store, threads=threads, queue_size=queue_size)
+
+    def synthesize_images(self, pool: str, images: list, at: str = None, workers: int = 1) -> list:
+        """
+        Generates the synthetic full backups of several images at the same time
+
+        Returns
+        -------
+        list
+            list of JobResult, one per image
+        """
+
+        if len(images) == 1 and images[0] == '*':
+            images = [image for image_pool, image in self._catalog.list_images() if image_pool == pool]
+
+        scheduler = Scheduler(workers)
+        for image in images:
+            scheduler.submit(image, self.synthesize, pool, image, at)
+        return scheduler.run()
+
+    def synthesize(self, pool: str, image: str, at: str = None) -> ExportStats:
+        """
+        Generates the synthetic full backup of an image at the point in time
+        of the last diff of its chain
+
+        Parameters
+        ----------
+        pool : str
+            pool of the backed up image
+        image : str
+            name of the backed up image
+        at : str
+            point in time (backup timestamp). None uses the latest diff
+
+        Returns
+        -------
+        ExportStats
+            counters of the new base, None when the chain has no diffs
+        """
+
+        chain = self._catalog.get_chain(pool, image, at)
+        if not chain:
+            raise LookupError(f"There is no backup of {pool}/{image} at {at or 'any time'}")
+        if len(chain) == 1:
+            logger.info(f"SYNTHETIC FULL - {pool}/{image} - the latest backup is already a full backup")
+            return None
+
+        last = chain[-1]
+        image_dir = self._catalog.absolute_path(chain[0]).parent
+        path = image_dir.joinpath(f"{image}_{last['timestamp']}.img")
+        partial_path = Path(f"{path}{PARTIAL_SUFFIX}")
+        if not path.exists() and sidecar_path(path).exists():
+            # Sidecar of a file an interrupted run did not rename
+            sidecar_path(path).unlink()
+        if any(p.name.startswith(path.name) for p in image_dir.iterdir() if p != partial_path):
+            raise FileExistsError(f"There is already a full backup of {pool}/{image} at {last['timestamp']}")
+
+        logger.info(f"SYNTHETIC FULL - START - {pool}/{image} - {len(chain) - 1} diffs over "
+                    f"{chain[0]['timestamp']}")
+        stats = ExportStats()
+        stats.started_at = time.time()
+        start = time.monotonic()
+
+        if partial_path.exists():
+            # Left by an interrupted run
+            partial_path.unlink()
+        try:
+            self._restorer.restore(pool, image, at=last["timestamp"], target_path=partial_path)
+            self._store(partial_path, path, stats)
+        finally:
+            if partial_path.exists():
+                partial_path.unlink()
+
+        stats.elapsed = time.monotonic() - start
+        # The new base points to the last diff it includes
+        self._catalog.add_backup(
+            pool, image, FULL, last["timestamp"], stats.path, parent_id=last["id"],
+            snapshot=last["snapshot"], logical_bytes=stats.logical_bytes,
+            allocated_bytes=stats.allocated_bytes, bytes_written=stats.bytes_written,
+            started_at=stats.started_at, duration=stats.elapsed, checksum=read_checksum(stats.path))
+        logger.info(f"SYNTHETIC FULL - END - {pool}/{image} - {stats}")
+        return stats
+
+    def _store(self, partial_path: Path, path: Path, stats: ExportStats):
+        """
+        Stores the rebuilt raw file in its final format. A raw file is just
+        renamed, otherwise its data extents are passed through the sink
+        """
+
+        with RawReader(partial_path) as reader:
+            stats.logical_bytes = reader.size
+            stats.allocated_bytes = sum(length for _, length in reader.iter_data_extents())
+
+            codec = self._compression_config.get("codec", "none")
+            if not self._dedup and codec == "none":
+                # The sidecar is saved before the file gets its final name
+                algorithm = self._checksum_config.get("algorithm", "none")
+                if algorithm != "none":
+                    write_sidecar(path, hash_file(partial_path, algorithm, int(
+                        self._checksum_config.get("block_size", DEFAULT_BLOCK_SIZE))))
+                try:
+                    commit_file(partial_path, path)
+                except:
+                    if algorithm != "none" and not path.exists():
+                        sidecar_path(path).unlink()
+                    raise
+                stats.path = str(path)
+                stats.bytes_written = stats.allocated_bytes
+                return
+
+            sink = open_sink(str(path), self._compression_config,
+                             self._chunk_store if self._dedup else None, self._chunk_size,
+                             self._checksum_config)
+            try:
+                position = 0
+                for offset, data in reader.iter_data_chunks():
+                    if offset > position:
+                        sink.skip(offset - position)
+                    sink.write(data)
+                    position = offset + len(data)
+                if position < reader.size:
+                    sink.skip(reader.size - position)
+                sink.close()
+            except:
+                sink.abort()
+                raise
+            stats.path = sink.path
+            stats.bytes_written = sink.bytes_written
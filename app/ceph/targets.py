@@ -0,0 +1,274 @@
+"""
+Backup of several pools and clusters in a single run
+
+The backup config can list several targets, every one with its pool, the
+images to back up (names or globs) and, optionally, its own cluster and
+backup directory:
+
+    backup:
+      targets:
+        - name: system                  # name of the target in the logs
+          pool: one-system
+          images: ["*"]
+        - name: cluster-b
+          cluster:
+            conf_file: etc/ceph/cluster-b.conf
+            user_keyring: etc/ceph/ceph.client.cluster-b.keyring
+          pool: one
+          images: ["one-*"]
+          directory: /backups/cluster-b
+
+The missing parameters are taken from the cluster and backup sections. The
+targets of the same cluster share its connection, the targets of the same
+directory share its catalog and chunk store, and the images of every target
+are scheduled together, within the same workers, throttle and adaptive
+limits.
+
+The backups of a directory are stored and cataloged by pool and image, so
+the targets with the same pool name need directories of their own.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+from util.color import Color
+
+from pathlib import Path
+
+from .ceph import Ceph
+from ..scheduler import Scheduler
+from ..throttle import Throttle
+from ..adaptive import ConcurrencyController
+from ..storage.catalog import Catalog
+from ..storage.chunkstore import ChunkStore
+from ..storage.backends import open_backend
+
+CLUSTER_KEYS = ["conf_file", "user_keyring", "client"]
+
+
+def resolve_targets(cluster_config: dict, backup_config: dict) -> list:
+    """
+    Returns the targets of a run, completed with the cluster and backup
+    sections. Without targets, the pool and images of the backup section are
+    the only target
+
+    Returns
+    -------
+    list
+        list of dict with the name (None for the single target), cluster,
+        pool, images and directory of every target
+    """
+
+    targets = backup_config.get("targets") or []
+    if not targets:
+        return [{
+            "name": None,
+            "cluster": {key: cluster_config[key] for key in CLUSTER_KEYS},
+            "pool": backup_config["pool"],
+            "images": backup_config["images"],
+            "directory": backup_config["directory"]
+        }]
+
+    resolved = []
+    for target in targets:
+        cluster = {key: cluster_config[key] for key in CLUSTER_KEYS}
+        cluster.update(target.get("cluster") or {})
+        resolved.append({
+            "name": target.get("name") or target.get("pool"),
+            "cluster": cluster,
+            "pool": target.get("pool"),
+            "images": target.get("images") or ["*"],
+            "directory": target.get("directory") or backup_config["directory"]
+        })
+    return resolved
+
+
+def check_targets(targets: list):
+    """
+    Checks the resolved targets of a run
+
+    Raises
+    ------
+    ValueError
+        when a target is not complete, its directory does not exist, two
+        targets have the same name or two targets would store a pool with
+        the same name in the same directory
+    """
+
+    names = set()
+    pools = {}
+    for target in targets:
+        if not target["pool"] or not str(target["pool"]).strip():
+            raise ValueError(f"Backup target \"{target['name']}\" has no pool")
+        if not isinstance(target["images"], list):
+            raise ValueError(f"The images of the backup target \"{target['name']}\" must be a list")
+        if not Path(target["directory"]).exists():
+            raise ValueError(f"Backup directory \"{target['directory']}\" does not exist")
+        if target["name"] in names:
+            raise ValueError(f"There are several backup targets named \"{target['name']}\"")
+        names.add(target["name"])
+        # The backups of a directory are stored by pool and image, two targets
+        # would write the same files, at the same time when their images overlap
+        key = (str(Path(target["directory"]).resolve()), target["pool"])
+        other = pools.setdefault(key, target)
+        if other is target:
+            continue
+        if other["cluster"]["conf_file"] != target["cluster"]["conf_file"]:
+            raise ValueError(f"The backup targets \"{other['name']}\" and \"{target['name']}\" store the "
+                             f"pool \"{target['pool']}\" of different clusters in the same directory "
+                             f"\"{target['directory']}\", please give one of them a directory of its own")
+        raise ValueError(f"The backup targets \"{other['name']}\" and \"{target['name']}\" both back up "
+                         f"the pool \"{target['pool']}\" into the directory \"{target['directory']}\", "
+                         f"please list their images in a single target")
+
+
+class BackupRun():
+    """
+    Backup of the images of several targets with shared resources
+    """
+
+    def __init__(self, targets: list, backup_config: dict, on_done=None):
+        """
+        Parameters
+        ----------
+        targets : list
+            targets returned by resolve_targets
+        backup_config : dict
+            backup section of the config
+        on_done : callable
+            called with the JobResult of every image when it finishes
+        """
+
+        self._backup_config = backup_config
+        self._workers = int(backup_config["workers"])
+        self._retries = int(backup_config["retries"])
+        self._on_done = on_done
+        self._handlers = {}
+        self._pools = {}
+        self._catalogs = {}
+        self._chunk_stores = {}
+        self.targets = []
+
+        self._throttle = Throttle(backup_config["throttle"])
+        self._offsite = open_backend(backup_config.get("offsite"))
+        if self._offsite is not None:
+            logger.info(f"The backups are copied to the offsite {self._offsite}")
+        self._controller = None
+        if backup_config["adaptive"].get("enabled", False):
+            self._controller = ConcurrencyController(
+                backup_config["adaptive"], self._workers, self._pool_stats, self._cluster_stats,
+                queue_depth=int(backup_config["export"]["queue_depth"]))
+
+        try:
+            for target in targets:
+                self.targets.append(self._open_target(target))
+        except:
+            self.close()
+            raise
+
+    def full_backup(self) -> list:
+        """ Performs a full backup of the images of every target """
+        return self._run("full")
+
+    def full_diff_backup(self) -> list:
+        """ Performs a differential backup of the images of every target """
+        return self._run("diff")
+
+    def auto_backup(self) -> list:
+        """ Performs a full or a differential backup of every image, whichever is cheaper """
+        return self._run("auto")
+
+    def print_overview(self):
+        print(f"\n{Color.GREEN}Backup Overview")
+        print(f"=================={Color.END}")
+        print(f"{Color.BOLD}Images to backup{Color.END}")
+        for target in self.targets:
+            for image in target.images:
+                print(f"\t{target.name}/{image}")
+        print(f"{Color.BOLD}Backup directory:{Color.END}")
+        for directory in self._catalogs:
+            print(f"\t{directory}")
+        print()
+
+    def close(self):
+        for target in self.targets:
+            target.close_pool_connection()
+        for chunk_store in self._chunk_stores.values():
+            chunk_store.close()
+        for catalog in self._catalogs.values():
+            catalog.close()
+        for handler in self._handlers.values():
+            handler.shutdown()
+        self.targets = []
+        self._chunk_stores = {}
+        self._catalogs = {}
+        self._handlers = {}
+        self._pools = {}
+
+    def _run(self, backup_type: str) -> list:
+        current_timestamp = Ceph._get_current_timestamp()
+        limit = self._controller.exports if self._controller is not None else None
+        scheduler = Scheduler(self._workers, self._retries, limit=limit, on_done=self._on_done)
+        for target in self.targets:
+            target.submit_backup_jobs(scheduler, backup_type, current_timestamp)
+        if self._controller is None:
+            return scheduler.run()
+        with self._controller:
+            return scheduler.run()
+
+    def _open_target(self, target: dict) -> Ceph:
+        cluster = target["cluster"]
+        cluster_key = tuple(cluster[key] for key in CLUSTER_KEYS)
+        directory = str(Path(target["directory"]))
+        if directory not in self._catalogs:
+            self._catalogs[directory] = Catalog(directory)
+
+        dedup_config = self._backup_config["dedup"]
+        chunk_store = None
+        if dedup_config.get("enabled", False):
+            chunk_store_dir = str(dedup_config.get("directory") or Path(directory).joinpath(".chunks"))
+            if chunk_store_dir not in self._chunk_stores:
+                compression_config = self._backup_config["compression"]
+                self._chunk_stores[chunk_store_dir] = ChunkStore(
+                    chunk_store_dir, compression_config["codec"], int(compression_config["level"]))
+            chunk_store = self._chunk_stores[chunk_store_dir]
+
+        # The targets of a cluster share its connection, shut down with the run
+        if cluster_key not in self._handlers:
+            self._handlers[cluster_key] = Ceph.open_handler(
+                cluster["conf_file"], cluster["user_keyring"], cluster["client"])
+
+        if target["name"] is not None:
+            logger.info(f"Opening the backup target {target['name']} ({target['pool']})")
+        ceph = Ceph(
+            cluster["conf_file"], cluster["user_keyring"], cluster["client"],
+            target["pool"], target["images"], directory,
+            self._workers, self._retries,
+            self._backup_config["export"], self._backup_config["compression"],
+            dedup_config, self._backup_config["checksum"],
+            self._backup_config["throttle"], self._backup_config["adaptive"],
+            self._backup_config["reference"],
+            handler=self._handlers[cluster_key], catalog=self._catalogs[directory],
+            chunk_store=chunk_store, throttle=self._throttle, controller=self._controller,
+            name=target["name"], offsite=self._offsite, auto_config=self._backup_config["auto"])
+        # The statistics of a pool backed up into several directories are
+        # sampled from one of its targets
+        self._pools.setdefault((cluster_key, target["pool"]), ceph)
+        return ceph
+
+    def _pool_stats(self) -> dict:
+        """ Statistics of every pool of the targets, added up """
+        return self._add_stats(target.pool_stats() for target in self._pools.values())
+
+    def _cluster_stats(self) -> dict:
+        """ Statistics of every cluster, added up """
+        return self._add_stats(handler.get_cluster_stats() for handler in self._handlers.values())
+
+    @staticmethod
+    def _add_stats(samples) -> dict:
+        total = {}
+        for sample in samples:
+            for key, value in sample.items():
+                if isinstance(value, (int, float)):
+                    total[key] = total.get(key, 0) + value
+        return total
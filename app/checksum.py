@@ -0,0 +1,278 @@
+"""
+Checksums of the stored backup files
+
+The checksums are computed while the files are written. A file is hashed in
+blocks of a fixed size, and its checksum is the hash of the digests of its
+blocks followed by its size (le64), so the blocks of a file can be verified
+in parallel. They are saved in a sidecar file next to the backup:
+
+    <file>.sum    {"algorithm": ..., "block_size": ..., "size": ...,
+                   "blocks": [hex digest of every block], "checksum": hex}
+
+The fully zero blocks (the holes of a sparse file) are hashed only once.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import json
+import struct
+import hashlib
+from pathlib import Path
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from .storage.files import PARTIAL_SUFFIX
+
+AVAILABLE_ALGORITHMS = ["none", "blake2b", "blake3", "xxh3"]
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+SIDECAR_SUFFIX = ".sum"
+
+
+def check_algorithm(algorithm: str):
+    """
+    Checks that a checksum algorithm is known and its python module installed
+
+    Raises
+    ------
+    ValueError
+        when the algorithm can not be used
+    """
+
+    if algorithm not in AVAILABLE_ALGORITHMS:
+        raise ValueError(f"Checksum algorithm \"{algorithm}\" not allowed, please use {AVAILABLE_ALGORITHMS}")
+    if algorithm == "blake3" and blake3 is None:
+        raise ValueError("blake3 checksums require the \"blake3\" module")
+    if algorithm == "xxh3" and xxhash is None:
+        raise ValueError("xxh3 checksums require the \"xxhash\" module")
+
+
+def new_hash(algorithm: str):
+    """ Returns a new hash object of the algorithm """
+    if algorithm == "blake3":
+        return blake3.blake3()
+    if algorithm == "xxh3":
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=32)
+
+
+def hash_block(algorithm: str, data) -> str:
+    h = new_hash(algorithm)
+    h.update(data)
+    return h.hexdigest()
+
+
+def sidecar_path(path) -> Path:
+    return Path(f"{path}{SIDECAR_SUFFIX}")
+
+
+class BlockHasher():
+    """
+    Hashes a stream in blocks as it is written
+    """
+
+    def __init__(self, algorithm: str = "blake2b", block_size: int = DEFAULT_BLOCK_SIZE):
+        check_algorithm(algorithm)
+        self.algorithm = algorithm
+        self.block_size = int(block_size)
+        self.size = 0
+        self.blocks = []
+        self._block = new_hash(algorithm)
+        self._block_fill = 0
+        self._zero_block = bytes(self.block_size)
+        self._zero_digest = None
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            n = min(len(view), self.block_size - self._block_fill)
+            self._block.update(view[:n])
+            self._add(n)
+            view = view[n:]
+
+    def update_zeros(self, length: int):
+        """ Hashes `length` zero bytes, without hashing the complete zero blocks again """
+        while length > 0:
+            if self._block_fill == 0 and length >= self.block_size:
+                if self._zero_digest is None:
+                    self._zero_digest = hash_block(self.algorithm, self._zero_block)
+                self.blocks.append(self._zero_digest)
+                self.size += self.block_size
+                length -= self.block_size
+                continue
+            n = min(length, self.block_size - self._block_fill)
+            self._block.update(memoryview(self._zero_block)[:n])
+            self._add(n)
+            length -= n
+
+    def finish(self) -> dict:
+        """ Returns the content of the sidecar file """
+        if self._block_fill > 0:
+            self.blocks.append(self._block.hexdigest())
+            self._block_fill = 0
+        return {
+            "algorithm": self.algorithm,
+            "block_size": self.block_size,
+            "size": self.size,
+            "blocks": self.blocks,
+            "checksum": file_checksum(self.algorithm, self.blocks, self.size)
+        }
+
+    def _add(self, n: int):
+        self.size += n
+        self._block_fill += n
+        if self._block_fill == self.block_size:
+            self.blocks.append(self._block.hexdigest())
+            self._block = new_hash(self.algorithm)
+            self._block_fill = 0
+
+
+def file_checksum(algorithm: str, blocks: list, size: int) -> str:
+    """ Whole file checksum from the digests of its blocks """
+    h = new_hash(algorithm)
+    for digest in blocks:
+        h.update(bytes.fromhex(digest))
+    h.update(struct.pack("<Q", size))
+    return h.hexdigest()
+
+
+class ChecksumSink():
+    """
+    Hashes the bytes written to another sink and saves the sidecar file
+    when it is closed
+
+    The sidecar is saved once the file is complete and before the file is
+    renamed, so a backup file never goes without its sidecar.
+    """
+
+    def __init__(self, sink, algorithm: str = "blake2b", block_size: int = DEFAULT_BLOCK_SIZE,
+                 inline: bool = True, resume: dict = None):
+        """
+        Parameters
+        ----------
+        sink : FileSink or ChunkSink
+            sink whose file is hashed
+        algorithm : str
+            "blake2b", "blake3" or "xxh3"
+        block_size : int
+            size in bytes of the hashed blocks
+        inline : bool
+            hash the stream while it is written. The file is hashed once
+            closed when the sink does not write the stream as is (a chunk
+            manifest)
+        resume : dict
+            state returned by checkpoint() to continue a partial file. The
+            bytes of its last incomplete block are read again from the file
+        """
+
+        self._sink = sink
+        self._hasher = BlockHasher(algorithm, block_size)
+        self._inline = inline
+        self.checksum = None
+        if resume is not None and inline:
+            self._hasher.blocks = list(resume["blocks"])
+            self._hasher.size = len(self._hasher.blocks) * self._hasher.block_size
+            with open(sink.partial_path, "rb") as f:
+                f.seek(self._hasher.size)
+                self._hasher.update(f.read(resume["size"] - self._hasher.size))
+
+    @property
+    def path(self):
+        return self._sink.path
+
+    @property
+    def bytes_written(self):
+        return self._sink.bytes_written
+
+    def write(self, data):
+        if self._inline:
+            self._hasher.update(data)
+        self._sink.write(data)
+
+    def skip(self, length: int):
+        if self._inline:
+            self._hasher.update_zeros(length)
+        self._sink.skip(length)
+
+    def checkpoint(self) -> dict:
+        state = {"inner": self._sink.checkpoint()}
+        if self._inline:
+            state["blocks"] = list(self._hasher.blocks)
+            state["size"] = self._hasher.size
+        return state
+
+    def close(self):
+        try:
+            self._sink.close(self._write_sidecar)
+        except Exception:
+            # The file was not renamed, its sidecar is discarded
+            if self.checksum is not None:
+                try:
+                    sidecar_path(self.path).unlink()
+                except FileNotFoundError:
+                    pass
+                self.checksum = None
+            raise
+
+    def _write_sidecar(self, partial_path: str):
+        """ Saves the sidecar of the complete file, before it is renamed """
+        if self._inline:
+            sidecar = self._hasher.finish()
+        else:
+            sidecar = hash_file(partial_path, self._hasher.algorithm, self._hasher.block_size)
+        write_sidecar(self.path, sidecar)
+        self.checksum = sidecar["checksum"]
+
+    def suspend(self):
+        self._sink.suspend()
+
+    def abort(self):
+        self._sink.abort()
+
+
+def hash_file(path, algorithm: str = "blake2b", block_size: int = DEFAULT_BLOCK_SIZE) -> dict:
+    """ Hashes an already written file. Returns the content of its sidecar file """
+    hasher = BlockHasher(algorithm, block_size)
+    with open(path, "rb") as f:
+        data = f.read(block_size)
+        while data:
+            hasher.update(data)
+            data = f.read(block_size)
+    return hasher.finish()
+
+
+def write_sidecar(path, sidecar: dict):
+    """ Saves the sidecar file of a backup file """
+    target = sidecar_path(path)
+    partial = Path(f"{target}{PARTIAL_SUFFIX}")
+    with open(partial, "w") as f:
+        json.dump(sidecar, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, target)
+
+
+def read_sidecar(path) -> dict:
+    """ Returns the sidecar content of a backup file, None when it has none """
+    try:
+        with open(sidecar_path(path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def read_checksum(path) -> str:
+    """ Returns the checksum of a backup file as "<algorithm>:<hex>", None when it has none """
+    sidecar = read_sidecar(path)
+    if sidecar is None:
+        return None
+    return f"{sidecar['algorithm']}:{sidecar['checksum']}"
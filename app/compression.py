@@ -0,0 +1,345 @@
+"""
+Streaming compression of the exported images
+
+The stream is cut in frames of a fixed uncompressed size that are compressed
+independently by a pool of threads and written in order. At the end of the
+file a seek table is appended, following the zstd seekable format:
+
+    skippable frame magic (0x184D2A5E), le32 frame size
+    for every frame: le32 compressed size, le32 decompressed size
+    le32 number of frames, 1 byte descriptor, le32 seekable magic (0x8F92EAB1)
+
+The seek table is a skippable frame for both zstd and lz4, so the files can
+still be decompressed by the `zstd` and `lz4` commands, while a restore can
+locate and decompress the frames in parallel.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import bisect
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+AVAILABLE_CODECS = ["none", "zstd", "lz4"]
+CODEC_SUFFIXES = {"zstd": ".zst", "lz4": ".lz4"}
+
+DEFAULT_FRAME_SIZE = 4 * 1024 * 1024
+
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER_SIZE = 9
+ZSTD_MAGIC = 0xFD2FB528
+LZ4_MAGIC = 0x184D2204
+
+
+def check_codec(codec: str):
+    """
+    Checks that a codec is known and its python module installed
+
+    Raises
+    ------
+    ValueError
+        when the codec can not be used
+    """
+
+    if codec not in AVAILABLE_CODECS:
+        raise ValueError(f"Compression codec \"{codec}\" not allowed, please use {AVAILABLE_CODECS}")
+    if codec == "zstd" and zstandard is None:
+        raise ValueError("zstd compression requires the \"zstandard\" module")
+    if codec == "lz4" and lz4 is None:
+        raise ValueError("lz4 compression requires the \"lz4\" module")
+
+
+def _frame_compressor(codec: str, level: int):
+    """
+    Returns a function that compresses a frame. It can be called from several
+    threads (zstd contexts are not thread-safe, so every thread has its own)
+    """
+
+    if codec == "zstd":
+        contexts = threading.local()
+
+        def compress(data):
+            if not hasattr(contexts, "compressor"):
+                contexts.compressor = zstandard.ZstdCompressor(level=level, write_content_size=True)
+            return contexts.compressor.compress(data)
+        return compress
+    return lambda data: lz4.frame.compress(data, compression_level=level, store_size=True)
+
+
+def _frame_decompressor(codec: str):
+    """
+    Returns a function that decompresses a frame. It can be called from
+    several threads
+    """
+
+    if codec == "zstd":
+        contexts = threading.local()
+
+        def decompress(data):
+            if not hasattr(contexts, "decompressor"):
+                contexts.decompressor = zstandard.ZstdDecompressor()
+            return contexts.decompressor.decompress(data)
+        return decompress
+    return lz4.frame.decompress
+
+
+class CompressedSink():
+    """
+    Compresses a stream on the fly into independent frames
+
+    Wraps another sink (the one that writes the compressed bytes), so it can
+    be used anywhere a FileSink is expected. The frames are gathered into a
+    fixed set of preallocated buffers, one being filled and one for every
+    frame being compressed, that are reused once their frame is written.
+    """
+
+    def __init__(self, sink, codec: str = "zstd", level: int = 3, threads: int = 2,
+                 frame_size: int = DEFAULT_FRAME_SIZE, resume: dict = None):
+        """
+        Parameters
+        ----------
+        sink : FileSink
+            sink where the compressed stream is written
+        codec : str
+            "zstd" or "lz4"
+        level : int
+            compression level of the codec
+        threads : int
+            number of frames compressed at the same time
+        frame_size : int
+            uncompressed size in bytes of every frame
+        resume : dict
+            state returned by checkpoint() to continue a partial file
+        """
+
+        check_codec(codec)
+        self._sink = sink
+        self._compress = _frame_compressor(codec, level)
+        self._frame_size = int(frame_size)
+        self._max_pending = max(1, int(threads)) * 2
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(threads)),
+                                            thread_name_prefix="compress")
+        self._pending = deque()
+        self._free = deque(bytearray(self._frame_size) for _ in range(self._max_pending + 1))
+        self._frame = self._free.popleft()
+        self._filled = 0
+        self._zero_block = bytes(self._frame_size)
+        self._frames = []
+        self.bytes_in = 0
+        if resume is not None:
+            self._frames = [tuple(frame) for frame in resume["frames"]]
+            self.bytes_in = resume["bytes_in"]
+
+    @property
+    def path(self):
+        return self._sink.path
+
+    @property
+    def bytes_written(self):
+        return self._sink.bytes_written
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self._fill(memoryview(data).cast("B"))
+
+    def skip(self, length: int):
+        """ Holes are not kept in a compressed stream, zeros are compressed instead """
+        self.bytes_in += length
+        zeros = memoryview(self._zero_block)
+        while length > 0:
+            n = min(length, self._frame_size)
+            self._fill(zeros[:n])
+            length -= n
+
+    def flush(self):
+        """ Ends the current frame and writes every pending frame """
+        if self._filled:
+            self._submit()
+        while self._pending:
+            self._write_frame(self._pending.popleft())
+
+    def checkpoint(self) -> dict:
+        """ Ends the current frame, so the stream can be resumed after it """
+        self.flush()
+        return {"frames": list(self._frames), "bytes_in": self.bytes_in,
+                "inner": self._sink.checkpoint()}
+
+    def close(self):
+        try:
+            self.flush()
+            self._sink.write(self._seek_table())
+        finally:
+            self._executor.shutdown()
+        self._sink.close()
+
+    def suspend(self):
+        self._cancel()
+        self._sink.suspend()
+
+    def abort(self):
+        self._cancel()
+        self._sink.abort()
+
+    def _cancel(self):
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown()
+
+    def _fill(self, view):
+        """ Copies the data into the frame being filled, submitting the full frames """
+        position = 0
+        while position < len(view):
+            n = min(len(view) - position, self._frame_size - self._filled)
+            self._frame[self._filled:self._filled + n] = view[position:position + n]
+            self._filled += n
+            position += n
+            if self._filled == self._frame_size:
+                self._submit()
+
+    def _submit(self):
+        """ Compresses the frame being filled and takes a free buffer for the next one """
+        if len(self._pending) >= self._max_pending:
+            self._write_frame(self._pending.popleft())
+        frame, length = self._frame, self._filled
+        self._pending.append(self._executor.submit(self._compress_frame, frame, length))
+        self._frame = self._free.popleft()
+        self._filled = 0
+
+    def _compress_frame(self, frame: bytearray, length: int) -> tuple:
+        with memoryview(frame)[:length] as view:
+            return self._compress(view), length, frame
+
+    def _write_frame(self, future):
+        compressed, decompressed_size, frame = future.result()
+        self._free.append(frame)
+        self._sink.write(compressed)
+        self._frames.append((len(compressed), decompressed_size))
+
+    def _seek_table(self) -> bytes:
+        entries = b"".join(struct.pack("<II", c, d) for c, d in self._frames)
+        footer = struct.pack("<IBI", len(self._frames), 0, SEEKABLE_MAGIC)
+        return struct.pack("<II", SKIPPABLE_MAGIC, len(entries) + len(footer)) + entries + footer
+
+
+class SeekableReader():
+    """
+    Reads a file written by CompressedSink
+
+    The frames are located through the seek table, so they can be
+    decompressed in parallel or individually for random access.
+    """
+
+    def __init__(self, path: str, threads: int = 1):
+        self.path = str(path)
+        self._threads = max(1, int(threads))
+        self._file = open(self.path, "rb")
+        self.frames = self._read_seek_table()
+        self.size = sum(frame[3] for frame in self.frames)
+        self._offsets = [frame[2] for frame in self.frames]
+        # Last frame decompressed by read_at, as (index, data)
+        self._cached = (None, None)
+        self._decompress = _frame_decompressor(self._detect_codec()) if self.frames else None
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def iter_chunks(self):
+        """
+        Yields the decompressed frames in order. Up to `threads` frames are
+        decompressed at the same time
+        """
+
+        with ThreadPoolExecutor(max_workers=self._threads, thread_name_prefix="decompress") as executor:
+            pending = deque()
+            for frame in self.frames:
+                if len(pending) >= self._threads * 2:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(self._decompress, self._read_frame(frame)))
+            while pending:
+                yield pending.popleft().result()
+
+    def read_at(self, offset: int, length: int) -> bytes:
+        """ Returns `length` decompressed bytes starting at `offset` """
+        data = bytearray()
+        index = max(bisect.bisect_right(self._offsets, offset) - 1, 0)
+        for index in range(index, len(self.frames)):
+            frame_start, frame_size = self.frames[index][2], self.frames[index][3]
+            if frame_start + frame_size <= offset:
+                continue
+            if frame_start >= offset + length:
+                break
+            chunk = self._get_frame(index)
+            start = max(offset - frame_start, 0)
+            data += chunk[start:start + length - len(data)]
+        return bytes(data)
+
+    def _get_frame(self, index: int) -> bytes:
+        cached_index, chunk = self._cached
+        if cached_index != index:
+            chunk = self._decompress(self._read_frame(self.frames[index]))
+            self._cached = (index, chunk)
+        return chunk
+
+    def _read_frame(self, frame: tuple) -> bytes:
+        self._file.seek(frame[0])
+        return self._file.read(frame[1])
+
+    def _detect_codec(self) -> str:
+        self._file.seek(0)
+        magic = struct.unpack("<I", self._file.read(4))[0]
+        if magic == ZSTD_MAGIC:
+            check_codec("zstd")
+            return "zstd"
+        if magic == LZ4_MAGIC:
+            check_codec("lz4")
+            return "lz4"
+        raise ValueError(f"Unknown compressed frame in {self.path}")
+
+    def _read_seek_table(self) -> list:
+        """
+        Returns the frames as a list of (compressed offset, compressed size,
+        decompressed offset, decompressed size)
+        """
+
+        self._file.seek(0, 2)
+        file_size = self._file.tell()
+        if file_size < SEEK_TABLE_FOOTER_SIZE:
+            raise ValueError(f"{self.path} has no seek table")
+        self._file.seek(file_size - SEEK_TABLE_FOOTER_SIZE)
+        count, descriptor, magic = struct.unpack("<IBI", self._file.read(SEEK_TABLE_FOOTER_SIZE))
+        if magic != SEEKABLE_MAGIC:
+            raise ValueError(f"{self.path} has no seek table")
+        entry_size = 12 if descriptor & 0x80 else 8
+        table_size = count * entry_size
+        self._file.seek(file_size - SEEK_TABLE_FOOTER_SIZE - table_size)
+        table = self._file.read(table_size)
+
+        frames = []
+        compressed_offset = 0
+        decompressed_offset = 0
+        for i in range(count):
+            compressed_size, decompressed_size = struct.unpack_from("<II", table, i * entry_size)
+            frames.append((compressed_offset, compressed_size, decompressed_offset, decompressed_size))
+            compressed_offset += compressed_size
+            decompressed_offset += decompressed_size
+        return frames
@@ -1,27 +1,50 @@
 #! /usr/bin/python3
+"""
+PandoraFMS plugin of the backups
+
+The backup process appends a JSON event per line to the pandora log when the
+backup of an image starts, ends or fails:
+
+    {"time": 1584262800.5, "event": "start", "type": "full", "image": "one-12-0"}
+
+Every poll of the agent reads only the lines appended since the last one,
+from the byte offset saved in a state file (`<log>.state` by default) with
+the last status of every image, and prints the modules of every image. A log
+that was truncated or replaced (rotated) is read again from the beginning.
+
+    pandorafms/__init__.py <log file> [<state file>]
+"""
+
+import os
 import sys
-from datetime import datetime
-FMT = '%H:%M:%S'
+import json
+import time
+import logging
 
 # https://pandorafms.com/docs/index.php?title=Pandora:Documentation_es:Operacion
 AVAILABLE_TYPES = [
-    "generic_data", "generic_data_inc", "generic_data_inc_abs", "generic_proc", 
-    "generic_data_string", "async_data", "async_string", "async_proc"]    
+    "generic_data", "generic_data_inc", "generic_data_inc_abs", "generic_proc",
+    "generic_data_string", "async_data", "async_string", "async_proc"]
+
+STATE_SUFFIX = ".state"
+
+# Bytes of the log read at once
+READ_SIZE = 1024 * 1024
 
 class Module:
     def __init__(self, name, type, description, data):
         self._name = name
-        
+
         if type in AVAILABLE_TYPES:
             self._type = type
         else:
             raise
-            
+
         self._description = description
         self._data = data
 
     def __str__(self):
-        r = "<module>\n"        
+        r = "<module>\n"
         r+= f"\t<name><![CDATA[{self._name}]]></name>\n"
         r+= f"\t<type><![CDATA[{self._type}]]></type>\n"
         r+= f"\t<data><![CDATA[{self._data}]]></data>\n"
@@ -29,53 +52,105 @@ class Module:
         r+= "</module>\n"
         return r
 
-def parse_log_file(log_file_path):
+
+class EventFilter(logging.Filter):
+    """ Lets through the records of the backup process that carry an event """
+    def filter(self, record):
+        return hasattr(record, "event")
+
+
+class EventFormatter(logging.Formatter):
+    """ Formats the event of a record as a JSON line """
+    def format(self, record):
+        return json.dumps(dict(record.event, time=record.created), sort_keys=True)
+
+
+def backup_event(name: str, backup_type: str, image: str) -> dict:
+    """ Returns the `extra` of a log record with a backup event """
+    return {"event": {"event": name, "type": backup_type, "image": image}}
+
+
+def load_state(state_file_path):
+    try:
+        with open(state_file_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"inode": None, "offset": 0, "images": {}}
+
+
+def save_state(state_file_path, state):
+    """ Replaces the state atomically, a poll killed halfway keeps the previous one """
+    partial = f"{state_file_path}.tmp"
+    with open(partial, "w") as f:
+        json.dump(state, f)
+    os.replace(partial, state_file_path)
+
+
+def apply_event(images, event):
+    image = images.setdefault(event["image"], {"status": 0, "elapsed": 0, "started_at": None})
+    image["type"] = event.get("type", image.get("type"))
+    if event["event"] == "start":
+        image["started_at"] = event["time"]
+    elif event["event"] in ("end", "fail"):
+        image["status"] = 1 if event["event"] == "end" else 0
+        if image["started_at"] is not None:
+            image["elapsed"] = max(0.0, event["time"] - image["started_at"])
+        image["started_at"] = None
+        image["finished_at"] = event["time"]
+
+
+def read_events(log_file_path, state):
+    """
+    Applies the events appended to the log since the last poll to the state.
+    A line still being written is left for the next poll
+    """
+
+    with open(log_file_path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        if state["inode"] != stat.st_ino or stat.st_size < state["offset"]:
+            # Rotated or truncated log
+            state["inode"] = stat.st_ino
+            state["offset"] = 0
+        f.seek(state["offset"])
+        pending = b""
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                state["offset"] += len(line) + 1
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(event, dict) or not {"image", "event", "time"} <= event.keys():
+                    continue
+                apply_event(state["images"], event)
+
+
+def parse_log_file(log_file_path, state_file_path=None):
+
+    state_file_path = state_file_path or f"{log_file_path}{STATE_SUFFIX}"
+    state = load_state(state_file_path)
+    if os.path.exists(log_file_path):
+        read_events(log_file_path, state)
+        save_state(state_file_path, state)
 
     modules = []
-    lines = []
-    
-
-    with open(log_file_path, "r") as f:
-        line = f.readline()
-        while line:
-            if "BACKUP" in line:
-                lines.append(line)
-            
-            line = f.readline()    
-
-    images_status = {}
-    
-    for line in lines:        
-        parts = line.split(" - ")
-        image_name = parts[4].rstrip()
-        backup_type = parts[3]
-        status = parts[2]
-        date, time = parts[0].split(" ")
-        
-        if image_name not in images_status:
-            images_status[image_name] = {}
-
-        images_status[image_name][status] = {
-            "backup_type": backup_type,
-            "date":  date,
-            "time": time.split(",")[0]
-        }                
-    
-    for key, value in images_status.items():        
-        backup_status_data = 0
-        backup_elapsed_time_data = 0
-        if "START" in value and "END" in value:        
-            backup_status_data = 1
-            backup_elapsed_time_data = datetime.strptime(value["END"]["time"], FMT) - datetime.strptime(value["START"]["time"], FMT)            
-
-        m = Module(f"ceph_backup_{key}_status", "generic_data", "Estado del backup", backup_status_data)
+    for key, value in state["images"].items():
+        m = Module(f"ceph_backup_{key}_status", "generic_data", "Estado del backup", value["status"])
         modules.append(m)
-        m = Module(f"ceph_backup_{key}_elapsed_time", "generic_data", "Tiempo empleado en el backup", backup_elapsed_time_data.total_seconds())        
-        modules.append(m)        
-    
+        m = Module(f"ceph_backup_{key}_elapsed_time", "generic_data", "Tiempo empleado en el backup", value["elapsed"])
+        modules.append(m)
+        running = 0 if value["started_at"] is None else time.time() - value["started_at"]
+        m = Module(f"ceph_backup_{key}_running_time", "generic_data", "Tiempo del backup en curso", running)
+        modules.append(m)
+
     for module in modules:
         print(module)
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
-        parse_log_file(sys.argv[1])
\ No newline at end of file
+        parse_log_file(*sys.argv[1:3])
@@ -0,0 +1,293 @@
+"""
+Prometheus metrics of the backup runs
+
+The result of every image is exposed in the OpenMetrics text format, both as
+a file for the textfile collector of the node exporter and, while the backup
+runs, through a local HTTP endpoint:
+
+    monitoring:
+      prometheus:
+        textfile: /var/lib/node_exporter/onbackup.prom
+        listen: "127.0.0.1:9469"        # empty disables the endpoint
+
+The file is replaced atomically at the end of every run. The endpoint serves
+the images finished so far.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import time
+import threading
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PREFIX = "onbackup"
+
+# name, type, unit, help
+RUN_METRICS = [
+    ("run_start_timestamp_seconds", "gauge", "seconds", "Start time of the backup run"),
+    ("run_duration_seconds", "gauge", "seconds", "Duration of the backup run"),
+    ("run_images", "gauge", None, "Images of the backup run by status"),
+    ("run_success", "gauge", None, "Whether every image of the backup run succeeded"),
+]
+IMAGE_METRICS = [
+    ("image_success", "gauge", None, "Whether the backup of the image succeeded"),
+    ("image_retries", "gauge", None, "Retries of the backup of the image"),
+    ("image_duration_seconds", "gauge", "seconds", "Duration of the backup of the image, with its retries"),
+    ("image_logical_bytes", "gauge", "bytes", "Size of the image"),
+    ("image_allocated_bytes", "gauge", "bytes", "Allocated bytes of the image"),
+    ("image_read_bytes", "gauge", "bytes", "Bytes read from the cluster"),
+    ("image_written_bytes", "gauge", "bytes", "Bytes written to the backup directory"),
+    ("image_read_throughput_bytes_per_second", "gauge", None, "Bytes read per second of export"),
+    ("image_throttled_seconds", "gauge", "seconds", "Time the reads waited for the throttle"),
+    ("image_phase_duration_seconds", "gauge", "seconds", "Duration of every phase of the backup"),
+    ("image_snapshots", "gauge", None, "Snapshots of the image after the backup"),
+    ("image_errors", "gauge", None, "Errors that did not fail the backup of the image"),
+    ("image_stage_busy_seconds", "gauge", "seconds", "Time every stage of the export pipeline was busy"),
+    ("image_stage_idle_seconds", "gauge", "seconds", "Time every stage of the export pipeline waited for data"),
+    ("image_stage_blocked_seconds", "gauge", "seconds",
+     "Time every stage of the export pipeline waited for room in the next stage"),
+    ("image_stage_utilisation_ratio", "gauge", "ratio", "Ratio of the export every stage was busy"),
+]
+
+
+def parse_listen(value: str) -> tuple:
+    """
+    Returns the (host, port) of a "host:port" address
+
+    Raises
+    ------
+    ValueError
+        when the address is not valid
+    """
+
+    host, sep, port = str(value).rpartition(":")
+    if not sep or not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"Wrong metrics listen address \"{value}\", please use host:port")
+    return host.strip("[]") or "127.0.0.1", int(port)
+
+
+def check_config(config: dict):
+    """
+    Checks the prometheus section of the monitoring config
+
+    Raises
+    ------
+    ValueError
+        when the textfile directory does not exist or the address is wrong
+    """
+
+    if config.get("textfile") and not Path(config["textfile"]).parent.exists():
+        raise ValueError(f"Metrics textfile directory \"{Path(config['textfile']).parent}\" does not exist")
+    if config.get("listen"):
+        parse_listen(config["listen"])
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f"{key}=\"{_escape(value)}\"" for key, value in labels.items()) + "}"
+
+
+def _value(value) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class BackupMetrics():
+    """
+    Metrics of a backup run, updated as the images finish
+    """
+
+    def __init__(self, backup_type: str, default_target: str = ""):
+        """
+        Parameters
+        ----------
+        backup_type : str
+            "full" or "diff"
+        default_target : str
+            target of the images whose job name has no target (the pool of
+            a run without targets)
+        """
+
+        self._backup_type = backup_type
+        self._default_target = default_target or ""
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+        self._finished_at = None
+        self._images = []
+
+    def record(self, result):
+        """ Accounts the JobResult of an image """
+        target, _, image = result.name.rpartition("/")
+        stats = result.value if result.success else None
+        # The auto backups are labelled with the type chosen for the image
+        backup_type = getattr(stats, "backup_type", None) or self._backup_type
+        labels = {"target": target or self._default_target, "image": image, "type": backup_type}
+        samples = [
+            ("image_success", labels, bool(result.success)),
+            ("image_retries", labels, max(0, result.attempts - 1)),
+            ("image_duration_seconds", labels, result.elapsed),
+        ]
+        if stats is not None:
+            samples += [
+                ("image_logical_bytes", labels, stats.logical_bytes),
+                ("image_allocated_bytes", labels, stats.allocated_bytes),
+                ("image_read_bytes", labels, stats.bytes_read),
+                ("image_written_bytes", labels, stats.bytes_written),
+                ("image_read_throughput_bytes_per_second", labels,
+                 stats.bytes_read / stats.elapsed if stats.elapsed else 0.0),
+                ("image_throttled_seconds", labels, stats.throttled),
+            ]
+            for phase, seconds in stats.phases.items():
+                samples.append(("image_phase_duration_seconds", dict(labels, phase=phase), seconds))
+            if stats.snapshots is not None:
+                samples.append(("image_snapshots", labels, stats.snapshots))
+            samples.append(("image_errors", labels, len(stats.errors)))
+            for stage, counters in stats.stages.items():
+                stage_labels = dict(labels, stage=stage)
+                samples += [
+                    ("image_stage_busy_seconds", stage_labels, counters["busy"]),
+                    ("image_stage_idle_seconds", stage_labels, counters["idle"]),
+                    ("image_stage_blocked_seconds", stage_labels, counters["blocked"]),
+                    ("image_stage_utilisation_ratio", stage_labels, counters["utilisation"]),
+                ]
+        with self._lock:
+            self._images.append((bool(result.success), samples))
+
+    def finish(self):
+        with self._lock:
+            self._finished_at = time.time()
+
+    def render(self) -> str:
+        """ Returns the metrics in the OpenMetrics text format """
+        with self._lock:
+            images = list(self._images)
+            finished_at = self._finished_at
+        labels = {"type": self._backup_type}
+        failed = sum(1 for success, _ in images if not success)
+        samples = [
+            ("run_start_timestamp_seconds", labels, self._started_at),
+            ("run_duration_seconds", labels, (finished_at or time.time()) - self._started_at),
+            ("run_images", dict(labels, status="success"), len(images) - failed),
+            ("run_images", dict(labels, status="failed"), failed),
+        ]
+        if finished_at is not None:
+            samples.append(("run_success", labels, failed == 0))
+        for _, image_samples in images:
+            samples += image_samples
+
+        lines = []
+        for name, metric_type, unit, description in RUN_METRICS + IMAGE_METRICS:
+            family = [sample for sample in samples if sample[0] == name]
+            if not family:
+                continue
+            lines.append(f"# TYPE {PREFIX}_{name} {metric_type}")
+            if unit:
+                lines.append(f"# UNIT {PREFIX}_{name} {unit}")
+            lines.append(f"# HELP {PREFIX}_{name} {description}")
+            for _, sample_labels, value in family:
+                lines.append(f"{PREFIX}_{name}{_labels(sample_labels)} {_value(value)}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str):
+        """ Replaces the textfile atomically, so the collector never reads it half written """
+        partial = f"{path}.{os.getpid()}.tmp"
+        with open(partial, "w") as f:
+            f.write(self.render())
+        os.replace(partial, path)
+
+
+class MetricsServer():
+    """
+    Local HTTP endpoint that serves the metrics of a run
+    """
+
+    def __init__(self, metrics: BackupMetrics, listen: str):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"{self.address_string()} - {format % args}")
+
+        self._server = ThreadingHTTPServer(parse_listen(listen), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self) -> tuple:
+        return self._server.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+        self._thread.start()
+        logger.info(f"Serving the metrics on http://{self.address[0]}:{self.address[1]}/metrics")
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class Monitor():
+    """
+    Prometheus monitoring of a backup run, as configured
+    """
+
+    def __init__(self, config: dict, backup_type: str, default_target: str = ""):
+        """
+        Parameters
+        ----------
+        config : dict
+            prometheus section of the monitoring config
+        backup_type : str
+            "full" or "diff"
+        default_target : str
+            target of the images of a run without targets
+        """
+
+        self._textfile = config.get("textfile") or None
+        self.metrics = BackupMetrics(backup_type, default_target)
+        self._server = None
+        if config.get("listen"):
+            self._server = MetricsServer(self.metrics, config["listen"])
+            self._server.start()
+
+    def record(self, result):
+        self.metrics.record(result)
+
+    def close(self):
+        """ Writes the textfile with the final metrics and stops the endpoint """
+        self.metrics.finish()
+        try:
+            if self._textfile:
+                self.metrics.write_textfile(self._textfile)
+                logger.info(f"Metrics written to {self._textfile}")
+        except OSError as e:
+            logger.error(f"Could not write the metrics to {self._textfile}: {e!r}")
+        finally:
+            if self._server is not None:
+                self._server.stop()
+                self._server = None
@@ -0,0 +1,235 @@
+"""
+Pipelined sinks of the exports
+
+An export reads the image, transforms the stream (checksum, compression,
+deduplication) and writes the file. Run in a single thread, the cluster is
+idle while the stream is compressed and written, and the disk is idle while
+the image is read. In a pipeline every stage runs in its own thread, and the
+stages are connected by queues bounded in bytes:
+
+    reader --queue--> transform --queue--> writer
+    (export thread)   (checksum, compression)   (file, offsite copy)
+
+The queues pass the buffers of the previous stage by reference, without
+copying them, so a stage must not change a buffer once written. A stage that
+finds the next queue full waits, which bounds the memory of every image.
+
+Every stage counts the seconds it was busy, idle (waiting for data) and
+blocked (waiting for room in the next queue), and the bytes it handled.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+import threading
+from collections import deque
+
+DEFAULT_QUEUE_BYTES = 32 * 1024 * 1024
+
+
+class StageStats():
+    """
+    Counters of a stage of a pipeline
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.busy = 0.0
+        self.idle = 0.0
+        self.blocked = 0.0
+        self.bytes = 0
+
+    def utilisation(self, elapsed: float) -> float:
+        """ Ratio of `elapsed` the stage was busy """
+        return min(1.0, self.busy / elapsed) if elapsed > 0 else 0.0
+
+    def as_dict(self, elapsed: float) -> dict:
+        return {"busy": round(self.busy, 6), "idle": round(self.idle, 6), "blocked": round(self.blocked, 6),
+                "bytes": self.bytes, "utilisation": round(self.utilisation(elapsed), 4)}
+
+    def __str__(self):
+        return f"{self.name} {self.busy:.2f} s busy, {self.idle:.2f} s idle, {self.blocked:.2f} s blocked"
+
+
+class Pipeline():
+    """
+    Stages of the pipeline of an export. The first one is the stage that
+    writes into the pipeline (the reader)
+    """
+
+    def __init__(self, reader: str = "read"):
+        self.stages = [StageStats(reader)]
+        self._started = time.monotonic()
+        self._stopped = None
+
+    def add_stage(self, name: str) -> StageStats:
+        stage = StageStats(name)
+        self.stages.append(stage)
+        return stage
+
+    def stop(self):
+        """
+        Ends the pipeline. The reader was busy whenever it was not blocked,
+        and it handled the bytes taken by the next stage
+        """
+        self._stopped = time.monotonic()
+        reader = self.stages[0]
+        reader.busy = max(0.0, self.elapsed - reader.blocked)
+        if len(self.stages) > 1:
+            reader.bytes = self.stages[1].bytes
+
+    @property
+    def elapsed(self) -> float:
+        return (self._stopped or time.monotonic()) - self._started
+
+    def as_dict(self) -> dict:
+        """ Counters of every stage, by name """
+        elapsed = self.elapsed
+        return {stage.name: stage.as_dict(elapsed) for stage in self.stages}
+
+    def __str__(self):
+        elapsed = self.elapsed
+        return ", ".join(f"{stage.name} {stage.utilisation(elapsed):.0%}" for stage in self.stages)
+
+
+class QueuedSink():
+    """
+    Runs a sink in the thread of a stage of a pipeline
+
+    The writes and skips are queued and applied by the thread. checkpoint()
+    and close() wait until the queue is empty. An error of the thread is
+    raised by the next call.
+    """
+
+    def __init__(self, sink, stage: StageStats, upstream: StageStats,
+                 max_bytes: int = DEFAULT_QUEUE_BYTES):
+        """
+        Parameters
+        ----------
+        sink :
+            sink run by the stage
+        stage : StageStats
+            counters of the stage
+        upstream : StageStats
+            counters of the stage that writes into the queue
+        max_bytes : int
+            bytes of the queue. A single larger write is still queued when
+            the queue is empty
+        """
+
+        self._sink = sink
+        self._stage = stage
+        self._upstream = upstream
+        self._max_bytes = max(1, int(max_bytes))
+        self._queue = deque()
+        self._queued_bytes = 0
+        self._pending = 0
+        self._error = None
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=f"stage-{stage.name}", daemon=True)
+        self._thread.start()
+
+    @property
+    def path(self):
+        return self._sink.path
+
+    @property
+    def partial_path(self):
+        return self._sink.partial_path
+
+    @property
+    def bytes_written(self):
+        return self._sink.bytes_written
+
+    def write(self, data):
+        self._put("write", data, len(data))
+
+    def skip(self, length: int):
+        self._put("skip", length, 0)
+
+    def checkpoint(self) -> dict:
+        self._drain()
+        return self._timed(self._sink.checkpoint)
+
+    def close(self, *args):
+        self._drain()
+        self._stop()
+        self._timed(self._sink.close, *args)
+
+    def suspend(self):
+        self._stop()
+        self._sink.suspend()
+
+    def abort(self):
+        self._stop()
+        self._sink.abort()
+
+    def _put(self, operation: str, argument, size: int):
+        with self._cond:
+            if self._queued_bytes and self._queued_bytes + size > self._max_bytes:
+                started = time.monotonic()
+                while self._error is None and not self._stopped and self._queued_bytes and \
+                        self._queued_bytes + size > self._max_bytes:
+                    self._cond.wait()
+                self._upstream.blocked += time.monotonic() - started
+            self._check()
+            self._queue.append((operation, argument, size))
+            self._queued_bytes += size
+            self._pending += 1
+            self._cond.notify_all()
+
+    def _drain(self):
+        """ Waits until every queued operation is applied """
+        with self._cond:
+            started = time.monotonic()
+            while self._pending and self._error is None:
+                self._cond.wait()
+            self._upstream.blocked += time.monotonic() - started
+            self._check()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+        if self._stopped:
+            raise RuntimeError(f"The {self._stage.name} stage is stopped")
+
+    def _stop(self):
+        with self._cond:
+            self._stopped = True
+            self._queue.clear()
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _timed(self, function, *args):
+        """ Calls the sink, counting as busy the time not blocked by the next stage """
+        started = time.monotonic()
+        blocked = self._stage.blocked
+        try:
+            return function(*args)
+        finally:
+            self._stage.busy += time.monotonic() - started - (self._stage.blocked - blocked)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                started = time.monotonic()
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                self._stage.idle += time.monotonic() - started
+                if self._stopped:
+                    return
+                operation, argument, size = self._queue.popleft()
+            try:
+                self._timed(self._sink.write if operation == "write" else self._sink.skip, argument)
+            except Exception as e:
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._stage.bytes += size
+                self._queued_bytes -= size
+                self._pending -= 1
+                self._cond.notify_all()
@@ -0,0 +1,142 @@
+import logging
+logger = logging.getLogger(__name__)
+
+from util.color import Color
+from . import tracing
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobResult():
+    """
+    Outcome of a job executed by the scheduler
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.success = False
+        self.attempts = 0
+        self.elapsed = 0.0
+        self.error = None
+        self.value = None
+
+
+class Scheduler():
+    """
+    Worker pool that runs independent jobs concurrently
+
+    Every job is isolated from the others. A failing job is retried up to
+    `retries` times and, if it keeps failing, the error is stored in its
+    result without aborting the rest of the jobs.
+    """
+
+    def __init__(self, workers: int = 1, retries: int = 0, retry_delay: float = 5.0, limit=None,
+                 on_done=None):
+        """
+        Parameters
+        ----------
+        workers : int
+            maximum number of jobs running at the same time
+        retries : int
+            number of extra attempts for a failed job
+        retry_delay : float
+            seconds to wait before retrying a failed job
+        limit : AdaptiveLimit
+            slots taken by every attempt of a job, to run less than `workers`
+            jobs at the same time. None runs `workers` jobs
+        on_done : callable
+            called with the JobResult of every job when it finishes
+        """
+
+        self._workers = max(1, int(workers))
+        self._retries = max(0, int(retries))
+        self._retry_delay = retry_delay
+        self._limit = limit
+        self._on_done = on_done
+        self._jobs = []
+
+    def submit(self, name: str, func, *args, **kwargs):
+        """
+        Queue a job to be executed on the next run
+
+        Parameters
+        ----------
+        name : str
+            name used to identify the job in the results
+        func : callable
+            function that performs the job
+        """
+
+        self._jobs.append((name, func, args, kwargs))
+
+    def run(self) -> list:
+        """
+        Execute all the queued jobs
+
+        Returns
+        -------
+        list
+            list of JobResult, in the same order the jobs were submitted
+        """
+
+        jobs, self._jobs = self._jobs, []
+        logger.info(f"Running {len(jobs)} jobs with {self._workers} workers...")
+        with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="job") as executor:
+            futures = [executor.submit(self._run_job, *job) for job in jobs]
+            return [future.result() for future in futures]
+
+    def _run_job(self, name: str, func, args: tuple, kwargs: dict) -> JobResult:
+        result = JobResult(name)
+        start = time.monotonic()
+        while result.attempts <= self._retries:
+            result.attempts += 1
+            try:
+                with tracing.span("job", job=name, attempt=result.attempts):
+                    if self._limit is not None:
+                        with self._limit:
+                            result.value = func(*args, **kwargs)
+                    else:
+                        result.value = func(*args, **kwargs)
+                result.success = True
+                result.error = None
+                break
+            except Exception as e:
+                result.error = e
+                logger.error(f"Job {name} failed (attempt {result.attempts}/{self._retries + 1}): {e!r}")
+                if result.attempts <= self._retries:
+                    time.sleep(self._retry_delay)
+        result.elapsed = time.monotonic() - start
+        if self._on_done is not None:
+            try:
+                self._on_done(result)
+            except Exception as e:
+                logger.warning(f"Could not account the result of the job {name}: {e!r}")
+        return result
+
+    @staticmethod
+    def print_summary(results: list, title: str = "Backup Summary"):
+        """
+        Prints a per job summary of a run
+
+        Parameters
+        ----------
+        results : list
+            list of JobResult returned by run
+        title : str
+            title of the summary
+        """
+
+        failed = [r for r in results if not r.success]
+        print(f"\n{Color.GREEN}{title}")
+        print(f"=================={Color.END}")
+        for r in results:
+            status = f"{Color.GREEN}OK{Color.END}" if r.success else f"{Color.RED}FAILED{Color.END}"
+            line = f"\t{r.name}: {status} ({r.attempts} attempts, {r.elapsed:.1f} s)"
+            if not r.success:
+                line += f" - {r.error!r}"
+            elif r.value is not None:
+                line += f" - {r.value}"
+            print(line)
+        print(f"{Color.BOLD}Total:{Color.END} {len(results)}, "
+              f"{Color.BOLD}failed:{Color.END} {len(failed)}\n")
@@ -0,0 +1,344 @@
+"""
+Storage backends of the offsite copies of the backups
+
+The exported files are always written into the backup directory. When an
+offsite backend is configured, the bytes stored in every file are also
+streamed to the backend while the export runs, so the copy does not have to
+read the files back once the backup finishes:
+
+    backup:
+      offsite:
+        backend: s3                    # none, local or s3
+        endpoint: https://s3.example.com
+        bucket: backups
+        prefix: onbackup
+        part_size: 67108864            # bytes of every uploaded part
+        concurrency: 4                 # parts uploaded at the same time
+
+The copy of a file is stored under the path of the file relative to its
+backup directory, after the prefix. Every backend opens writers with the
+same interface:
+
+    write(data)     appends data to the copy
+    skip(length)    appends a zero-filled hole
+    commit()        completes the copy, once the file is complete
+    abort()         discards the incomplete copy
+
+The s3 backend works with any S3-compatible store and requires the boto3
+module. The file is uploaded in parts by a multipart upload, with at most
+`concurrency` parts in flight, so every export holds at most
+(concurrency + 1) * part_size bytes in memory.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+except ImportError:
+    boto3 = None
+
+from .files import PARTIAL_SUFFIX
+
+AVAILABLE_BACKENDS = ["none", "local", "s3"]
+
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_CONCURRENCY = 4
+# Limits of the S3 multipart uploads
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+# The part size doubles every PART_SIZE_STEP parts, so the largest files
+# do not run out of part numbers
+PART_SIZE_STEP = 1000
+# Bytes of the zeros appended at a time for the holes
+ZERO_BLOCK_SIZE = 1024 * 1024
+
+
+def check_config(offsite_config: dict):
+    """
+    Checks the offsite section of the backup config
+
+    Raises
+    ------
+    ValueError
+        when the backend can not be used
+    """
+
+    backend = offsite_config.get("backend", "none")
+    if backend not in AVAILABLE_BACKENDS:
+        raise ValueError(f"Offsite backend \"{backend}\" not allowed, please use {AVAILABLE_BACKENDS}")
+    if backend == "local":
+        directory = offsite_config.get("directory", "")
+        if not directory or not Path(directory).is_dir():
+            raise ValueError(f"Offsite directory \"{directory}\" does not exist")
+    if backend == "s3":
+        if boto3 is None:
+            raise ValueError("The s3 offsite backend requires the \"boto3\" module")
+        if not offsite_config.get("bucket", ""):
+            raise ValueError("Offsite bucket not set")
+        if int(offsite_config.get("part_size", DEFAULT_PART_SIZE)) < MIN_PART_SIZE:
+            raise ValueError(f"Offsite part size must be at least {MIN_PART_SIZE} bytes")
+        if int(offsite_config.get("concurrency", DEFAULT_CONCURRENCY)) < 1:
+            raise ValueError("Offsite concurrency must be at least 1")
+
+
+def open_backend(offsite_config: dict):
+    """
+    Opens the backend of the offsite section of the backup config
+
+    Returns
+    -------
+    LocalBackend, S3Backend or None when the offsite copy is disabled
+    """
+
+    offsite_config = offsite_config or {}
+    backend = offsite_config.get("backend", "none")
+    if backend == "local":
+        return LocalBackend(offsite_config["directory"])
+    if backend == "s3":
+        return S3Backend(
+            offsite_config["bucket"], offsite_config.get("prefix", ""),
+            endpoint=offsite_config.get("endpoint", ""), region=offsite_config.get("region", ""),
+            access_key=offsite_config.get("access_key", ""),
+            secret_key=offsite_config.get("secret_key", ""),
+            part_size=int(offsite_config.get("part_size", DEFAULT_PART_SIZE)),
+            concurrency=int(offsite_config.get("concurrency", DEFAULT_CONCURRENCY)))
+    return None
+
+
+class LocalBackend():
+    """
+    Copies the files into another directory, such as a remote filesystem
+    """
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+
+    def open_writer(self, key: str):
+        return LocalWriter(self.directory.joinpath(key))
+
+    def __str__(self):
+        return f"directory {self.directory}"
+
+
+class LocalWriter():
+    """
+    Writes a copy into <path>.part and renames it to <path> once it is
+    complete, keeping the holes
+    """
+
+    def __init__(self, path: Path):
+        self.path = str(path)
+        self.partial_path = f"{self.path}{PARTIAL_SUFFIX}"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.partial_path, "wb")
+
+    def write(self, data):
+        self._file.write(data)
+
+    def skip(self, length: int):
+        self._file.seek(length, os.SEEK_CUR)
+
+    def commit(self):
+        # Extends the file when it ends with a hole
+        self._file.truncate()
+        self._file.close()
+        os.rename(self.partial_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.unlink(self.partial_path)
+        except FileNotFoundError:
+            pass
+
+
+class S3Backend():
+    """
+    Uploads the files to a bucket of an S3-compatible store
+    """
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint: str = "", region: str = "",
+                 access_key: str = "", secret_key: str = "", part_size: int = DEFAULT_PART_SIZE,
+                 concurrency: int = DEFAULT_CONCURRENCY, client=None):
+        """
+        Parameters
+        ----------
+        bucket : str
+            bucket of the copies
+        prefix : str
+            prefix of the keys of the copies
+        endpoint : str
+            URL of the store, the one of AWS when empty
+        region : str
+            region of the bucket
+        access_key, secret_key : str
+            credentials, taken from the environment or the AWS config files
+            when empty
+        part_size : int
+            bytes of every uploaded part
+        concurrency : int
+            parts of every file uploaded at the same time
+        client :
+            S3 client, created from the parameters when it is not given
+        """
+
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.part_size = max(int(part_size), MIN_PART_SIZE)
+        self.concurrency = max(int(concurrency), 1)
+        self._client = client
+        if client is None:
+            # The exports of every worker share the connections of the client
+            self._client = boto3.client(
+                "s3", endpoint_url=endpoint or None, region_name=region or None,
+                aws_access_key_id=access_key or None, aws_secret_access_key=secret_key or None,
+                config=BotoConfig(max_pool_connections=max(10, self.concurrency * 4)))
+
+    def open_writer(self, key: str):
+        key = f"{self.prefix}/{key}" if self.prefix else key
+        return S3Writer(self._client, self.bucket, key, self.part_size, self.concurrency)
+
+    def __str__(self):
+        return f"bucket {self.bucket}" + (f" ({self.prefix})" if self.prefix else "")
+
+
+class S3Writer():
+    """
+    Streams a copy into a multipart upload
+
+    The written bytes are gathered into parts of `part_size` bytes that are
+    uploaded by `concurrency` threads. A write waits when all of them are
+    busy, so the memory of the writer is bounded. The files smaller than a
+    part are uploaded with a single request.
+    """
+
+    def __init__(self, client, bucket: str, key: str, part_size: int, concurrency: int):
+        self.bucket = bucket
+        self.key = key
+        self._client = client
+        self._part_size = part_size
+        self._concurrency = concurrency
+        self._chunks = []
+        self._buffered = 0
+        self._upload_id = None
+        self._parts = {}
+        self._futures = []
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._error = None
+
+    def write(self, data):
+        self._check_error()
+        data = memoryview(data).cast("B")
+        position = 0
+        while position < len(data):
+            length = min(len(data) - position, self._current_part_size() - self._buffered)
+            self._chunks.append(bytes(data[position:position + length]))
+            self._buffered += length
+            position += length
+            if self._buffered == self._current_part_size():
+                self._upload_part()
+
+    def skip(self, length: int):
+        """ Objects have no holes, the zeros are uploaded """
+        zeros = bytes(min(length, ZERO_BLOCK_SIZE))
+        while length > 0:
+            self.write(zeros[:length] if length < len(zeros) else zeros)
+            length -= len(zeros)
+
+    def commit(self):
+        """ Uploads the buffered bytes and completes the upload """
+        try:
+            if self._upload_id is None:
+                self._client.put_object(Bucket=self.bucket, Key=self.key, Body=self._take_buffer())
+                return
+            if self._buffered:
+                self._upload_part()
+            self._wait()
+            self._check_error()
+            parts = [{"PartNumber": number, "ETag": etag} for number, etag in sorted(self._parts.items())]
+            self._client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                MultipartUpload={"Parts": parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._shutdown()
+
+    def abort(self):
+        """ Stops the upload and discards the uploaded parts """
+        for future in self._futures:
+            future.cancel()
+        self._wait()
+        self._shutdown()
+        self._chunks = []
+        self._buffered = 0
+        if self._upload_id is not None:
+            upload_id, self._upload_id = self._upload_id, None
+            try:
+                self._client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=upload_id)
+            except Exception as e:
+                logger.warning(f"Could not abort the upload of {self.key}: {e!r}")
+
+    def _current_part_size(self) -> int:
+        return self._part_size << len(self._futures) // PART_SIZE_STEP
+
+    def _take_buffer(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        self._buffered = 0
+        return data
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            response = self._client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self._upload_id = response["UploadId"]
+            self._executor = ThreadPoolExecutor(max_workers=self._concurrency,
+                                                thread_name_prefix="offsite-upload")
+        number = len(self._futures) + 1
+        if number > MAX_PARTS:
+            raise ValueError(f"The copy {self.key} needs more than {MAX_PARTS} parts")
+        # Waits for a free upload thread, so at most `concurrency` parts
+        # are held besides the buffer
+        self._slots.acquire()
+        self._check_error(release=True)
+        future = self._executor.submit(self._send_part, number, self._take_buffer())
+        future.add_done_callback(self._part_done)
+        self._futures.append(future)
+
+    def _send_part(self, number: int, data: bytes):
+        response = self._client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                            PartNumber=number, Body=data)
+        self._parts[number] = response["ETag"]
+
+    def _part_done(self, future):
+        self._slots.release()
+        if not future.cancelled() and future.exception() is not None and self._error is None:
+            self._error = future.exception()
+
+    def _check_error(self, release: bool = False):
+        if self._error is not None:
+            if release:
+                self._slots.release()
+            raise OSError(f"Upload of {self.key} failed: {self._error!r}") from self._error
+
+    def _wait(self):
+        for future in self._futures:
+            if not future.cancelled():
+                try:
+                    future.result()
+                except Exception:
+                    pass
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
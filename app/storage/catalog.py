@@ -0,0 +1,319 @@
+"""
+Catalog of the backups stored in a backup directory
+
+Every completed export is recorded in a SQLite database in the root of the
+backup directory, so the base and diff chains of an image can be queried
+without walking the directory tree. The snapshots created by the backups of
+the directory are recorded as well, so only those are ever removed as
+leftovers: the pool may also be backed up by other configs.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import re
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+CATALOG_FILE_NAME = "catalog.sqlite"
+
+FULL = "full"
+DIFF = "diff"
+
+# <image>_<timestamp>.img[.suffix] and diff_<image>_<timestamp>.img[.suffix], where
+# the suffix is the one of a compressed file or a chunk manifest
+BACKUP_FILE_PATTERN = re.compile(
+    r"^(?P<diff>diff_)?(?P<image>.+)_(?P<timestamp>\d{8}-\d+)\.img(\.(zst|lz4|chunks))?$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pool TEXT NOT NULL,
+    image TEXT NOT NULL,
+    type TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    parent_id INTEGER REFERENCES backups (id),
+    snapshot TEXT,
+    from_snapshot TEXT,
+    logical_bytes INTEGER,
+    allocated_bytes INTEGER,
+    bytes_written INTEGER,
+    started_at REAL,
+    duration REAL,
+    checksum TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS backups_image ON backups (pool, image, timestamp);
+CREATE TABLE IF NOT EXISTS snapshot_references (
+    pool TEXT NOT NULL,
+    image TEXT NOT NULL,
+    snapshot TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (pool, image)
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    pool TEXT NOT NULL,
+    image TEXT NOT NULL,
+    snapshot TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (pool, image, snapshot)
+);
+"""
+
+COLUMNS = [
+    "id", "pool", "image", "type", "timestamp", "path", "parent_id", "snapshot",
+    "from_snapshot", "logical_bytes", "allocated_bytes", "bytes_written",
+    "started_at", "duration", "checksum", "created_at"]
+
+
+class Catalog():
+    """
+    SQLite catalog of a backup directory
+
+    The catalog can be shared by several threads. Every record is written in
+    its own transaction, once the exported file is complete.
+    """
+
+    def __init__(self, backup_dir: str):
+        """
+        Parameters
+        ----------
+        backup_dir : str
+            root of the backup directory. The catalog is stored inside it
+        """
+
+        self._backup_dir = Path(backup_dir)
+        path = self._backup_dir.joinpath(CATALOG_FILE_NAME)
+        is_new = not path.exists()
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.executescript(SCHEMA)
+
+        if is_new:
+            self.import_tree()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def add_backup(self, pool: str, image: str, backup_type: str, timestamp: str, path: str,
+                   parent_id: int = None, snapshot: str = None, from_snapshot: str = None,
+                   logical_bytes: int = None, allocated_bytes: int = None,
+                   bytes_written: int = None, started_at: float = None,
+                   duration: float = None, checksum: str = None, replaces: list = None,
+                   reference: bool = False) -> int:
+        """
+        Records a completed backup
+
+        Parameters
+        ----------
+        pool : str
+            name of the pool
+        image : str
+            name of the image
+        backup_type : str
+            "full" or "diff"
+        timestamp : str
+            timestamp of the backup
+        path : str
+            path of the exported file
+        parent_id : int
+            id of the base backup of a diff
+        replaces : list
+            ids of the backups superseded by this one (a compacted range of
+            diffs). They are removed in the same transaction
+        reference : bool
+            record `snapshot` as the reference snapshot of the next diff of
+            the image, in the same transaction
+
+        Returns
+        -------
+        int
+            id of the new record
+        """
+
+        values = {
+            "pool": pool, "image": image, "type": backup_type, "timestamp": timestamp,
+            "path": self._relative_path(path), "parent_id": parent_id, "snapshot": snapshot,
+            "from_snapshot": from_snapshot, "logical_bytes": logical_bytes,
+            "allocated_bytes": allocated_bytes, "bytes_written": bytes_written,
+            "started_at": started_at, "duration": duration, "checksum": checksum,
+            "created_at": time.time()
+        }
+        columns = ", ".join(values)
+        placeholders = ", ".join(f":{column}" for column in values)
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                f"INSERT OR REPLACE INTO backups ({columns}) VALUES ({placeholders})", values)
+            backup_id = cursor.lastrowid
+            for old_id in replaces or []:
+                self._db.execute("UPDATE backups SET parent_id = ? WHERE parent_id = ?", (backup_id, old_id))
+                self._db.execute("DELETE FROM backups WHERE id = ?", (old_id,))
+            if reference:
+                self._set_reference(pool, image, snapshot)
+            return backup_id
+
+    def remove_backup(self, backup_id: int):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM backups WHERE id = ?", (backup_id,))
+
+    def get_backup(self, backup_id: int) -> dict:
+        rows = self._query("SELECT * FROM backups WHERE id = ?", (backup_id,))
+        return rows[0] if rows else None
+
+    def list_backups(self, pool: str = None, image: str = None, backup_type: str = None) -> list:
+        """
+        Returns the backups that match the given filters, sorted by pool,
+        image and timestamp
+        """
+
+        conditions = []
+        params = []
+        for column, value in (("pool", pool), ("image", image), ("type", backup_type)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._query(f"SELECT * FROM backups {where} ORDER BY pool, image, timestamp, type DESC", params)
+
+    def get_reference(self, pool: str, image: str) -> str:
+        """ Returns the reference snapshot of the next diff of an image, None when it has none """
+        rows = self._query("SELECT snapshot FROM snapshot_references WHERE pool = ? AND image = ?",
+                           (pool, image))
+        return rows[0]["snapshot"] if rows else None
+
+    def set_reference(self, pool: str, image: str, snapshot: str):
+        with self._lock, self._db:
+            self._set_reference(pool, image, snapshot)
+
+    def remove_reference(self, pool: str, image: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM snapshot_references WHERE pool = ? AND image = ?", (pool, image))
+
+    def _set_reference(self, pool: str, image: str, snapshot: str):
+        self._db.execute(
+            "INSERT OR REPLACE INTO snapshot_references (pool, image, snapshot, updated_at) VALUES (?, ?, ?, ?)",
+            (pool, image, snapshot, time.time()))
+
+    def add_snapshot(self, pool: str, image: str, snapshot: str):
+        """ Records a snapshot created by a backup """
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO snapshots (pool, image, snapshot, created_at) VALUES (?, ?, ?, ?)",
+                (pool, image, snapshot, time.time()))
+
+    def remove_snapshot(self, pool: str, image: str, snapshot: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM snapshots WHERE pool = ? AND image = ? AND snapshot = ?",
+                             (pool, image, snapshot))
+
+    def list_snapshots(self, pool: str, image: str) -> set:
+        """
+        Returns the names of the snapshots of an image created by the backups
+        of the directory: the recorded ones and the ones of its backups
+        """
+
+        rows = self._query("SELECT snapshot FROM snapshots WHERE pool = ? AND image = ? UNION "
+                           "SELECT snapshot FROM backups WHERE pool = ? AND image = ? AND snapshot IS NOT NULL",
+                           (pool, image, pool, image))
+        return {row["snapshot"] for row in rows}
+
+    def list_images(self) -> list:
+        """ Returns a list of (pool, image) with at least one backup """
+        with self._lock:
+            rows = self._db.execute("SELECT DISTINCT pool, image FROM backups ORDER BY pool, image")
+            return [(row["pool"], row["image"]) for row in rows]
+
+    def get_latest_full(self, pool: str, image: str, at: str = None) -> dict:
+        """
+        Returns the most recent full backup of an image taken at or before
+        `at` (any time when it is None)
+        """
+
+        query = "SELECT * FROM backups WHERE pool = ? AND image = ? AND type = ?"
+        params = [pool, image, FULL]
+        if at is not None:
+            query += " AND timestamp <= ?"
+            params.append(at)
+        rows = self._query(query + " ORDER BY timestamp DESC, id DESC LIMIT 1", params)
+        return rows[0] if rows else None
+
+    def get_chain(self, pool: str, image: str, at: str = None) -> list:
+        """
+        Returns the backups needed to rebuild an image at a point in time: the
+        latest full backup taken at or before `at` followed by the diffs taken
+        after it, in order
+
+        Returns
+        -------
+        list
+            list of backups, empty when there is no base
+        """
+
+        base = self.get_latest_full(pool, image, at)
+        if base is None:
+            return []
+        # A diff taken in the same run as its base (same timestamp) is
+        # recorded after it and still has to be applied
+        query = ("SELECT * FROM backups WHERE pool = ? AND image = ? AND type = ? "
+                 "AND (timestamp > ? OR (timestamp = ? AND id > ?))")
+        params = [pool, image, DIFF, base["timestamp"], base["timestamp"], base["id"]]
+        if at is not None:
+            query += " AND timestamp <= ?"
+            params.append(at)
+        return [base] + self._query(query + " ORDER BY timestamp", params)
+
+    def absolute_path(self, backup: dict) -> Path:
+        return self._backup_dir.joinpath(backup["path"])
+
+    def import_tree(self):
+        """
+        Records the backups of a directory tree written before the catalog
+        existed, deducing them from the file names
+        """
+
+        imported = 0
+        for pool_dir in sorted(p for p in self._backup_dir.iterdir() if p.is_dir() and not p.name.startswith(".")):
+            for image_dir in sorted(p for p in pool_dir.iterdir() if p.is_dir()):
+                files = list(image_dir.iterdir())
+                diffs_dir = image_dir.joinpath("diffs")
+                if diffs_dir.is_dir():
+                    files += list(diffs_dir.iterdir())
+
+                parent_id = None
+                for path in sorted(files, key=lambda p: (self._file_timestamp(p), p.name.startswith("diff_"))):
+                    match = BACKUP_FILE_PATTERN.match(path.name)
+                    if not path.is_file() or match is None or match.group("image") != image_dir.name:
+                        continue
+                    backup_type = DIFF if match.group("diff") else FULL
+                    backup_id = self.add_backup(
+                        pool_dir.name, image_dir.name, backup_type, match.group("timestamp"), path,
+                        parent_id=parent_id if backup_type == DIFF else None,
+                        snapshot=match.group("timestamp"), bytes_written=path.stat().st_size)
+                    if backup_type == FULL:
+                        parent_id = backup_id
+                    imported += 1
+        if imported:
+            logger.info(f"Imported {imported} existing backups into the catalog")
+
+    @staticmethod
+    def _file_timestamp(path: Path) -> str:
+        match = BACKUP_FILE_PATTERN.match(path.name)
+        return match.group("timestamp") if match else ""
+
+    def _relative_path(self, path) -> str:
+        path = Path(path)
+        try:
+            return str(path.relative_to(self._backup_dir))
+        except ValueError:
+            return str(path)
+
+    def _query(self, query: str, params=()) -> list:
+        with self._lock:
+            return [dict(row) for row in self._db.execute(query, params)]
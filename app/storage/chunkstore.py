@@ -0,0 +1,419 @@
+"""
+Content-defined chunk deduplication store
+
+The export streams are split in chunks whose boundaries depend on the data,
+so the same content produces the same chunks whatever image or backup it
+comes from. Every chunk is stored once, named by its BLAKE2b hash, and every
+backup only keeps a small manifest with the list of its chunks:
+
+    store/
+        index.sqlite          hash -> size of every stored chunk
+        chunks/ab/abcd...     chunk files (1 byte header + data)
+
+Manifest format (little endian):
+
+    b"ONBCHNK1", le64 logical size
+    for every chunk: 32 bytes hash, le64 length
+
+A hash of 32 zero bytes means a run of zeros that is not stored.
+
+Disk images are written in filesystem blocks, so the chunk boundaries are
+chosen among the 4 KiB block boundaries: a chunk ends after a block whose
+crc32 matches the boundary mask (between a minimum and a maximum chunk size).
+This keeps the boundaries content-defined while only hashing once per block.
+
+A chunk is only recorded in the index once its file and its directory entry
+are durable: the later backups never write a chunk of the index again.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import bisect
+import struct
+import hashlib
+import sqlite3
+import threading
+import zlib
+from pathlib import Path
+
+from .files import sync_directory, PARTIAL_SUFFIX
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+MANIFEST_MAGIC = b"ONBCHNK1"
+MANIFEST_SUFFIX = ".chunks"
+HASH_SIZE = 32
+ZERO_HASH = bytes(HASH_SIZE)
+BLOCK_SIZE = 4096
+DEFAULT_CHUNK_SIZE = 256 * 1024
+INDEX_BATCH = 1024
+
+CHUNK_RAW = b"\x00"
+CHUNK_ZSTD = b"z"
+CHUNK_LZ4 = b"l"
+
+
+def chunk_hash(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=HASH_SIZE).digest()
+
+
+class ChunkStore():
+    """
+    Stores unique chunks on disk with a SQLite index of the stored hashes
+
+    The store can be shared by several threads.
+    """
+
+    def __init__(self, root: str, codec: str = "none", level: int = 3):
+        """
+        Parameters
+        ----------
+        root : str
+            directory of the store
+        codec : str
+            "none", "zstd" or "lz4". Codec used to compress the new chunks
+        level : int
+            compression level of the codec
+        """
+
+        self.root = Path(root)
+        self._chunks_dir = self.root.joinpath("chunks")
+        self._chunks_dir.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.root.joinpath("index.sqlite")), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (hash BLOB PRIMARY KEY, size INTEGER NOT NULL) WITHOUT ROWID")
+        self._db.commit()
+        self._pending = {}
+        # Directories of the pending chunks, synced before the index commit
+        self._pending_dirs = set()
+
+        self._codec = codec
+        self._level = level
+
+    def contains(self, digest: bytes) -> bool:
+        with self._lock:
+            if digest in self._pending:
+                return True
+            row = self._db.execute("SELECT 1 FROM chunks WHERE hash = ?", (digest,)).fetchone()
+            return row is not None
+
+    def put(self, digest: bytes, data) -> int:
+        """
+        Stores a chunk if it is not already in the store
+
+        Returns
+        -------
+        int
+            number of bytes written to disk (0 for a duplicated chunk)
+        """
+
+        if self.contains(digest):
+            return 0
+
+        path = self._chunk_path(digest)
+        try:
+            path.parent.mkdir()
+            sync_directory(str(self._chunks_dir))
+        except FileExistsError:
+            pass
+        payload = self._encode(data)
+        tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._pending[digest] = len(data)
+            self._pending_dirs.add(str(path.parent))
+            if len(self._pending) >= INDEX_BATCH:
+                self._commit()
+        return len(payload)
+
+    def get(self, digest: bytes) -> bytes:
+        with open(self._chunk_path(digest), "rb") as f:
+            payload = f.read()
+        header, data = payload[:1], payload[1:]
+        if header == CHUNK_ZSTD:
+            return zstandard.ZstdDecompressor().decompress(data)
+        if header == CHUNK_LZ4:
+            return lz4.frame.decompress(data)
+        return data
+
+    def flush(self):
+        """ Writes the hashes of the new chunks into the index """
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def _commit(self):
+        if self._pending:
+            for directory in self._pending_dirs:
+                sync_directory(directory)
+            self._pending_dirs = set()
+            self._db.executemany("INSERT OR IGNORE INTO chunks (hash, size) VALUES (?, ?)",
+                                 self._pending.items())
+            self._db.commit()
+            self._pending = {}
+
+    def _chunk_path(self, digest: bytes) -> Path:
+        name = digest.hex()
+        return self._chunks_dir.joinpath(name[:2], name)
+
+    def _encode(self, data) -> bytes:
+        if self._codec == "zstd":
+            # Compressors can not be shared between threads
+            return CHUNK_ZSTD + zstandard.ZstdCompressor(level=self._level).compress(data)
+        if self._codec == "lz4":
+            return CHUNK_LZ4 + lz4.frame.compress(data, compression_level=self._level)
+        return CHUNK_RAW + data
+
+
+class ChunkSink():
+    """
+    Splits an export stream in chunks, stores the new ones in a ChunkStore
+    and writes the manifest of the stream
+    """
+
+    def __init__(self, store: ChunkStore, path: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 resume: dict = None):
+        """
+        Parameters
+        ----------
+        store : ChunkStore
+            store where the chunks are saved
+        path : str
+            path of the manifest. It is written into <path>.part until it
+            is complete
+        chunk_size : int
+            average size in bytes of the chunks
+        resume : dict
+            state returned by checkpoint() to continue a partial manifest
+        """
+
+        self.path = str(path)
+        self._store = store
+        blocks = max(1, int(chunk_size) // BLOCK_SIZE)
+        self._mask = (1 << max(0, blocks.bit_length() - 1)) - 1
+        self._min_size = max(BLOCK_SIZE, (blocks // 4) * BLOCK_SIZE)
+        self._max_size = blocks * 4 * BLOCK_SIZE
+        self._zero_chunk = bytes(self._max_size)
+
+        self.partial_path = f"{self.path}{PARTIAL_SUFFIX}"
+        self._buffer = bytearray()
+        self._zero_run = 0
+        self.bytes_in = 0
+        self.bytes_written = 0
+        self.chunks = 0
+        self.new_chunks = 0
+        if resume is None:
+            self._file = open(self.partial_path, "wb")
+            self._file.write(MANIFEST_MAGIC + struct.pack("<Q", 0))
+        else:
+            self._file = open(self.partial_path, "r+b")
+            self._file.truncate(resume["manifest_size"])
+            self._file.seek(resume["manifest_size"])
+            for counter in ("bytes_in", "bytes_written", "chunks", "new_chunks"):
+                setattr(self, counter, resume[counter])
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self._buffer += data
+        self._cut_chunks(final=False)
+
+    def skip(self, length: int):
+        """ Holes are stored as zero runs in the manifest """
+        self._cut_chunks(final=True)
+        self.bytes_in += length
+        self._zero_run += length
+
+    def checkpoint(self) -> dict:
+        """
+        Stores the buffered data as a chunk and makes the manifest durable.
+        Returns the state needed to resume it
+        """
+
+        self._cut_chunks(final=True)
+        self._flush_zero_run()
+        self._store.flush()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return {"manifest_size": self._file.tell(), "bytes_in": self.bytes_in,
+                "bytes_written": self.bytes_written, "chunks": self.chunks,
+                "new_chunks": self.new_chunks}
+
+    def close(self, before_rename=None):
+        self._cut_chunks(final=True)
+        self._flush_zero_run()
+        self._store.flush()
+        self._file.seek(len(MANIFEST_MAGIC))
+        self._file.write(struct.pack("<Q", self.bytes_in))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        if before_rename is not None:
+            before_rename(self.partial_path)
+        os.rename(self.partial_path, self.path)
+        sync_directory(os.path.dirname(self.path) or ".")
+        self.bytes_written += os.path.getsize(self.path)
+
+    def suspend(self):
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.unlink(self.partial_path)
+        except FileNotFoundError:
+            pass
+
+    def _cut_chunks(self, final: bool):
+        """
+        Stores every complete chunk of the buffer. With `final` the remaining
+        data is also stored as the last chunk
+        """
+
+        buffer = self._buffer
+        view = memoryview(buffer)
+        start = 0
+        position = start + self._min_size
+        length = len(buffer)
+        while position <= length:
+            end = self._find_boundary(view, start, position, length)
+            if end is None:
+                break
+            self._add_chunk(view[start:end])
+            start = end
+            position = start + self._min_size
+        if final and start < length:
+            self._add_chunk(view[start:length])
+            start = length
+        view.release()
+        del buffer[:start]
+
+    def _find_boundary(self, view, start: int, position: int, length: int):
+        """
+        Returns the end of the chunk that begins at `start`, or None when
+        the buffer does not contain a complete chunk yet
+        """
+
+        limit = min(start + self._max_size, length)
+        position -= BLOCK_SIZE
+        while position + BLOCK_SIZE <= limit:
+            position += BLOCK_SIZE
+            if zlib.crc32(view[position - BLOCK_SIZE:position]) & self._mask == 0:
+                return position
+        if start + self._max_size <= length:
+            return start + self._max_size
+        return None
+
+    def _add_chunk(self, view):
+        chunk = view.tobytes()
+        if self._zero_chunk.startswith(chunk):
+            self._zero_run += len(chunk)
+            return
+        self._flush_zero_run()
+        digest = chunk_hash(chunk)
+        written = self._store.put(digest, chunk)
+        self.bytes_written += written
+        self.chunks += 1
+        if written:
+            self.new_chunks += 1
+        self._file.write(digest + struct.pack("<Q", len(chunk)))
+
+    def _flush_zero_run(self):
+        if self._zero_run:
+            self._file.write(ZERO_HASH + struct.pack("<Q", self._zero_run))
+            self._zero_run = 0
+
+
+class ChunkReader():
+    """
+    Reads the stream of a manifest written by ChunkSink
+    """
+
+    def __init__(self, store: ChunkStore, path: str):
+        self.path = str(path)
+        self._store = store
+        with open(self.path, "rb") as f:
+            content = f.read()
+        if content[:len(MANIFEST_MAGIC)] != MANIFEST_MAGIC:
+            raise ValueError(f"{self.path} is not a chunk manifest")
+        self.size = struct.unpack_from("<Q", content, len(MANIFEST_MAGIC))[0]
+
+        # (offset, length, hash) of every entry
+        self.entries = []
+        self._offsets = []
+        # Last chunk read by read_at, as (hash, data)
+        self._cached = (None, None)
+        offset = 0
+        entry_size = HASH_SIZE + 8
+        for position in range(len(MANIFEST_MAGIC) + 8, len(content), entry_size):
+            digest = content[position:position + HASH_SIZE]
+            length = struct.unpack_from("<Q", content, position + HASH_SIZE)[0]
+            self.entries.append((offset, length, digest))
+            self._offsets.append(offset)
+            offset += length
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def iter_chunks(self, zero_size: int = 4 * 1024 * 1024):
+        """ Yields the stream in order. Zero runs are yielded in pieces of `zero_size` """
+        zero_block = bytes(zero_size)
+        for _, length, digest in self.entries:
+            if digest == ZERO_HASH:
+                while length > 0:
+                    n = min(length, zero_size)
+                    yield zero_block[:n] if n < zero_size else zero_block
+                    length -= n
+            else:
+                yield self._store.get(digest)
+
+    def read_at(self, offset: int, length: int) -> bytes:
+        """ Returns `length` bytes of the stream starting at `offset` """
+        data = bytearray()
+        index = max(bisect.bisect_right(self._offsets, offset) - 1, 0)
+        for entry_offset, entry_length, digest in self.entries[index:]:
+            if entry_offset + entry_length <= offset:
+                continue
+            if entry_offset >= offset + length:
+                break
+            start = max(offset - entry_offset, 0)
+            n = min(entry_length - start, length - len(data))
+            if digest == ZERO_HASH:
+                data += bytes(n)
+            else:
+                data += self._get(digest)[start:start + n]
+        return bytes(data)
+
+    def _get(self, digest: bytes) -> bytes:
+        cached_digest, chunk = self._cached
+        if cached_digest != digest:
+            chunk = self._store.get(digest)
+            self._cached = (digest, chunk)
+        return chunk
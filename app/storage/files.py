@@ -0,0 +1,347 @@
+"""
+Files where the exports are written
+
+The exported files are written sequentially, once, and are not read again
+by the backup server. The writer of a file can be tuned so the exports do
+not fill the page cache and do not leave gigabytes of dirty pages behind:
+
+    backup:
+      export:
+        preallocate: False      # reserve the size of the image up front
+        cache: keep             # keep, dontneed or direct
+        sync_interval: 0        # bytes written between syncs (0 only at the end)
+
+    preallocate     reserves the blocks of an uncompressed full export with
+                    fallocate from the size of the image, so the file is not
+                    fragmented. The holes of a sparse export take space
+    keep            writes through the page cache
+    dontneed        drops the pages of the file from the page cache once
+                    they are synced (posix_fadvise DONTNEED), every
+                    sync_interval bytes (64 MiB when it is 0)
+    direct          writes with O_DIRECT from an aligned buffer, bypassing
+                    the page cache. Falls back to dontneed on the
+                    filesystems without O_DIRECT
+    sync_interval   syncs the file every sync_interval bytes, so the dirty
+                    pages are written back while the export runs instead of
+                    in a long stall at the end
+
+Whatever the writer, an export is only complete once its file is synced,
+renamed from <path>.part to <path> and the rename is synced.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import mmap
+import errno
+import ctypes
+
+CACHE_MODES = ["keep", "dontneed", "direct"]
+
+# Suffix of the files being written, until commit_file renames them
+PARTIAL_SUFFIX = ".part"
+
+# Alignment of the offsets, lengths and buffers of the O_DIRECT writes
+DIRECT_ALIGNMENT = 4096
+# Bytes gathered before every O_DIRECT write
+DIRECT_BUFFER_SIZE = 8 * 1024 * 1024
+# Bytes between the syncs of the dontneed writer without sync interval
+DONTNEED_SYNC_INTERVAL = 64 * 1024 * 1024
+
+_ZEROS = bytes(DIRECT_ALIGNMENT)
+_fallocate = None
+
+
+def check_cache(cache: str):
+    """
+    Raises
+    ------
+    ValueError
+        when the cache mode is unknown or not supported
+    """
+
+    if cache not in CACHE_MODES:
+        raise ValueError(f"Export cache \"{cache}\" not allowed, please use {CACHE_MODES}")
+    if cache == "direct" and not hasattr(os, "O_DIRECT"):
+        raise ValueError("The direct export cache requires O_DIRECT")
+    if cache == "dontneed" and not hasattr(os, "posix_fadvise"):
+        raise ValueError("The dontneed export cache requires posix_fadvise")
+
+
+def open_file(path: str, resume_size: int = None, size: int = None, cache: str = "keep",
+              sync_interval: int = 0):
+    """
+    Opens a file to write an export
+
+    Parameters
+    ----------
+    path : str
+        path of the file
+    resume_size : int
+        size of the file to continue, None to create it
+    size : int
+        bytes to preallocate, None to not preallocate
+    cache : str
+        cache mode of the writes
+    sync_interval : int
+        bytes written between syncs, 0 to only sync when asked
+
+    Returns
+    -------
+    BufferedFile or DirectFile
+    """
+
+    if cache == "dontneed" and not sync_interval:
+        sync_interval = DONTNEED_SYNC_INTERVAL
+    flags = os.O_WRONLY | os.O_CREAT
+    if resume_size is None:
+        flags |= os.O_TRUNC
+    fd = os.open(path, flags, 0o666)
+    try:
+        if resume_size is not None:
+            os.ftruncate(fd, resume_size)
+        if size:
+            _preallocate(fd, size, path)
+        if cache != "direct":
+            return BufferedFile(fd, resume_size or 0, cache == "dontneed", sync_interval)
+        tail = _read_tail(path, resume_size or 0)
+        try:
+            direct_fd = os.open(path, os.O_WRONLY | os.O_DIRECT)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            logger.warning(f"O_DIRECT not supported for {path}, dropping its pages from the cache instead")
+            return BufferedFile(fd, resume_size or 0, True, sync_interval or DONTNEED_SYNC_INTERVAL)
+        os.close(fd)
+        return DirectFile(direct_fd, resume_size or 0, tail, sync_interval)
+    except Exception:
+        os.close(fd)
+        raise
+
+
+def commit_file(partial_path: str, path: str):
+    """
+    Completes a file written into `partial_path`: syncs it, renames it to
+    `path` and syncs the rename
+    """
+
+    fd = os.open(partial_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(partial_path, path)
+    sync_directory(os.path.dirname(path) or ".")
+
+
+def sync_directory(directory: str):
+    """ Makes the entries created or renamed in a directory durable """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class BufferedFile():
+    """
+    Writes a file through the page cache
+
+    The file is synced every `sync_interval` bytes, and with `dontneed` the
+    synced pages are dropped from the page cache.
+    """
+
+    def __init__(self, fd: int, position: int, dontneed: bool = False, sync_interval: int = 0):
+        self._fd = fd
+        self._file = os.fdopen(fd, "wb")
+        self._file.seek(position)
+        self._dontneed = dontneed
+        self._sync_interval = int(sync_interval)
+        self._unsynced = 0
+        self._dropped = position
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def write(self, data):
+        self._file.write(data)
+        if self._sync_interval:
+            self._unsynced += len(data)
+            if self._unsynced >= self._sync_interval:
+                self._sync(metadata=False)
+
+    def skip(self, length: int):
+        self._file.seek(length, os.SEEK_CUR)
+
+    def sync(self) -> int:
+        """ Makes the written bytes durable, returns the size of the file """
+        self._extend()
+        self._sync(metadata=True)
+        return self._file.tell()
+
+    def finish(self):
+        """ Truncates the file to the written bytes, syncs and closes it """
+        self._file.truncate()
+        self._sync(metadata=True)
+        self._file.close()
+
+    def close(self):
+        self._file.close()
+
+    def _extend(self):
+        """ Extends the file when it ends with a hole, keeping the preallocated size """
+        if os.fstat(self._fd).st_size < self._file.tell():
+            self._file.truncate()
+
+    def _sync(self, metadata: bool):
+        self._file.flush()
+        if metadata:
+            os.fsync(self._fd)
+        else:
+            os.fdatasync(self._fd)
+        self._unsynced = 0
+        if self._dontneed:
+            position = self._file.tell()
+            if position > self._dropped:
+                os.posix_fadvise(self._fd, self._dropped, position - self._dropped, os.POSIX_FADV_DONTNEED)
+            self._dropped = position
+
+
+class DirectFile():
+    """
+    Writes a file with O_DIRECT
+
+    The stream is gathered into a buffer aligned on DIRECT_ALIGNMENT bytes
+    that is written at aligned offsets. A hole spanning whole aligned blocks
+    is left unwritten, its unaligned edges are written as zeros. The
+    unaligned end of the stream is written padded and the file truncated.
+    """
+
+    def __init__(self, fd: int, position: int, tail: bytes = b"", sync_interval: int = 0):
+        """
+        Parameters
+        ----------
+        fd : int
+            file descriptor opened with O_DIRECT
+        position : int
+            offset where the stream continues
+        tail : bytes
+            bytes of the file from the aligned offset before `position`
+        sync_interval : int
+            bytes written between syncs
+        """
+
+        self._fd = fd
+        # Anonymous maps are aligned on pages
+        self._buffer = mmap.mmap(-1, DIRECT_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._start = position - len(tail)
+        self._filled = len(tail)
+        self._view[:len(tail)] = tail
+        self._sync_interval = int(sync_interval)
+        self._unsynced = 0
+
+    def tell(self) -> int:
+        return self._start + self._filled
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        position = 0
+        while position < len(data):
+            length = min(len(data) - position, DIRECT_BUFFER_SIZE - self._filled)
+            self._view[self._filled:self._filled + length] = data[position:position + length]
+            self._filled += length
+            position += length
+            if self._filled == DIRECT_BUFFER_SIZE:
+                self._flush()
+        if self._sync_interval:
+            self._unsynced += len(data)
+            if self._unsynced >= self._sync_interval:
+                self._flush()
+                os.fdatasync(self._fd)
+                self._unsynced = 0
+
+    def skip(self, length: int):
+        padding = min(length, -self.tell() % DIRECT_ALIGNMENT)
+        self.write(_ZEROS[:padding])
+        length -= padding
+        hole = length - length % DIRECT_ALIGNMENT
+        if hole:
+            self._flush()
+            self._start += hole
+        self.write(_ZEROS[:length - hole])
+
+    def sync(self) -> int:
+        """ Makes the written bytes durable, returns the size of the file """
+        self._flush(final=True)
+        position = self.tell()
+        if os.fstat(self._fd).st_size < position:
+            os.ftruncate(self._fd, position)
+        os.fsync(self._fd)
+        self._unsynced = 0
+        return position
+
+    def finish(self):
+        """ Truncates the file to the written bytes, syncs and closes it """
+        self._flush(final=True)
+        os.ftruncate(self._fd, self.tell())
+        os.fsync(self._fd)
+        self.close()
+
+    def close(self):
+        self._view.release()
+        self._buffer.close()
+        os.close(self._fd)
+
+    def _flush(self, final: bool = False):
+        """
+        Writes the aligned blocks of the buffer and keeps its unaligned tail.
+        The tail is also written, padded with zeros, when `final`
+        """
+
+        aligned = self._filled - self._filled % DIRECT_ALIGNMENT
+        length = aligned
+        if final and aligned < self._filled:
+            length = aligned + DIRECT_ALIGNMENT
+            self._view[self._filled:length] = _ZEROS[:length - self._filled]
+        written = 0
+        while written < length:
+            written += os.pwrite(self._fd, self._view[written:length], self._start + written)
+        tail = self._filled - aligned
+        if aligned:
+            self._view[:tail] = self._view[aligned:self._filled]
+            self._start += aligned
+            self._filled = tail
+
+
+def _read_tail(path: str, position: int) -> bytes:
+    """ Bytes of a file from the aligned offset before `position` """
+    start = position - position % DIRECT_ALIGNMENT
+    if start == position:
+        return b""
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(position - start)
+
+
+def _preallocate(fd: int, size: int, path: str):
+    """
+    Reserves the blocks of the first `size` bytes of a file. The filesystems
+    without fallocate are left alone, rather than filled with zeros like
+    posix_fallocate does
+    """
+
+    global _fallocate
+    if _fallocate is None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        _fallocate = getattr(libc, "fallocate64", None) or getattr(libc, "fallocate", None) or False
+        if _fallocate:
+            _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    if not _fallocate:
+        return
+    if _fallocate(fd, 0, 0, size) != 0:
+        error = ctypes.get_errno()
+        if error not in (errno.EOPNOTSUPP, errno.ENOSYS):
+            raise OSError(error, f"Could not preallocate {size} bytes: {os.strerror(error)}", path)
+        logger.debug(f"Preallocation not supported for {path}")
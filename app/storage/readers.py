@@ -0,0 +1,179 @@
+"""
+Readers of the stored backup files
+
+A backup can be stored as a raw file, a compressed file with a seek table or
+a chunk manifest. The three readers share the same interface:
+
+    size                    logical size of the stream
+    iter_chunks()           yields the stream in order
+    read_at(offset, length) random access
+    close()
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+
+from ..compression import SeekableReader, CODEC_SUFFIXES
+from .chunkstore import ChunkReader, MANIFEST_SUFFIX
+
+DEFAULT_READ_SIZE = 8 * 1024 * 1024
+
+
+class RawReader():
+    """
+    Reads a raw (maybe sparse) backup file
+    """
+
+    def __init__(self, path: str, read_size: int = DEFAULT_READ_SIZE):
+        self.path = str(path)
+        self._read_size = read_size
+        self._file = open(self.path, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def iter_chunks(self):
+        self._file.seek(0)
+        data = self._file.read(self._read_size)
+        while data:
+            yield data
+            data = self._file.read(self._read_size)
+
+    def read_at(self, offset: int, length: int) -> bytes:
+        return os.pread(self._file.fileno(), length, offset)
+
+    def iter_data_extents(self):
+        """
+        Yields the (offset, length) of the data extents of the file, skipping
+        its holes. The whole file is a data extent when the system does not
+        report holes
+        """
+
+        if not hasattr(os, "SEEK_DATA"):
+            yield 0, self.size
+            return
+
+        fd = self._file.fileno()
+        offset = 0
+        while offset < self.size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError:
+                # ENXIO: there is no more data after offset
+                return
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            yield start, end - start
+            offset = end
+
+    def iter_data_chunks(self):
+        """ Yields the (offset, data) of the data extents, in pieces of read_size """
+        for offset, length in self.iter_data_extents():
+            end = offset + length
+            while offset < end:
+                n = min(self._read_size, end - offset)
+                yield offset, self.read_at(offset, n)
+                offset += n
+
+
+class IteratorStream():
+    """
+    File-like object with a read(n) method over an iterator of byte chunks
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+        self._position = 0
+
+    def read(self, length: int = -1) -> bytes:
+        if length < 0:
+            data = self._buffer[self._position:] + b"".join(self._chunks)
+            self._buffer, self._position = b"", 0
+            return data
+        while len(self._buffer) - self._position < length:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer = self._buffer[self._position:] + chunk
+            self._position = 0
+        data = self._buffer[self._position:self._position + length]
+        self._position += len(data)
+        return data
+
+
+def open_backup(path: str, chunk_store=None, threads: int = 1):
+    """
+    Opens a stored backup with the reader that matches its format
+
+    Parameters
+    ----------
+    path : str
+        path of the stored file
+    chunk_store : ChunkStore
+        store of the chunks, needed for the chunk manifests
+    threads : int
+        number of frames decompressed at the same time
+
+    Returns
+    -------
+    RawReader, SeekableReader or ChunkReader
+    """
+
+    path = str(path)
+    if path.endswith(MANIFEST_SUFFIX):
+        if chunk_store is None:
+            raise ValueError(f"A chunk store is needed to read {path}")
+        return ChunkReader(chunk_store, path)
+    if any(path.endswith(suffix) for suffix in CODEC_SUFFIXES.values()):
+        return SeekableReader(path, threads)
+    return RawReader(path)
+
+
+def iter_data(reader, block_size: int = 64 * 1024):
+    """
+    Yields the (offset, data) pieces of a backup that are not zero-filled
+
+    Parameters
+    ----------
+    reader : RawReader, SeekableReader or ChunkReader
+        opened backup
+    block_size : int
+        size in bytes of the blocks checked for zeros
+    """
+
+    zero_block = bytes(block_size)
+    if isinstance(reader, RawReader):
+        # Only the data extents of a sparse file are read
+        chunks = reader.iter_data_chunks()
+    else:
+        chunks = _with_offsets(reader.iter_chunks())
+
+    for offset, data in chunks:
+        view = memoryview(data)
+        data_start = None
+        for position in range(0, len(data), block_size):
+            n = min(block_size, len(data) - position)
+            if data.startswith(zero_block if n == block_size else bytes(n), position):
+                if data_start is not None:
+                    yield offset + data_start, view[data_start:position]
+                    data_start = None
+            elif data_start is None:
+                data_start = position
+        if data_start is not None:
+            yield offset + data_start, view[data_start:]
+
+
+def _with_offsets(chunks):
+    offset = 0
+    for chunk in chunks:
+        yield offset, chunk
+        offset += len(chunk)
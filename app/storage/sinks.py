@@ -0,0 +1,232 @@
+"""
+Sinks where the backup streams are written
+
+Every sink has the same interface:
+
+    write(data)     appends data to the stream
+    skip(length)    appends a zero-filled hole
+    checkpoint()    makes the stream durable, returns the state to resume it
+    close()         completes the file. The sinks that rename a partial
+                    file call close(before_rename) with the partial path
+                    once it is complete and synced, before the rename
+    suspend()       closes keeping the incomplete file, to resume it later
+    abort()         closes and removes the incomplete file
+    path            path of the written file
+    bytes_written   bytes stored on disk
+
+The sinks are opened with the state returned by checkpoint() to resume an
+interrupted stream.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+
+from ..compression import CompressedSink, CODEC_SUFFIXES, DEFAULT_FRAME_SIZE
+from ..checksum import ChecksumSink, DEFAULT_BLOCK_SIZE
+from .chunkstore import ChunkSink, MANIFEST_SUFFIX, DEFAULT_CHUNK_SIZE
+from ..pipeline import QueuedSink, DEFAULT_QUEUE_BYTES
+from .files import open_file, sync_directory, PARTIAL_SUFFIX
+
+# Bytes read at a time to copy a resumed partial file to the offsite backend
+MIRROR_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+class FileSink():
+    """
+    Writes an export stream into a local file
+
+    The stream is written into <path>.part and renamed to <path> once it is
+    complete and synced, so an interrupted export never leaves a file that
+    looks like a backup. The stream can also be copied into the writer of an
+    offsite backend while it is written.
+    """
+
+    def __init__(self, path: str, resume: dict = None, mirror=None, file_config: dict = None,
+                 size: int = None):
+        """
+        Parameters
+        ----------
+        path : str
+            path of the file
+        resume : dict
+            state returned by checkpoint() to continue a partial file
+        mirror :
+            writer of the offsite copy of the file (see storage.backends)
+        file_config : dict
+            preallocate, cache and sync_interval options of the export
+            config (see storage.files)
+        size : int
+            expected size of the file, preallocated when enabled
+        """
+
+        file_config = file_config or {}
+        self.path = str(path)
+        self.partial_path = f"{self.path}{PARTIAL_SUFFIX}"
+        self._mirror = mirror
+        self.bytes_written = resume["bytes_written"] if resume is not None else 0
+        if resume is not None and mirror is not None:
+            self._copy_partial(resume["size"])
+        self._file = open_file(
+            self.partial_path, resume["size"] if resume is not None else None,
+            size if file_config.get("preallocate", False) else None,
+            file_config.get("cache", "keep"), int(file_config.get("sync_interval", 0)))
+
+    def write(self, data):
+        self._file.write(data)
+        self.bytes_written += len(data)
+        if self._mirror is not None:
+            self._mirror.write(data)
+
+    def skip(self, length: int):
+        """ Leaves a hole of `length` bytes in the file """
+        self._file.skip(length)
+        if self._mirror is not None:
+            self._mirror.skip(length)
+
+    def checkpoint(self) -> dict:
+        """ Makes the written stream durable and returns the state needed to resume it """
+        return {"size": self._file.sync(), "bytes_written": self.bytes_written}
+
+    def close(self, before_rename=None):
+        # Truncates the file to the end of the stream, which extends it when
+        # it ends with a hole, and syncs it
+        self._file.finish()
+        if before_rename is not None:
+            before_rename(self.partial_path)
+        # The file is not renamed until its copy is complete, a failed copy
+        # fails the export
+        if self._mirror is not None:
+            self._mirror.commit()
+        os.rename(self.partial_path, self.path)
+        sync_directory(os.path.dirname(self.path) or ".")
+
+    def suspend(self):
+        """ Closes the sink keeping the partial file, to resume it later """
+        self._file.close()
+        # The copy of a resumed file starts over from the partial file
+        if self._mirror is not None:
+            self._mirror.abort()
+
+    def abort(self):
+        """ Closes the sink and removes the incomplete file """
+        self._file.close()
+        if self._mirror is not None:
+            self._mirror.abort()
+        try:
+            os.unlink(self.partial_path)
+        except FileNotFoundError:
+            pass
+
+    def _copy_partial(self, size: int):
+        """ Copies the part of the file written before the interruption """
+        with open(self.partial_path, "rb") as f:
+            position = 0
+            while position < size:
+                data = f.read(min(size - position, MIRROR_BLOCK_SIZE))
+                if not data:
+                    break
+                self._mirror.write(data)
+                position += len(data)
+
+
+def open_sink(path: str, compression_config: dict = None, chunk_store=None,
+              chunk_size: int = DEFAULT_CHUNK_SIZE, checksum_config: dict = None,
+              resume: dict = None, offsite=None, pipeline=None,
+              queue_bytes: int = DEFAULT_QUEUE_BYTES, file_config: dict = None, size: int = None):
+    """
+    Opens the sink where a backup is written, adding the compression,
+    deduplication and checksum stages when they are enabled
+
+    Parameters
+    ----------
+    path : str
+        path of the file. The codec suffix is appended when the file is
+        compressed and the manifest suffix when it is deduplicated
+    compression_config : dict
+        compression section of the backup config
+    chunk_store : ChunkStore
+        chunk store of the deduplicated backups, None when disabled
+    chunk_size : int
+        average size in bytes of the chunks
+    checksum_config : dict
+        checksum section of the backup config. The stored bytes are hashed
+    resume : dict
+        state returned by the checkpoint() of a sink opened with the same
+        parameters, to continue its partial file
+    offsite : callable
+        opens the writer of the offsite copy of a file from its path, None
+        when there is no offsite copy. The deduplicated backups are not
+        copied
+    pipeline : Pipeline
+        pipeline of the export, None to write in the calling thread. The
+        checksum, compression and deduplication stages run in a transform
+        thread and the file is written by a write thread
+    queue_bytes : int
+        bytes queued before every stage of the pipeline
+    file_config : dict
+        preallocate, cache and sync_interval options of the export config
+    size : int
+        size of the exported image. The uncompressed files are preallocated
+        from it when enabled
+
+    Returns
+    -------
+    FileSink, CompressedSink, ChunkSink, ChecksumSink or QueuedSink
+    """
+
+    compression_config = compression_config or {}
+    codec = compression_config.get("codec", "none")
+    checksum_config = checksum_config or {}
+    with_checksum = checksum_config.get("algorithm", "none") != "none"
+
+    if chunk_store is not None:
+        # The manifest is hashed once it is complete
+        sink_resume = _inner_state(resume) if with_checksum else resume
+        sink = ChunkSink(chunk_store, f"{path}{MANIFEST_SUFFIX}", chunk_size, sink_resume)
+        sink = _add_checksum(sink, checksum_config, resume, inline=False)
+        if pipeline is None:
+            return sink
+        return QueuedSink(sink, pipeline.add_stage("transform"), pipeline.stages[0], queue_bytes)
+
+    if codec != "none":
+        compressed_resume, resume = resume, _inner_state(resume)
+        path = f"{path}{CODEC_SUFFIXES[codec]}"
+    file_resume = _inner_state(resume) if with_checksum else resume
+    mirror = offsite(path) if offsite is not None else None
+    try:
+        sink = FileSink(path, file_resume, mirror, file_config, size if codec == "none" else None)
+    except Exception:
+        if mirror is not None:
+            mirror.abort()
+        raise
+    transform = None
+    if pipeline is not None:
+        if codec != "none" or with_checksum:
+            transform = pipeline.add_stage("transform")
+        sink = QueuedSink(sink, pipeline.add_stage("write"), transform or pipeline.stages[0], queue_bytes)
+    sink = _add_checksum(sink, checksum_config, resume)
+    if codec != "none":
+        sink = CompressedSink(
+            sink, codec,
+            int(compression_config.get("level", 3)),
+            int(compression_config.get("threads", 2)),
+            int(compression_config.get("frame_size", DEFAULT_FRAME_SIZE)),
+            compressed_resume)
+    if transform is None:
+        return sink
+    return QueuedSink(sink, transform, pipeline.stages[0], queue_bytes)
+
+
+def _inner_state(state: dict) -> dict:
+    """ State of the sink wrapped by the sink of `state` """
+    return state["inner"] if state is not None else None
+
+
+def _add_checksum(sink, checksum_config: dict, resume: dict = None, inline: bool = True):
+    algorithm = checksum_config.get("algorithm", "none")
+    if algorithm == "none":
+        return sink
+    return ChecksumSink(sink, algorithm, int(checksum_config.get("block_size", DEFAULT_BLOCK_SIZE)),
+                        inline, resume)
@@ -0,0 +1,276 @@
+"""
+Verification of the stored backups against their checksums
+
+Every file recorded in the catalog is hashed again, block by block, by a
+pool of threads and compared with its sidecar file. The holes of the sparse
+files are not read, and the chunks referenced by the manifests of the
+deduplicated backups are checked against their names.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .. import checksum
+from ..scheduler import Scheduler
+from .catalog import Catalog
+from .chunkstore import ChunkStore, ChunkReader, MANIFEST_SUFFIX, ZERO_HASH, chunk_hash
+from .readers import RawReader
+
+
+def verify_images(backup_dir: str, pool: str, images: list, chunk_store_dir: str = None,
+                  workers: int = 1, threads: int = 0) -> list:
+    """
+    Verifies the backups of several images
+
+    Parameters
+    ----------
+    backup_dir : str
+        root of the backup directory
+    pool : str
+        pool of the backed up images
+    images : list
+        names of the images ('*' for every image of the pool in the catalog)
+    chunk_store_dir : str
+        directory of the chunk store of the deduplicated backups
+    workers : int
+        number of images verified at the same time
+    threads : int
+        number of blocks hashed at the same time (0 for one per core)
+
+    Returns
+    -------
+    list
+        list of JobResult, one per image
+    """
+
+    catalog = Catalog(backup_dir)
+    chunk_store = None
+    if chunk_store_dir and Path(chunk_store_dir).exists():
+        chunk_store = ChunkStore(chunk_store_dir)
+    try:
+        with Verifier(catalog, chunk_store, threads) as verifier:
+            return verifier.verify_images(pool, images, workers)
+    finally:
+        if chunk_store is not None:
+            chunk_store.close()
+        catalog.close()
+
+
+class VerifyStats():
+    """
+    Counters of the verification of an image
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.unchecked = 0
+        self.bytes_read = 0
+        self.chunks = 0
+
+    def __str__(self):
+        return (f"{self.files} files verified ({self.bytes_read} bytes read, {self.chunks} chunks), "
+                f"{self.unchecked} without checksum")
+
+
+class Verifier():
+    """
+    Checks the backups of the catalog against their checksums
+    """
+
+    def __init__(self, catalog, chunk_store=None, threads: int = 0):
+        """
+        Parameters
+        ----------
+        catalog : Catalog
+            catalog of the backup directory
+        chunk_store : ChunkStore
+            chunk store, needed to check the deduplicated backups
+        threads : int
+            number of blocks hashed at the same time (0 for one per core)
+        """
+
+        self._catalog = catalog
+        self._chunk_store = chunk_store
+        self._threads = int(threads) or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=self._threads, thread_name_prefix="verify")
+        # Chunks shared by several backups are checked once
+        self._checked_chunks = set()
+        self._chunks_lock = threading.Lock()
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def verify_images(self, pool: str, images: list, workers: int = 1) -> list:
+        """
+        Verifies the backups of several images at the same time
+
+        Returns
+        -------
+        list
+            list of JobResult, one per image
+        """
+
+        if len(images) == 1 and images[0] == '*':
+            images = [image for image_pool, image in self._catalog.list_images() if image_pool == pool]
+
+        scheduler = Scheduler(workers)
+        for image in images:
+            scheduler.submit(image, self.verify, pool, image)
+        return scheduler.run()
+
+    def verify(self, pool: str, image: str) -> VerifyStats:
+        """
+        Verifies every backup of an image
+
+        Raises
+        ------
+        ValueError
+            when a file is missing or does not match its checksum
+        """
+
+        backups = self._catalog.list_backups(pool, image)
+        if not backups:
+            raise LookupError(f"There is no backup of {pool}/{image}")
+
+        logger.info(f"VERIFY - START - {pool}/{image} - {len(backups)} files")
+        stats = VerifyStats()
+        errors = []
+        for backup in backups:
+            path = self._catalog.absolute_path(backup)
+            if not path.exists():
+                errors.append(f"{path} is missing")
+                continue
+            sidecar = checksum.read_sidecar(path)
+            if sidecar is None:
+                logger.warning(f"{path} has no checksum")
+                stats.unchecked += 1
+            else:
+                errors += self.verify_file(path, sidecar, stats)
+                if backup["checksum"] and backup["checksum"] != checksum.read_checksum(path):
+                    errors.append(f"{path}: the checksum of the catalog does not match its sidecar file")
+            if path.name.endswith(MANIFEST_SUFFIX):
+                errors += self.verify_chunks(path, stats)
+            stats.files += 1
+
+        for error in errors:
+            logger.error(f"VERIFY - {pool}/{image} - {error}")
+        if errors:
+            raise ValueError(f"{len(errors)} errors found: {errors[0]}")
+        logger.info(f"VERIFY - END - {pool}/{image} - {stats}")
+        return stats
+
+    def verify_file(self, path: Path, sidecar: dict, stats: VerifyStats = None) -> list:
+        """
+        Hashes a file again and compares it with its sidecar
+
+        Returns
+        -------
+        list
+            description of every mismatch
+        """
+
+        stats = stats or VerifyStats()
+        algorithm = sidecar["algorithm"]
+        block_size = int(sidecar["block_size"])
+        checksum.check_algorithm(algorithm)
+
+        size = os.path.getsize(path)
+        if size != sidecar["size"]:
+            return [f"{path}: {size} bytes, {sidecar['size']} expected"]
+
+        with RawReader(path) as reader:
+            extents = list(reader.iter_data_extents())
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                digests = self._hash_blocks(fd, size, block_size, algorithm, extents, stats)
+            finally:
+                os.close(fd)
+
+        errors = []
+        expected = sidecar["blocks"]
+        for index, digest in enumerate(digests):
+            if index >= len(expected) or digest != expected[index]:
+                errors.append(f"{path}: block {index} (offset {index * block_size}) does not match")
+        if len(expected) != len(digests):
+            errors.append(f"{path}: {len(digests)} blocks, {len(expected)} expected")
+        elif checksum.file_checksum(algorithm, expected, size) != sidecar["checksum"]:
+            errors.append(f"{path}: the checksum file is corrupted")
+        return errors
+
+    def verify_chunks(self, path: Path, stats: VerifyStats) -> list:
+        """ Checks that every chunk of a manifest is stored and matches its hash """
+        if self._chunk_store is None:
+            return [f"{path}: there is no chunk store to check its chunks"]
+
+        digests = []
+        with self._chunks_lock:
+            for _, _, digest in ChunkReader(self._chunk_store, path).entries:
+                if digest != ZERO_HASH and digest not in self._checked_chunks:
+                    self._checked_chunks.add(digest)
+                    digests.append(digest)
+
+        errors = []
+        for digest, error in self._map(self._check_chunk, digests):
+            stats.chunks += 1
+            if error:
+                errors.append(f"{path}: chunk {digest.hex()} {error}")
+        return errors
+
+    def _check_chunk(self, digest: bytes) -> tuple:
+        try:
+            data = self._chunk_store.get(digest)
+        except FileNotFoundError:
+            return digest, "is missing"
+        except Exception as e:
+            return digest, f"can not be read: {e!r}"
+        if chunk_hash(data) != digest:
+            return digest, "does not match its hash"
+        return digest, None
+
+    def _hash_blocks(self, fd: int, size: int, block_size: int, algorithm: str,
+                     extents: list, stats: VerifyStats) -> list:
+        """ Returns the digests of the blocks of a file, hashed in parallel """
+        zero_digest = None
+        jobs = []
+        extent_index = 0
+        for offset in range(0, size, block_size):
+            length = min(block_size, size - offset)
+            while extent_index < len(extents) and sum(extents[extent_index]) <= offset:
+                extent_index += 1
+            in_hole = extent_index == len(extents) or extents[extent_index][0] >= offset + length
+            if in_hole and length == block_size:
+                if zero_digest is None:
+                    zero_digest = checksum.hash_block(algorithm, bytes(block_size))
+                jobs.append(zero_digest)
+            else:
+                jobs.append((offset, length))
+                stats.bytes_read += length
+
+        def hash_job(job):
+            if isinstance(job, str):
+                return job
+            return checksum.hash_block(algorithm, os.pread(fd, job[1], job[0]))
+
+        return list(self._map(hash_job, jobs))
+
+    def _map(self, func, items: list):
+        """ Runs func over the items in the thread pool, with a bounded number in flight """
+        pending = deque()
+        for item in items:
+            if len(pending) >= self._threads * 2:
+                yield pending.popleft().result()
+            pending.append(self._executor.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
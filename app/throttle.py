@@ -0,0 +1,229 @@
+"""
+Throttling of the reads sent to the cluster
+
+The reads of the exports are limited with token buckets, in bytes and in
+operations per second, for the whole run and for every image. The limits can
+change with the time of the day following a schedule of windows:
+
+    throttle:
+      bytes_per_second: 0           # whole run, 0 is unlimited
+      ops_per_second: 0
+      image_bytes_per_second: 0     # every image
+      image_ops_per_second: 0
+      schedule:
+        - start: "08:00"            # local time, a window may cross midnight
+          end: "20:00"
+          bytes_per_second: 104857600
+
+The limits missing in a window keep their base value. A read bigger than the
+tokens available is not split: the bucket goes into debt and the next reads
+wait until it is paid.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+import threading
+
+LIMITS = ["bytes_per_second", "ops_per_second", "image_bytes_per_second", "image_ops_per_second"]
+
+# Seconds between two checks of the schedule
+SCHEDULE_CHECK_INTERVAL = 30
+
+
+def parse_time_of_day(value) -> int:
+    """
+    Returns the minutes since midnight of a "HH:MM" time
+
+    YAML reads an unquoted time such as 20:00 as a base 60 integer, which
+    already is the number of minutes.
+    """
+
+    if isinstance(value, int):
+        minutes = value
+    else:
+        try:
+            hours, minutes = str(value).split(":")
+            minutes = int(hours) * 60 + int(minutes)
+        except ValueError:
+            raise ValueError(f"Wrong time of day \"{value}\", please use HH:MM")
+    if not 0 <= minutes <= 24 * 60:
+        raise ValueError(f"Wrong time of day \"{value}\", please use HH:MM")
+    return minutes
+
+
+def check_config(config: dict):
+    """
+    Checks the throttle section of the backup config
+
+    Raises
+    ------
+    ValueError
+        when a limit or a window of the schedule is wrong
+    """
+
+    for window in [config] + list(config.get("schedule") or []):
+        for limit in LIMITS:
+            if float(window.get(limit) or 0) < 0:
+                raise ValueError(f"Throttle {limit} cannot be negative")
+    for window in config.get("schedule") or []:
+        if "start" not in window or "end" not in window:
+            raise ValueError("Every throttle schedule window needs a start and an end")
+        parse_time_of_day(window["start"])
+        parse_time_of_day(window["end"])
+
+
+class TokenBucket():
+    """
+    Token bucket shared by several threads
+    """
+
+    def __init__(self, rate: float = 0):
+        """
+        Parameters
+        ----------
+        rate : float
+            tokens added per second, also the size of the bucket (0 for
+            unlimited)
+        """
+
+        self._lock = threading.Lock()
+        self._rate = 0.0
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self.set_rate(rate)
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            now = time.monotonic()
+            if self._rate <= 0:
+                # A bucket that was unlimited starts full
+                self._tokens = float(rate)
+            else:
+                self._refill(now)
+                self._tokens = min(self._tokens, float(rate))
+            self._rate = float(rate)
+            self._last = now
+
+    def reserve(self, amount: float) -> float:
+        """ Takes `amount` tokens, returns the seconds to wait before using them """
+        with self._lock:
+            if self._rate <= 0:
+                return 0.0
+            self._refill(time.monotonic())
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self._rate
+
+    def _refill(self, now: float):
+        self._tokens = min(self._rate, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+
+class Throttle():
+    """
+    Read limits of a run, for the whole run and for every image
+    """
+
+    def __init__(self, config: dict = None):
+        """
+        Parameters
+        ----------
+        config : dict
+            throttle section of the backup config
+        """
+
+        config = config or {}
+        check_config(config)
+        self._base = {limit: float(config.get(limit) or 0) for limit in LIMITS}
+        self._schedule = []
+        for window in config.get("schedule") or []:
+            limits = {limit: float(window[limit] or 0) for limit in LIMITS if limit in window}
+            self._schedule.append((parse_time_of_day(window["start"]),
+                                   parse_time_of_day(window["end"]), limits))
+
+        self._lock = threading.Lock()
+        self._limits = None
+        self._checked_at = None
+        self._bytes = TokenBucket()
+        self._ops = TokenBucket()
+        self._images = {}
+        self.refresh()
+
+    @property
+    def enabled(self) -> bool:
+        """ Whether any limit is set, at any time of the day """
+        return any(self._base.values()) or \
+            any(any(limits.values()) for _, _, limits in self._schedule)
+
+    def limits(self, now: time.struct_time = None) -> dict:
+        """ Returns the limits at a local time (now by default) """
+        now = now or time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        limits = dict(self._base)
+        for start, end, window in self._schedule:
+            if start <= end:
+                active = start <= minute < end
+            else:
+                active = minute >= start or minute < end
+            if active:
+                limits.update(window)
+        return limits
+
+    def refresh(self):
+        """ Applies the limits of the current time of the day """
+        limits = self.limits()
+        with self._lock:
+            self._checked_at = time.monotonic()
+            if limits == self._limits:
+                return
+            if self._limits is not None:
+                logger.info(f"Read limits changed to {self._describe(limits)}")
+            self._limits = limits
+            self._bytes.set_rate(limits["bytes_per_second"])
+            self._ops.set_rate(limits["ops_per_second"])
+            for image_bytes, image_ops in self._images.values():
+                image_bytes.set_rate(limits["image_bytes_per_second"])
+                image_ops.set_rate(limits["image_ops_per_second"])
+
+    def acquire(self, image_name: str, length: int) -> float:
+        """
+        Waits until a read of `length` bytes of an image is allowed
+
+        Returns
+        -------
+        float
+            seconds waited
+        """
+
+        if time.monotonic() - self._checked_at >= SCHEDULE_CHECK_INTERVAL:
+            self.refresh()
+        image_bytes, image_ops = self._image_buckets(image_name)
+        wait = max(self._bytes.reserve(length), self._ops.reserve(1),
+                   image_bytes.reserve(length), image_ops.reserve(1))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def _image_buckets(self, image_name: str) -> tuple:
+        with self._lock:
+            buckets = self._images.get(image_name)
+            if buckets is None:
+                buckets = (TokenBucket(self._limits["image_bytes_per_second"]),
+                           TokenBucket(self._limits["image_ops_per_second"]))
+                self._images[image_name] = buckets
+            return buckets
+
+    @staticmethod
+    def _describe(limits: dict) -> str:
+        return ", ".join(f"{limit} {int(value) if value else 'unlimited'}"
+                         for limit, value in limits.items())
+
+    def __str__(self):
+        return self._describe(self._limits)
@@ -0,0 +1,156 @@
+"""
+Tracing of the phases of a backup run
+
+While tracing is on, every phase of the backup of an image (metadata lookup,
+snapshot creation, export, fsync, snapshot removal, reference update...) is
+recorded as a span with its thread, duration, bytes and outcome, and the run
+is written as a Chrome trace (JSON), that chrome://tracing and Perfetto open:
+
+    with tracing.span("export", image=image) as span:
+        stats = export()
+        span.set(bytes_read=stats.bytes_read)
+
+While it is off, span() returns a shared span that does nothing.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import json
+import time
+import threading
+
+_tracer = None
+
+
+class _NullSpan():
+    """ Span of a run without tracing """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span():
+    """ Phase being traced, recorded when it ends """
+
+    __slots__ = ("_tracer", "_name", "_args", "_start")
+
+    def __init__(self, tracer, name: str, args: dict):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        self._args["outcome"] = "ok" if exc_type is None else f"error: {exc_type.__name__}"
+        self._tracer.record(self._name, self._start, end, self._args)
+        return False
+
+    def set(self, **args):
+        """ Adds arguments to the span, such as the bytes of the phase """
+        self._args.update(args)
+
+
+class Tracer():
+    """
+    Spans of a run, written as a Chrome trace
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters
+        ----------
+        path : str
+            path of the trace file
+        """
+
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._started_at = time.time()
+        self._pid = os.getpid()
+        self._events = []
+        self._threads = {}
+
+    def span(self, name: str, **args) -> Span:
+        return Span(self, name, args)
+
+    def record(self, name: str, start: float, end: float, args: dict):
+        thread = threading.current_thread()
+        event = {
+            "name": name, "cat": "backup", "ph": "X", "pid": self._pid, "tid": thread.ident,
+            "ts": round((start - self._origin) * 1e6, 3), "dur": round((end - start) * 1e6, 3),
+            "args": args
+        }
+        with self._lock:
+            self._events.append(event)
+            self._threads.setdefault(thread.ident, thread.name)
+
+    def write(self):
+        """ Writes the trace file atomically """
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        metadata = [{"name": "process_name", "ph": "M", "pid": self._pid, "tid": 0,
+                     "args": {"name": "onbackup"}}]
+        metadata += [{"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid,
+                      "args": {"name": name}} for tid, name in threads.items()]
+        trace = {
+            "traceEvents": metadata + events,
+            "displayTimeUnit": "ms",
+            "otherData": {"started_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self._started_at))}
+        }
+        partial = f"{self.path}.part"
+        with open(partial, "w") as f:
+            json.dump(trace, f)
+        os.replace(partial, self.path)
+
+
+def start(path: str) -> Tracer:
+    """ Starts tracing the run into a file """
+    global _tracer
+    _tracer = Tracer(path)
+    logger.info(f"Tracing the run into {path}")
+    return _tracer
+
+
+def stop():
+    """ Stops tracing and writes the trace file """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return
+    try:
+        tracer.write()
+        logger.info(f"Trace written to {tracer.path}")
+    except OSError as e:
+        logger.error(f"Could not write the trace to {tracer.path}: {e!r}")
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name: str, **args):
+    """ Returns a span of the phase `name`, to use as a context manager """
+    tracer = _tracer
+    if tracer is None:
+        return NULL_SPAN
+    return tracer.span(name, **args)
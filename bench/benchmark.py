@@ -0,0 +1,210 @@
+"""
+Benchmark of the backups against an in-memory cluster
+
+Runs a full and a diff backup of synthetic pools, with the rados and rbd
+modules of bench/fake instead of the real bindings, and reports the wall
+time, the throughput and the operations of every run. The cost of the reads
+is simulated with a latency per request and a bandwidth shared by all of
+them.
+
+    python bench/benchmark.py --sizes 256M 1G --fill 0.1 0.5 1 --images 4 \\
+        --workers 2 --latency 2 --bandwidth 400
+
+Every scenario runs a full backup, a first diff backup (`base`, that exports
+the whole images and keeps their reference snapshots) and a diff backup of the
+changes of `--change` of the allocated objects of every image. With
+`--offsite` the exported files are also copied to a directory or uploaded to
+the in-memory S3 store of bench/fake while they are written.
+"""
+
+import os
+import sys
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The fake bindings take the place of the real ones
+sys.path[:0] = [os.path.join(BASE_PATH, "bench", "fake"), BASE_PATH]
+
+import copy
+import time
+import shutil
+import logging
+import tempfile
+from argparse import ArgumentParser
+
+import rados
+import rbd
+import boto3
+import app
+from app.ceph.ceph import Ceph
+from app.ceph.targets import BackupRun, resolve_targets
+
+POOL = "bench"
+BUCKET = "bench"
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+MB = 1024 * 1024
+
+
+def parse_size(value: str) -> int:
+    """ Returns the bytes of a size such as 512M or 2G """
+    value = value.strip().upper()
+    if value and value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+def parse_args():
+    parser = ArgumentParser(description="Benchmark of the backups against an in-memory cluster")
+    parser.add_argument("--sizes", nargs="+", default=["256M", "1G"],
+                        help="Sizes of the images of every pool (K, M, G suffixes)")
+    parser.add_argument("--fill", nargs="+", type=float, default=[0.1, 0.5, 1.0],
+                        help="Ratios of the objects of the images that are allocated")
+    parser.add_argument("--images", type=int, default=4, help="Images of every pool")
+    parser.add_argument("--change", type=float, default=0.1,
+                        help="Ratio of the allocated objects changed before the diff run")
+    parser.add_argument("--order", type=int, default=rbd.DEFAULT_ORDER,
+                        help="Objects of 2^order bytes")
+    parser.add_argument("--workers", type=int, default=1, help="Images backed up at the same time")
+    parser.add_argument("--queue-depth", type=int, default=None, help="Reads in flight of every image")
+    parser.add_argument("--read-size", default=None, help="Bytes of every read request")
+    parser.add_argument("--cache", choices=["keep", "dontneed", "direct"], default=None,
+                        help="Page cache mode of the exported files")
+    parser.add_argument("--sync-interval", default=None, help="Bytes written between the syncs of a file")
+    parser.add_argument("--compression", choices=["none", "zstd", "lz4"], default=None,
+                        help="Codec of the exported files")
+    parser.add_argument("--latency", type=float, default=0.0, help="Milliseconds of every read")
+    parser.add_argument("--op-latency", type=float, default=0.0,
+                        help="Milliseconds of every snapshot and listing operation")
+    parser.add_argument("--bandwidth", type=float, default=0.0,
+                        help="MB/s of the cluster shared by every read (0 is unlimited)")
+    parser.add_argument("--offsite", choices=["none", "local", "s3"], default="none",
+                        help="Backend of the offsite copies of the exported files")
+    parser.add_argument("--part-size", default=None, help="Bytes of every uploaded part")
+    parser.add_argument("--upload-concurrency", type=int, default=None,
+                        help="Parts of every file uploaded at the same time")
+    parser.add_argument("--upload-bandwidth", type=float, default=0.0,
+                        help="MB/s of the S3 store shared by every upload (0 is unlimited)")
+    parser.add_argument("--directory", default=None,
+                        help="Directory where the backups of every scenario are written and removed")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the log of the backups")
+    return parser.parse_args()
+
+
+def backup_config(args, directory: str) -> dict:
+    config = copy.deepcopy(app.default_config)
+    backup = config["backup"]
+    backup.update({"pool": POOL, "directory": directory, "images": ["*"], "workers": args.workers})
+    if args.queue_depth is not None:
+        backup["export"]["queue_depth"] = args.queue_depth
+    if args.read_size is not None:
+        backup["export"]["read_size"] = parse_size(args.read_size)
+    if args.cache is not None:
+        backup["export"]["cache"] = args.cache
+    if args.sync_interval is not None:
+        backup["export"]["sync_interval"] = parse_size(args.sync_interval)
+    if args.compression is not None:
+        backup["compression"]["codec"] = args.compression
+    offsite = backup["offsite"]
+    offsite["backend"] = args.offsite
+    if args.offsite == "local":
+        offsite["directory"] = f"{directory}.offsite"
+        os.mkdir(offsite["directory"])
+    elif args.offsite == "s3":
+        offsite["bucket"] = BUCKET
+        boto3.reset()
+        boto3.client("s3").create_bucket(Bucket=BUCKET)
+    if args.part_size is not None:
+        offsite["part_size"] = parse_size(args.part_size)
+    if args.upload_concurrency is not None:
+        offsite["concurrency"] = args.upload_concurrency
+    return config
+
+
+def create_pool(args, size: int, fill: float):
+    """ Creates the pool of a scenario and returns its ioctx """
+    rados.reset()
+    handler = rados.Rados()
+    handler.create_pool(POOL)
+    ioctx = handler.open_ioctx(POOL)
+    for index in range(args.images):
+        name = f"image-{index}"
+        rbd.RBD().create(ioctx, name, size, order=args.order)
+        rbd.fill(ioctx, name, fill, seed=index)
+    return ioctx
+
+
+def run_backup(config: dict, backup_type: str, ioctx) -> dict:
+    """ Runs a backup and returns its measures """
+    stats_before = ioctx.get_stats()
+    started = time.monotonic()
+    run = BackupRun(resolve_targets(config["cluster"], config["backup"]), config["backup"])
+    try:
+        results = run.full_backup() if backup_type == "full" else run.full_diff_backup()
+    finally:
+        run.close()
+    wall = time.monotonic() - started
+    stats_after = ioctx.get_stats()
+
+    measures = {"type": backup_type, "wall": wall, "failed": 0, "read": 0, "written": 0, "snapshot": 0.0}
+    for result in results:
+        if not result.success:
+            measures["failed"] += 1
+            continue
+        measures["read"] += result.value.bytes_read
+        measures["written"] += result.value.bytes_written
+        measures["snapshot"] += sum(seconds for phase, seconds in result.value.phases.items()
+                                    if phase in ("snapshot", "cleanup", "reference"))
+    measures["ops"] = stats_after["num_rd"] - stats_before["num_rd"]
+    return measures
+
+
+def wait_next_timestamp(last: str) -> str:
+    """ Snapshots are named after the timestamp of the run, two runs need different ones """
+    while True:
+        timestamp = Ceph._get_current_timestamp()
+        if timestamp != last:
+            return timestamp
+        time.sleep(0.05)
+
+
+def print_row(columns: list):
+    print("  ".join(str(column).rjust(width) for column, width in zip(columns, WIDTHS)))
+
+
+HEADER = ["size", "fill", "run", "wall s", "read MB", "MB/s", "read ops", "written MB", "snap s", "failed"]
+WIDTHS = [8, 5, 5, 8, 9, 9, 9, 11, 7, 6]
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    rados.configure(latency=args.latency / 1000, bandwidth=args.bandwidth * MB,
+                    op_latency=args.op_latency / 1000)
+
+    print(f"{args.images} images, {args.workers} workers, latency {args.latency} ms, "
+          f"bandwidth {args.bandwidth or 'unlimited'} MB/s, {args.change:.0%} changed before the diff\n")
+    print_row(HEADER)
+    timestamp = None
+    for size in map(parse_size, args.sizes):
+        for fill in args.fill:
+            directory = tempfile.mkdtemp(prefix="onbackup-bench-", dir=args.directory)
+            try:
+                config = backup_config(args, directory)
+                ioctx = create_pool(args, size, fill)
+                for run_name in ("full", "base", "diff"):
+                    if run_name == "diff":
+                        for index in range(args.images):
+                            rbd.rewrite(ioctx, f"image-{index}", args.change, seed=index + 1)
+                    timestamp = wait_next_timestamp(timestamp)
+                    m = run_backup(config, "full" if run_name == "full" else "diff", ioctx)
+                    print_row([f"{size // MB}M", fill, run_name, f"{m['wall']:.2f}",
+                               f"{m['read'] / MB:.0f}", f"{m['read'] / MB / m['wall']:.1f}",
+                               m["ops"], f"{m['written'] / MB:.0f}", f"{m['snapshot']:.2f}",
+                               m["failed"]])
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+                shutil.rmtree(f"{directory}.offsite", ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
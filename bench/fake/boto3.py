@@ -0,0 +1,193 @@
+"""
+In-memory stand-in of an S3-compatible store for the boto3 bindings
+
+Implements the requests of the s3 offsite backend: single uploads and
+multipart uploads. The uploads share a simulated link set with `configure`,
+like the reads of the rados module. The content of the objects is only kept
+with `keep_data`, otherwise only their size is, so the copies of a benchmark
+do not fill the memory.
+"""
+
+import time
+import uuid
+import hashlib
+import threading
+
+__version__ = "fake"
+
+
+class ClientError(Exception):
+    pass
+
+
+class _Link():
+    """ Uploads queued one after the other at `bandwidth` bytes per second """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._free_at = 0.0
+        self.latency = 0.0
+        self.bandwidth = 0.0
+
+    def transfer(self, length: int):
+        now = time.monotonic()
+        done = now
+        if self.bandwidth > 0:
+            with self._lock:
+                self._free_at = max(now, self._free_at) + length / self.bandwidth
+                done = self._free_at
+        done += self.latency
+        if done > now:
+            time.sleep(done - now)
+
+
+class _Object():
+    __slots__ = ("size", "data")
+
+    def __init__(self, size: int, data: bytes = None):
+        self.size = size
+        self.data = data
+
+
+_lock = threading.Lock()
+_buckets = {}
+_uploads = {}
+_stats = {"requests": 0, "parts": 0, "bytes": 0, "in_flight": 0, "max_in_flight": 0}
+link = _Link()
+keep_data = False
+
+
+def configure(latency: float = 0.0, bandwidth: float = 0.0, keep: bool = False):
+    """
+    Sets the simulated cost of the uploads
+
+    Parameters
+    ----------
+    latency : float
+        seconds added to every request
+    bandwidth : float
+        bytes per second shared by all the uploads (0 is unlimited)
+    keep : bool
+        whether the content of the objects is kept
+    """
+
+    global keep_data
+    link.latency = float(latency)
+    link.bandwidth = float(bandwidth)
+    keep_data = bool(keep)
+
+
+def reset():
+    """ Removes every bucket, upload and statistic """
+    with _lock:
+        _buckets.clear()
+        _uploads.clear()
+        for key in _stats:
+            _stats[key] = 0
+
+
+def stats() -> dict:
+    with _lock:
+        return dict(_stats)
+
+
+def objects(bucket: str) -> dict:
+    """ Objects of a bucket, by key """
+    with _lock:
+        return dict(_buckets.get(bucket, {}))
+
+
+def pending_uploads() -> list:
+    """ Multipart uploads neither completed nor aborted """
+    with _lock:
+        return [(upload["bucket"], upload["key"]) for upload in _uploads.values()]
+
+
+def client(service_name: str, endpoint_url: str = None, region_name: str = None,
+           aws_access_key_id: str = None, aws_secret_access_key: str = None, config=None):
+    return Client()
+
+
+class Client():
+    def create_bucket(self, Bucket: str, **kwargs):
+        with _lock:
+            _buckets.setdefault(Bucket, {})
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs) -> dict:
+        body = bytes(Body)
+        self._transfer(len(body))
+        with _lock:
+            self._bucket(Bucket)[Key] = _Object(len(body), body if keep_data else None)
+        return {"ETag": f"\"{hashlib.md5(body).hexdigest()}\""}
+
+    def create_multipart_upload(self, Bucket: str, Key: str, **kwargs) -> dict:
+        with _lock:
+            self._bucket(Bucket)
+            _stats["requests"] += 1
+            upload_id = uuid.uuid4().hex
+            _uploads[upload_id] = {"bucket": Bucket, "key": Key, "parts": {}}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes,
+                    **kwargs) -> dict:
+        body = bytes(Body)
+        with _lock:
+            _stats["in_flight"] += 1
+            _stats["max_in_flight"] = max(_stats["max_in_flight"], _stats["in_flight"])
+        try:
+            self._transfer(len(body))
+        finally:
+            with _lock:
+                _stats["in_flight"] -= 1
+        etag = f"\"{hashlib.md5(body).hexdigest()}\""
+        with _lock:
+            upload = self._upload(UploadId)
+            _stats["parts"] += 1
+            upload["parts"][PartNumber] = (etag, len(body), body if keep_data else None)
+        return {"ETag": etag}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict,
+                                  **kwargs) -> dict:
+        with _lock:
+            upload = self._upload(UploadId)
+            numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+            if not numbers or numbers != sorted(numbers):
+                raise ClientError("InvalidPartOrder")
+            parts = []
+            for part in MultipartUpload["Parts"]:
+                uploaded = upload["parts"].get(part["PartNumber"])
+                if uploaded is None or uploaded[0] != part["ETag"]:
+                    raise ClientError(f"InvalidPart {part['PartNumber']}")
+                parts.append(uploaded)
+            size = sum(length for _, length, _ in parts)
+            data = b"".join(body for _, _, body in parts) if keep_data else None
+            self._bucket(Bucket)[Key] = _Object(size, data)
+            del _uploads[UploadId]
+        return {"Bucket": Bucket, "Key": Key}
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str, **kwargs) -> dict:
+        with _lock:
+            self._upload(UploadId)
+            del _uploads[UploadId]
+        return {}
+
+    @staticmethod
+    def _transfer(length: int):
+        link.transfer(length)
+        with _lock:
+            _stats["requests"] += 1
+            _stats["bytes"] += length
+
+    @staticmethod
+    def _bucket(name: str) -> dict:
+        bucket = _buckets.get(name)
+        if bucket is None:
+            raise ClientError(f"NoSuchBucket {name}")
+        return bucket
+
+    @staticmethod
+    def _upload(upload_id: str) -> dict:
+        upload = _uploads.get(upload_id)
+        if upload is None:
+            raise ClientError(f"NoSuchUpload {upload_id}")
+        return upload
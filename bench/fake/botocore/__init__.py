@@ -0,0 +1 @@
+""" Stand-in of botocore for the fake boto3 module """
@@ -0,0 +1,8 @@
+"""
+Stand-in of the client config of botocore, its options are ignored
+"""
+
+
+class Config():
+    def __init__(self, **kwargs):
+        self.options = kwargs
@@ -0,0 +1,176 @@
+"""
+In-memory stand-in of the python rados bindings
+
+Implements the subset of the API used by the backup: the cluster handler,
+the pools and their ioctx with statistics. The images live in the pools (see
+the rbd module of this directory), so every handler of the process sees the
+same cluster.
+
+The cost of the data transferred is simulated with `configure`: every read
+or write waits `latency` seconds and shares a link of `bandwidth` bytes per
+second with the rest of the requests in flight.
+"""
+
+import time
+import threading
+
+__version__ = "fake"
+
+
+class Error(Exception):
+    pass
+
+
+class ObjectNotFound(Error):
+    pass
+
+
+class ObjectExists(Error):
+    pass
+
+
+class _Link():
+    """
+    Link of the cluster shared by every request
+
+    The transfers are queued one after the other at `bandwidth` bytes per
+    second, while their latencies overlap.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._free_at = 0.0
+        self.latency = 0.0
+        self.op_latency = 0.0
+        self.bandwidth = 0.0
+
+    def transfer(self, length: int):
+        now = time.monotonic()
+        done = now
+        if self.bandwidth > 0:
+            with self._lock:
+                self._free_at = max(now, self._free_at) + length / self.bandwidth
+                done = self._free_at
+        done += self.latency
+        if done > now:
+            time.sleep(done - now)
+
+    def operation(self):
+        """ Metadata operation (snapshots, listings) """
+        if self.op_latency > 0:
+            time.sleep(self.op_latency)
+
+
+class _Pool():
+    def __init__(self, name: str):
+        self.name = name
+        self.images = {}
+        self.lock = threading.Lock()
+        self.stats = {"num_rd": 0, "num_rd_kb": 0, "num_wr": 0, "num_wr_kb": 0}
+
+    def account(self, kind: str, length: int):
+        with self.lock:
+            self.stats[f"num_{kind}"] += 1
+            self.stats[f"num_{kind}_kb"] += length // 1024
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+link = _Link()
+
+
+def configure(latency: float = 0.0, bandwidth: float = 0.0, op_latency: float = 0.0):
+    """
+    Sets the simulated cost of the requests
+
+    Parameters
+    ----------
+    latency : float
+        seconds added to every read and write
+    bandwidth : float
+        bytes per second shared by all the reads and writes (0 is unlimited)
+    op_latency : float
+        seconds added to every metadata operation
+    """
+
+    link.latency = float(latency)
+    link.bandwidth = float(bandwidth)
+    link.op_latency = float(op_latency)
+
+
+def reset():
+    """ Removes every pool """
+    with _pools_lock:
+        _pools.clear()
+
+
+class Ioctx():
+    def __init__(self, pool: _Pool):
+        self._pool = pool
+        self.name = pool.name
+
+    @property
+    def pool(self) -> _Pool:
+        return self._pool
+
+    def get_stats(self) -> dict:
+        with self._pool.lock:
+            return dict(self._pool.stats)
+
+    def close(self):
+        pass
+
+
+class Rados():
+    def __init__(self, rados_id=None, name=None, clustername=None, conf_defaults=None,
+                 conffile=None, conf=None, flags=0):
+        self._connected = False
+
+    def version(self) -> str:
+        return __version__
+
+    def conf_get(self, option: str) -> str:
+        return "fake"
+
+    def connect(self, timeout: int = 0):
+        self._connected = True
+
+    def shutdown(self):
+        self._connected = False
+
+    def get_fsid(self) -> bytes:
+        return b"00000000-0000-0000-0000-000000000000"
+
+    def create_pool(self, pool_name: str):
+        with _pools_lock:
+            if pool_name in _pools:
+                raise ObjectExists(pool_name)
+            _pools[pool_name] = _Pool(pool_name)
+
+    def pool_exists(self, pool_name: str) -> bool:
+        return pool_name in _pools
+
+    def delete_pool(self, pool_name: str):
+        with _pools_lock:
+            if _pools.pop(pool_name, None) is None:
+                raise ObjectNotFound(pool_name)
+
+    def list_pools(self) -> list:
+        return list(_pools)
+
+    def open_ioctx(self, pool_name: str) -> Ioctx:
+        pool = _pools.get(pool_name)
+        if pool is None:
+            raise ObjectNotFound(f"pool {pool_name} does not exist")
+        return Ioctx(pool)
+
+    def get_cluster_stats(self) -> dict:
+        used = 0
+        objects = 0
+        for pool in list(_pools.values()):
+            for image in list(pool.images.values()):
+                used += image.allocated_bytes()
+                objects += len(image.objects)
+        kb_used = used // 1024
+        return {"kb": max(kb_used * 2, 1), "kb_used": kb_used, "kb_avail": max(kb_used, 1),
+                "num_objects": objects}
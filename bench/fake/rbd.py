@@ -0,0 +1,376 @@
+"""
+In-memory stand-in of the python rbd bindings
+
+Images are sparse: only the objects written (or filled with `fill`) are
+stored, and the snapshots share the objects that did not change since they
+were taken, so the pools of a benchmark can be much bigger than the memory.
+The objects filled with `fill` are not stored either, their content is a view
+of a shared block of random bytes, shifted by the seed of the object.
+
+Every read and write goes through the simulated link of the rados module.
+"""
+
+import os
+import math
+import threading
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import rados
+
+RBD_FEATURE_LAYERING = 1
+RBD_FEATURE_EXCLUSIVE_LOCK = 4
+RBD_FEATURE_OBJECT_MAP = 8
+RBD_FEATURE_FAST_DIFF = 16
+RBD_FEATURE_DEEP_FLATTEN = 32
+DEFAULT_FEATURES = (RBD_FEATURE_LAYERING | RBD_FEATURE_EXCLUSIVE_LOCK | RBD_FEATURE_OBJECT_MAP |
+                    RBD_FEATURE_FAST_DIFF | RBD_FEATURE_DEEP_FLATTEN)
+DEFAULT_ORDER = 22
+
+# Threads that complete the aio requests, like the callbacks of librbd
+AIO_THREADS = 64
+
+
+class Error(Exception):
+    pass
+
+
+class ImageExists(Error):
+    pass
+
+
+class ImageNotFound(Error):
+    pass
+
+
+class ImageBusy(Error):
+    pass
+
+
+class ReadOnlyImage(Error):
+    pass
+
+
+class InvalidArgument(Error):
+    pass
+
+
+_generations = itertools.count(1)
+_noise = {}
+_noise_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _noise_block(object_size: int) -> bytes:
+    """ Random bytes shared by the filled objects, a bit longer than an object """
+    with _noise_lock:
+        block = _noise.get(object_size)
+        if block is None:
+            block = _noise[object_size] = os.urandom(object_size + 65536)
+        return block
+
+
+def _aio_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=AIO_THREADS, thread_name_prefix="fake-aio")
+        return _executor
+
+
+class _Object():
+    """ Object of an image: written data, or a seed of the shared random block """
+
+    __slots__ = ("generation", "data", "seed")
+
+    def __init__(self, data: bytes = None, seed: int = None):
+        self.generation = next(_generations)
+        self.data = data
+        self.seed = seed
+
+    def read(self, offset: int, length: int, object_size: int) -> bytes:
+        if self.data is not None:
+            return self.data[offset:offset + length]
+        shift = self.seed % 65536 + offset
+        return _noise_block(object_size)[shift:shift + length]
+
+
+class _ImageData():
+    def __init__(self, size: int, order: int, features: int):
+        self.lock = threading.RLock()
+        self.size = int(size)
+        self.order = int(order)
+        self.object_size = 1 << self.order
+        self.features = features
+        self.objects = {}
+        self.snaps = OrderedDict()
+        self.snap_ids = itertools.count(1)
+
+    def allocated_bytes(self) -> int:
+        return len(self.objects) * self.object_size
+
+
+class RBD():
+    def list(self, ioctx) -> list:
+        rados.link.operation()
+        return list(ioctx.pool.images)
+
+    def create(self, ioctx, name: str, size: int, order: int = None, old_format: bool = False,
+               features: int = None, *args, **kwargs):
+        rados.link.operation()
+        with ioctx.pool.lock:
+            if name in ioctx.pool.images:
+                raise ImageExists(f"image {name} already exists")
+            ioctx.pool.images[name] = _ImageData(size, order or DEFAULT_ORDER,
+                                                 DEFAULT_FEATURES if features is None else features)
+
+    def remove(self, ioctx, name: str, *args, **kwargs):
+        rados.link.operation()
+        with ioctx.pool.lock:
+            image = ioctx.pool.images.get(name)
+            if image is None:
+                raise ImageNotFound(f"image {name} does not exist")
+            if image.snaps:
+                raise ImageBusy(f"image {name} has snapshots")
+            del ioctx.pool.images[name]
+
+
+class Completion():
+    def __init__(self):
+        self._done = threading.Event()
+        self._return_value = None
+
+    def get_return_value(self) -> int:
+        return self._return_value
+
+    def is_complete(self) -> bool:
+        return self._done.is_set()
+
+    def wait_for_complete_and_cb(self):
+        self._done.wait()
+
+    def _complete(self, return_value: int):
+        self._return_value = return_value
+        self._done.set()
+
+
+class Image():
+    def __init__(self, ioctx, name: str, snapshot: str = None, read_only: bool = False, *args, **kwargs):
+        self._ioctx = ioctx
+        self.name = name
+        image = ioctx.pool.images.get(name)
+        if image is None:
+            raise ImageNotFound(f"image {name} does not exist")
+        self._image = image
+        self._read_only = read_only
+        self._snapshot = None
+        if snapshot is not None:
+            self.set_snap(snapshot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _view(self) -> tuple:
+        """ Objects and size of the image or the snapshot being read """
+        if self._snapshot is None:
+            return self._image.objects, self._image.size
+        _, objects, size = self._image.snaps[self._snapshot]
+        return objects, size
+
+    def size(self) -> int:
+        return self._view()[1]
+
+    def stat(self) -> dict:
+        size = self.size()
+        return {"size": size, "obj_size": self._image.object_size,
+                "num_objs": -(-size // self._image.object_size), "order": self._image.order,
+                "block_name_prefix": f"rbd_data.{self.name}", "parent_pool": -1, "parent_name": ""}
+
+    def features(self) -> int:
+        return self._image.features
+
+    def flags(self) -> int:
+        return 0
+
+    def parent_info(self) -> tuple:
+        raise ImageNotFound(f"image {self.name} has no parent")
+
+    def flush(self):
+        pass
+
+    def set_snap(self, name: str):
+        if name is not None and name not in self._image.snaps:
+            raise ImageNotFound(f"snapshot {name} does not exist")
+        self._snapshot = name
+
+    def list_snaps(self) -> list:
+        rados.link.operation()
+        with self._image.lock:
+            return [{"id": snap_id, "name": name, "size": size}
+                    for name, (snap_id, _, size) in self._image.snaps.items()]
+
+    def create_snap(self, name: str):
+        rados.link.operation()
+        with self._image.lock:
+            if name in self._image.snaps:
+                raise ImageExists(f"snapshot {name} already exists")
+            self._image.snaps[name] = (next(self._image.snap_ids), dict(self._image.objects),
+                                       self._image.size)
+
+    def remove_snap(self, name: str):
+        rados.link.operation()
+        with self._image.lock:
+            if self._image.snaps.pop(name, None) is None:
+                raise ImageNotFound(f"snapshot {name} does not exist")
+
+    def resize(self, size: int):
+        self._check_writable()
+        rados.link.operation()
+        with self._image.lock:
+            object_size = self._image.object_size
+            for index in [index for index in self._image.objects if index * object_size >= size]:
+                del self._image.objects[index]
+            last = size // object_size
+            if size % object_size and last in self._image.objects:
+                keep = size % object_size
+                data = self._image.objects[last].read(0, keep, object_size)
+                self._image.objects[last] = _Object(data + bytes(object_size - keep))
+            self._image.size = int(size)
+
+    def read(self, offset: int, length: int, fadvise_flags: int = 0) -> bytes:
+        objects, size = self._view()
+        if offset + length > size:
+            raise InvalidArgument(f"read past the end of the image {self.name}")
+        rados.link.transfer(length)
+        object_size = self._image.object_size
+        out = bytearray(length)
+        position = offset
+        end = offset + length
+        while position < end:
+            index, start = divmod(position, object_size)
+            chunk = min(object_size - start, end - position)
+            obj = objects.get(index)
+            if obj is not None:
+                out[position - offset:position - offset + chunk] = obj.read(start, chunk, object_size)
+            position += chunk
+        self._ioctx.pool.account("rd", length)
+        return bytes(out)
+
+    def aio_read(self, offset: int, length: int, oncomplete, fadvise_flags: int = 0) -> Completion:
+        completion = Completion()
+
+        def run():
+            try:
+                data = self.read(offset, length, fadvise_flags)
+                completion._complete(len(data))
+            except Exception:
+                data = None
+                completion._complete(-5)
+            oncomplete(completion, data)
+
+        _aio_executor().submit(run)
+        return completion
+
+    def write(self, data: bytes, offset: int, fadvise_flags: int = 0) -> int:
+        self._check_writable()
+        rados.link.transfer(len(data))
+        object_size = self._image.object_size
+        with self._image.lock:
+            if offset + len(data) > self._image.size:
+                raise InvalidArgument(f"write past the end of the image {self.name}")
+            position = offset
+            written = 0
+            while written < len(data):
+                index, start = divmod(position, object_size)
+                chunk = min(object_size - start, len(data) - written)
+                obj = self._image.objects.get(index)
+                current = bytearray(obj.read(0, object_size, object_size) if obj else bytes(object_size))
+                current[start:start + chunk] = data[written:written + chunk]
+                self._image.objects[index] = _Object(bytes(current))
+                position += chunk
+                written += chunk
+        self._ioctx.pool.account("wr", len(data))
+        return len(data)
+
+    def discard(self, offset: int, length: int):
+        self._check_writable()
+        object_size = self._image.object_size
+        with self._image.lock:
+            position = offset
+            end = offset + length
+            while position < end:
+                index, start = divmod(position, object_size)
+                chunk = min(object_size - start, end - position)
+                if chunk == object_size:
+                    self._image.objects.pop(index, None)
+                elif index in self._image.objects:
+                    self.write(bytes(chunk), position)
+                position += chunk
+
+    def diff_iterate(self, offset: int, length: int, from_snapshot: str, iterate_cb,
+                     include_parent: bool = True, whole_object: bool = False) -> int:
+        """ Reports the changed extents, object by object, like with the fast-diff feature """
+        with self._image.lock:
+            objects, size = self._view()
+            objects = dict(objects)
+            base = dict(self._image.snaps[from_snapshot][1]) if from_snapshot else {}
+        object_size = self._image.object_size
+        end = min(offset + length, size)
+        for index in sorted(set(objects) | set(base)):
+            start = max(index * object_size, offset)
+            stop = min((index + 1) * object_size, end)
+            if start >= stop:
+                continue
+            current, previous = objects.get(index), base.get(index)
+            if current is None:
+                iterate_cb(start, stop - start, False)
+            elif previous is None or current.generation != previous.generation:
+                iterate_cb(start, stop - start, True)
+        return 0
+
+    def _check_writable(self):
+        if self._read_only or self._snapshot is not None:
+            raise ReadOnlyImage(f"image {self.name} is read only")
+
+
+def fill(ioctx, name: str, ratio: float, seed: int = 0) -> int:
+    """
+    Allocates `ratio` of the objects of an image with random content, without
+    storing it, and returns the number of objects filled. The objects are
+    spread over the whole image
+    """
+
+    image = ioctx.pool.images[name]
+    with image.lock:
+        count = -(-image.size // image.object_size)
+        filled = 0
+        for index in range(count):
+            # Spread the allocated objects evenly
+            if math.ceil((index + 1) * ratio) > math.ceil(index * ratio):
+                image.objects[index] = _Object(seed=seed * 1000003 + index)
+                filled += 1
+    return filled
+
+
+def rewrite(ioctx, name: str, ratio: float, seed: int = 0) -> int:
+    """
+    Replaces the content of `ratio` of the allocated objects of an image, as
+    the writes between two backups, and returns the number of objects changed
+    """
+
+    image = ioctx.pool.images[name]
+    with image.lock:
+        changed = 0
+        for position, index in enumerate(sorted(image.objects)):
+            if math.ceil((position + 1) * ratio) > math.ceil(position * ratio):
+                image.objects[index] = _Object(seed=seed * 1000003 + index + 7919)
+                changed += 1
+    return changed
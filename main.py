@@ -1,6 +1,7 @@
 from argparse import ArgumentParser
 import os
 import sys
+import time
 os.environ['BASE_PATH'] = os.path.abspath(os.path.dirname(__file__))
 
 import app
@@ -37,6 +38,28 @@ def parse_args(parser: ArgumentParser, ceph_config: dict):
         '-d',
         '--directory',
         help="Target directory where backups will be stored")
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        help="Number of images backed up at the same time")
+    parser.add_argument(
+        '--retries',
+        type=int,
+        help="Number of retries for an image whose backup fails")
+    parser.add_argument(
+        '--export-mode',
+        choices=["librbd", "cli"],
+        help="Read the snapshots in-process (librbd) or with the rbd command (cli)")
+    parser.add_argument(
+        '--compression',
+        choices=["none", "zstd", "lz4"],
+        help="Codec used to compress the exported files")
+    parser.add_argument(
+        '--dedup',
+        action="store_true",
+        default=None,
+        help="Store the exports in the deduplicated chunk store")
     parser.add_argument(
         '-v',
         '--verbose',
@@ -56,6 +79,40 @@ def parse_args(parser: ArgumentParser, ceph_config: dict):
         '--diff',
         action="store_true",
         help="Perform a incremental image backup")
+    backup_type_group.add_argument(
+        '--auto',
+        action="store_true",
+        help="Perform a full or an incremental backup of every image, whichever is cheaper")
+    backup_type_group.add_argument(
+        '--restore',
+        action="store_true",
+        help="Restore the images from the backup directory")
+    backup_type_group.add_argument(
+        '--synthetic-full',
+        action="store_true",
+        help="Build a new full backup from the last full backup and its diffs")
+    backup_type_group.add_argument(
+        '--compact',
+        action="store_true",
+        help="Merge the diffs that follow the last full backup into a single diff")
+    backup_type_group.add_argument(
+        '--verify',
+        action="store_true",
+        help="Check the stored backups against their checksums")
+
+    # RESTORE OPTIONS
+    parser.add_argument(
+        '--at',
+        metavar="TIME",
+        help="Point in time to restore, synthesize or compact: backup timestamp, YYYYMMDD or 'YYYY-MM-DD HH:MM' (latest by default)")
+    parser.add_argument(
+        '--target-dir',
+        metavar="PATH",
+        help="Restore the images as raw files <image>.img into this directory")
+    parser.add_argument(
+        '--target-pool',
+        metavar="POOL",
+        help="Restore the images as rbd images into this pool")
 
     args = parser.parse_args()
 
@@ -75,8 +132,34 @@ def parse_args(parser: ArgumentParser, ceph_config: dict):
     if args.diff:
         ceph_config["backup"]["type"] = "diff"
 
+    if args.auto:
+        ceph_config["backup"]["type"] = "auto"
+
+    if args.restore:
+        ceph_config["app"]["mode"] = "restore"
+
+    if args.synthetic_full:
+        ceph_config["app"]["mode"] = "synthetic"
+
+    if args.compact:
+        ceph_config["app"]["mode"] = "compact"
+
+    if args.verify:
+        ceph_config["app"]["mode"] = "verify"
+
+    if args.at:
+        ceph_config["restore"]["at"] = args.at
+
+    if args.target_dir:
+        ceph_config["restore"]["target_dir"] = args.target_dir
+
+    if args.target_pool:
+        ceph_config["restore"]["target_pool"] = args.target_pool
+
     if args.pool:
+        # A pool given in the command line replaces the configured targets
         ceph_config["backup"]["pool"] = args.pool
+        ceph_config["backup"]["targets"] = []
 
     if args.images:
         ceph_config["backup"]["images"] = args.images
@@ -84,29 +167,172 @@ def parse_args(parser: ArgumentParser, ceph_config: dict):
     if args.directory:
         ceph_config["backup"]["directory"] = args.directory
 
+    if args.workers is not None:
+        ceph_config["backup"]["workers"] = args.workers
+        ceph_config["restore"]["workers"] = args.workers
+        ceph_config["verify"]["workers"] = args.workers
+
+    if args.retries is not None:
+        ceph_config["backup"]["retries"] = args.retries
+
+    if args.export_mode:
+        ceph_config["backup"]["export"]["mode"] = args.export_mode
+
+    if args.compression:
+        ceph_config["backup"]["compression"]["codec"] = args.compression
+
+    if args.dedup:
+        ceph_config["backup"]["dedup"]["enabled"] = True
+
+
+def restore(ceph_config):
+
+    cluster_config = ceph_config["cluster"]
+    backup_config = ceph_config["backup"]
+    restore_config = ceph_config["restore"]
+
+    try:
+        at = app.restore.parse_point_in_time(restore_config["at"]) if restore_config["at"] else None
+    except ValueError as e:
+        logger.critical(str(e))
+        sys.exit(1)
+
+    if restore_config["target_pool"]:
+        try:
+            cluster = app.ceph.Ceph(
+                cluster_config["conf_file"], cluster_config["user_keyring"],
+                cluster_config["client"], restore_config["target_pool"],
+                [], backup_config["directory"],
+                dedup_config=backup_config["dedup"])
+        except:
+            sys.exit(1)
+        try:
+            results = cluster.restore(
+                backup_config["pool"], backup_config["images"], at,
+                restore_config["workers"], restore_config["threads"],
+                restore_config["queue_size"])
+        finally:
+            cluster.close_pool_connection()
+    else:
+        results = app.restore.restore_images(
+            backup_config["directory"], backup_config["pool"],
+            backup_config["images"], at, restore_config["target_dir"],
+            chunk_store_dir=backup_config["dedup"]["directory"] or
+            os.path.join(backup_config["directory"], ".chunks"),
+            workers=restore_config["workers"], threads=restore_config["threads"],
+            queue_size=restore_config["queue_size"])
+
+    app.scheduler.Scheduler.print_summary(results, "Restore Summary")
+    if not all(result.success for result in results):
+        sys.exit(1)
+
+
+def maintain_chains(ceph_config):
+
+    backup_config = ceph_config["backup"]
+    restore_config = ceph_config["restore"]
+
+    try:
+        at = app.restore.parse_point_in_time(restore_config["at"]) if restore_config["at"] else None
+    except ValueError as e:
+        logger.critical(str(e))
+        sys.exit(1)
+
+    if ceph_config["app"]["mode"] == "compact":
+        results = app.compact.compact_images(
+            backup_config["directory"], backup_config["pool"], backup_config["images"], at,
+            backup_config["compression"], backup_config["dedup"], backup_config["checksum"],
+            workers=restore_config["workers"], threads=restore_config["threads"])
+        title = "Compaction Summary"
+    else:
+        results = app.synthetic.synthesize_images(
+            backup_config["directory"], backup_config["pool"], backup_config["images"], at,
+            backup_config["compression"], backup_config["dedup"], backup_config["checksum"],
+            workers=restore_config["workers"], threads=restore_config["threads"],
+            queue_size=restore_config["queue_size"])
+        title = "Synthetic Full Summary"
+
+    app.scheduler.Scheduler.print_summary(results, title)
+    if not all(result.success for result in results):
+        sys.exit(1)
+
+
+def verify(ceph_config):
+
+    backup_config = ceph_config["backup"]
+    verify_config = ceph_config["verify"]
+
+    results = app.verify.verify_images(
+        backup_config["directory"], backup_config["pool"], backup_config["images"],
+        chunk_store_dir=backup_config["dedup"]["directory"] or
+        os.path.join(backup_config["directory"], ".chunks"),
+        workers=verify_config["workers"], threads=verify_config["threads"])
+
+    app.scheduler.Scheduler.print_summary(results, "Verify Summary")
+    if not all(result.success for result in results):
+        sys.exit(1)
+
 
 def main(ceph_config):
 
+    if ceph_config["app"]["mode"] == "restore":
+        restore(ceph_config)
+        return
+
+    if ceph_config["app"]["mode"] in ("synthetic", "compact"):
+        maintain_chains(ceph_config)
+        return
+
+    if ceph_config["app"]["mode"] == "verify":
+        verify(ceph_config)
+        return
+
     cluster_config = ceph_config["cluster"]
     backup_config = ceph_config["backup"]
 
+    # Spans of every phase of the run, written as a Chrome trace
+    trace_dir = ceph_config["monitoring"]["trace"]["directory"]
+    if trace_dir:
+        app.tracing.start(os.path.join(trace_dir, f"trace-{time.strftime('%Y%m%d-%H%M%S')}.json"))
+
+    # Metrics of every image, exposed while the run goes on and written
+    # when it ends
     try:
-        cluster = app.ceph.Ceph(
-            cluster_config["conf_file"], cluster_config["user_keyring"],
-            cluster_config["client"], backup_config["pool"],
-            backup_config["images"], backup_config["directory"])
+        monitor = app.prometheus.Monitor(
+            ceph_config["monitoring"]["prometheus"], backup_config["type"], backup_config["pool"])
+    except OSError as e:
+        logger.critical(f"Could not serve the metrics: {e!r}")
+        sys.exit(1)
+
+    # Every pool of the targets (or the backup pool) is backed up in the
+    # same run, sharing the connection of every cluster
+    try:
+        run = app.targets.BackupRun(
+            app.targets.resolve_targets(cluster_config, backup_config), backup_config,
+            on_done=monitor.record)
     except:
+        monitor.close()
         sys.exit(1)
 
     backup_type = backup_config["type"]
-    cluster.print_overview()
+    run.print_overview()
 
     if backup_type == "full":
-        cluster.full_backup()
+        results = run.full_backup()
     elif backup_type == "diff":
-        cluster.full_diff_backup()
+        results = run.full_diff_backup()
+    elif backup_type == "auto":
+        results = run.auto_backup()
     else:
-        logger.critical("Wrong backup type. Must be <full/diff>")
+        logger.critical("Wrong backup type. Must be <full/diff/auto>")
+        sys.exit(1)
+    run.close()
+    monitor.close()
+    app.tracing.stop()
+
+    app.scheduler.Scheduler.print_summary(results)
+    if not all(result.success for result in results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":